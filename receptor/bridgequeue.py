@@ -57,9 +57,17 @@ class BridgeQueue(queue.Queue):
         placed into the queue, signaling to the consumer that all data has
         been read.
         """
-        with open(path, "rb") as fp:
-            chunk = fp.read(chunk_size)
-            while chunk:
-                self.put(chunk)
+        self.read_files([path], chunk_size)
+
+    def read_files(self, paths, chunk_size=2 ** 12):
+        """
+        Like read_from, but reads each of the given paths in turn before
+        placing the sentinel value into the queue.
+        """
+        for path in paths:
+            with open(path, "rb") as fp:
                 chunk = fp.read(chunk_size)
-            self.put(self.sentinel)
+                while chunk:
+                    self.put(chunk)
+                    chunk = fp.read(chunk_size)
+        self.put(self.sentinel)
@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+import time
+import uuid
+
+from ..exceptions import ReceptorBufferError
+from ..stats import blob_dedup_bytes
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """
+    Stores message payloads once per distinct content, named by their
+    SHA-256 digest.
+
+    A queued message refers to a blob through a hard link of its own, so the
+    blob's link count is its reference count: it survives restarts without a
+    separate index and dropping the last message that uses a payload is just
+    a matter of removing links.  Payloads smaller than min_size are not worth
+    hashing and stay inline in the message file.
+
+    Every method does blocking file IO and is meant to run on the file IO
+    thread pool.
+    """
+
+    def __init__(self, path, min_size=2 ** 16, chunk_size=2 ** 20):
+        self.path = path
+        self.min_size = min_size
+        self.chunk_size = chunk_size
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+    def _digest(self, payload):
+        digest = hashlib.sha256()
+        payload.seek(0)
+        for chunk in iter(lambda: payload.read(self.chunk_size), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def _write(self, payload, blob):
+        tmp = os.path.join(self.path, f".{uuid.uuid4()}")
+        try:
+            payload.seek(0)
+            with open(tmp, "wb") as fp:
+                for chunk in iter(lambda: payload.read(self.chunk_size), b""):
+                    fp.write(chunk)
+            try:
+                os.link(tmp, blob)
+            except FileExistsError:
+                pass  # another message stored the same content first
+        finally:
+            os.remove(tmp)
+
+    def store(self, payload, prefix):
+        """
+        Links "<prefix>.<digest>" to the blob holding payload's content,
+        writing the blob only if no identical payload is stored already.
+        Returns the digest and the path of the new link.
+        """
+        digest = self._digest(payload)
+        blob = os.path.join(self.path, digest)
+        dest = f"{prefix}.{digest}"
+        written = False
+        for _ in range(3):
+            try:
+                os.link(blob, dest)
+            except FileNotFoundError:
+                # Either new content, or the last reference went away meanwhile
+                self._write(payload, blob)
+                written = True
+            else:
+                if not written:
+                    blob_dedup_bytes.inc(len(payload))
+                return digest, dest
+        raise ReceptorBufferError(f"Unable to store payload blob {digest}")
+
+    def release(self, path, digest):
+        """Drops the reference held by path, removing the blob if it was the last one."""
+        if os.path.exists(path):
+            os.remove(path)
+        blob = os.path.join(self.path, digest)
+        try:
+            if os.stat(blob).st_nlink <= 1:
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+
+    def collect(self, tmp_age=3600):
+        """Removes blobs no message refers to and abandoned temporary files."""
+        removed = 0
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+                if name.startswith("."):
+                    garbage = st.st_mtime < time.time() - tmp_age
+                else:
+                    garbage = st.st_nlink <= 1
+                if garbage:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        if removed:
+            logger.info("Removed %d unreferenced payload blob(s) from %s", removed, self.path)
+        return removed
@@ -2,30 +2,68 @@ import asyncio
 import datetime
 import logging
 import os
+import struct
+import time
 import uuid
 from collections import defaultdict
 from json.decoder import JSONDecodeError
 
 from .. import fileio
 from .. import serde as json
+from ..messages.framed import Frame, FramedMessage
+from ..messages.priority import Priority, classify
+from ..stats import buffer_recovery_seconds
+from .blobs import BlobStore
+from .lanes import LaneQueue
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_TTL = 300
+VERIFY_BATCH = 256
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def deadline_of(item):
+    """Returns the deadline of a manifest item as a unix timestamp."""
+    expire_time = item["expire_time"]
+    if isinstance(expire_time, datetime.datetime):
+        # Manifests written by older versions store a naive UTC datetime
+        return (expire_time - EPOCH).total_seconds()
+    return expire_time
+
 
 class DurableBuffer:
-    def __init__(self, dir_, key, loop, write_time=1.0):
+    def __init__(
+        self,
+        dir_,
+        key,
+        loop,
+        write_time=1.0,
+        ttl=DEFAULT_TTL,
+        on_expire=None,
+        verify=False,
+        blobs=None,
+    ):
         self._base_path = os.path.join(os.path.expanduser(dir_))
-        self._message_path = os.path.join(self._base_path, "messages")
+        self._message_path = os.path.join(self._base_path, "messages", key)
         self._manifest_path = os.path.join(self._base_path, f"manifest-{key}")
         self._loop = loop
-        self.q = asyncio.Queue(loop=self._loop)
+        self.q = LaneQueue(loop=self._loop)
         self.deferrer = fileio.Deferrer(loop=self._loop)
         self._manifest_lock = asyncio.Lock(loop=self._loop)
         self._manifest_dirty = asyncio.Event(loop=self._loop)
         self._manifest_clean = asyncio.Event(loop=self._loop)
         self._write_time = write_time
+        self._ttl = ttl
+        self._on_expire = on_expire
+        self._deadline_changed = asyncio.Event(loop=self._loop)
+        self._watched_deadline = None
+        self._verify = verify
+        self._blobs = blobs
+        self.legacy_paths = set()
+        self.recovery = {}
         self.ready = asyncio.Event(loop=self._loop)
-        self._loop.create_task(self.start_manifest())
+        self._tasks = [self._loop.create_task(self.start_manifest())]
 
     def clean(self):
         self._manifest_dirty.clear()
@@ -41,33 +79,156 @@ class DurableBuffer:
         except Exception:
             pass
 
-        loaded_items = await self._read_manifest()
+        loaded_items = await self.recover()
 
         for item in loaded_items:
-            await self.q.put(item)
+            self._enqueue(item)
 
         self.ready.set()
-        self._loop.create_task(self.manifest_writer(self._write_time))
+        self._tasks.append(self._loop.create_task(self.manifest_writer(self._write_time)))
+        self._tasks.append(self._loop.create_task(self.expire_watcher()))
 
-    async def put(self, framed_message):
+    async def close(self):
+        """
+        Stops the manifest writer and expire watcher, then writes the manifest
+        if it changed since they last ran.
+        """
+        # Holding the lock waits out a write already running in the executor
+        async with self._manifest_lock:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            if self.ready.is_set() and self._manifest_dirty.is_set():
+                await fileio.write(self._manifest_path, json.dumps(list(self.q)), mode="w")
+                self.clean()
+
+    async def put(self, framed_message, priority=None):
         await self.ready.wait()
+        item = await self._store_message(framed_message, priority)
+        await self.put_ident(item)
+
+    async def _store_message(self, framed_message, priority):
+        """Writes a message to the store and returns the item describing it."""
         path = os.path.join(self._message_path, str(uuid.uuid4()))
-        item = {
-            "path": path,
-            "expire_time": datetime.datetime.utcnow() + datetime.timedelta(minutes=5),
-        }
+        if not isinstance(framed_message, FramedMessage):
+            item = self._item_for(path, None, None, priority)
+            if isinstance(framed_message, bytes):
+                await fileio.write(path, framed_message)
+            else:
+                await fileio.writelines(path, framed_message)
+            return item
 
-        if isinstance(framed_message, bytes):
-            await fileio.write(path, framed_message)
+        item = self._item_for(path, framed_message.header, framed_message.msg_id, priority)
+        payload = framed_message.payload
+        if self._blobs is not None and payload and len(payload) >= self._blobs.min_size:
+            # Only the frames are written per message, the payload is shared
+            item["blob"], item["payload"] = await self.deferrer.defer(
+                self._blobs.store, payload, path
+            )
+            await fileio.write(path, framed_message.serialize_header())
         else:
             await fileio.writelines(path, framed_message)
+        return item
 
-        await self.put_ident(item)
+    @staticmethod
+    def message_paths(item):
+        """Returns the files that make up a stored message, in wire order."""
+        if "payload" in item:
+            return [item["path"], item["payload"]]
+        return [item["path"]]
+
+    def release(self, item):
+        """
+        Removes a stored message once it has been sent or expired, dropping
+        its reference to a shared payload.  Does blocking file IO.
+        """
+        self._remove_path(item["path"])
+        if "payload" in item:
+            if self._blobs is not None:
+                self._blobs.release(item["payload"], item["blob"])
+            else:
+                self._remove_path(item["payload"])
 
     async def put_ident(self, ident):
-        await self.q.put(ident)
+        self._enqueue(ident)
         self.dirty()
 
+    def qsize(self):
+        return self.q.qsize()
+
+    async def hand_over(self, other):
+        """
+        Moves the messages queued here to other, another buffer of the same
+        manager, for when they have a new next hop.  Returns how many moved.
+        """
+        await other.ready.wait()
+        moved = 0
+        while self.qsize():
+            try:
+                item = await asyncio.wait_for(self.get(), 1.0)
+            except asyncio.TimeoutError:
+                break  # the rest expired, or were sent, meanwhile
+            await self.deferrer.defer(self._move, item, other)
+            await other.put_ident(item)
+            moved += 1
+        return moved
+
+    def _move(self, item, other):
+        # Shared payloads stay in the blob store
+        for key in ("path", "payload"):
+            path = item.get(key)
+            if path and os.path.dirname(path) == self._message_path:
+                item[key] = os.path.join(other._message_path, os.path.basename(path))
+                os.rename(path, item[key])
+
+    def deadline_for(self, header, queued_at=None):
+        """
+        Returns the deadline for a message, preferring the one set by its
+        sender over this buffer's default time to live.
+        """
+        if header and header.get("deadline") is not None:
+            return float(header["deadline"])
+        return (queued_at or time.time()) + self._ttl
+
+    def _item_for(self, path, header, msg_id, priority=None, queued_at=None):
+        if priority is None:
+            priority = classify(header) if header else Priority.BULK
+        item = {
+            "path": path,
+            "expire_time": self.deadline_for(header, queued_at),
+            "priority": Priority.from_label(priority).label,
+        }
+        if header and "recipient" in header:
+            item["recipient"] = header["recipient"]
+        if header and "in_response_to" in header:
+            # Keeps a request's responses on one connection to the next hop
+            item["flow"] = header["in_response_to"]
+        elif header and header.get("cmd") == "ROUTE2":
+            # and a node's route advertisements, so a stale one can't overtake
+            item["flow"] = header.get("origin")
+        if header and "directive" in header and "sender" in header:
+            # Enough to tell the sender about the message if it expires here
+            item["sender"] = header["sender"]
+            item["msg_id"] = msg_id
+            if "recipients" in header:
+                item["covers"] = header["recipients"]
+        return item
+
+    def _enqueue(self, item):
+        try:
+            deadline = deadline_of(item)
+        except (TypeError, KeyError):
+            deadline = None
+        self.q.put_nowait(item, deadline)
+        self._deadline_added(deadline)
+
+    def _deadline_added(self, deadline):
+        # Wake the expire watcher if this message expires before the one it is waiting on
+        if deadline is not None and (
+            self._watched_deadline is None or deadline < self._watched_deadline
+        ):
+            self._deadline_changed.set()
+
     async def get(self):
         await self.ready.wait()
         while True:
@@ -84,19 +245,146 @@ class DurableBuffer:
                 )
 
     async def _read_manifest(self):
+        """Returns the items in the manifest, or None if it is missing or unreadable."""
         try:
             data = await fileio.read(self._manifest_path, mode="r")
         except FileNotFoundError:
-            return []
-        else:
+            return None
+        try:
+            items = json.loads(data)
+        except JSONDecodeError:
+            logger.error("failed to decode manifest: %s", self._manifest_path)
+            return None
+        except Exception:
+            logger.exception("Unknown failure in decoding manifest: %s", self._manifest_path)
+            return None
+        if not isinstance(items, list):
+            logger.error("manifest %s is not a list of messages", self._manifest_path)
+            return None
+        return items
+
+    async def recover(self):
+        """
+        Rebuilds the queue from the manifest and the message store.
+
+        Manifest entries whose message file is gone are dropped. Message
+        files the manifest does not know about (all of them when the manifest
+        is missing or corrupt, or when the buffer was created with verify=True)
+        are checked in parallel; intact messages are queued again and anything
+        else is deleted.
+        """
+        start = time.monotonic()
+        manifest = None if self._verify else await self._read_manifest()
+        names = await self.deferrer.defer(os.listdir, self._message_path)
+        on_disk = {os.path.join(self._message_path, name) for name in names}
+
+        items = []
+        for item in manifest or []:
             try:
-                return json.loads(data)
-            except JSONDecodeError:
-                logger.error("failed to decode manifest: %s", data)
-            except Exception:
-                logger.exception("Unknown failure in decoding manifest: %s", data)
-            finally:
-                return []
+                path = item["path"]
+            except (TypeError, KeyError):
+                continue
+            if path in on_disk and item.get("payload", path) in on_disk:
+                items.append(item)
+            elif os.path.dirname(path) != self._message_path and os.path.exists(path):
+                # Written before messages were stored per buffer
+                self.legacy_paths.add(path)
+                items.append(item)
+
+        recovered, reclaimed = await self._recover_unknown(
+            on_disk, {path for item in items for path in self.message_paths(item)}
+        )
+        items.extend(recovered)
+
+        elapsed = time.monotonic() - start
+        buffer_recovery_seconds.observe(elapsed)
+        self.recovery = dict(
+            manifest="ok" if manifest is not None else "missing",
+            queued=len(items),
+            recovered=len(recovered),
+            reclaimed=reclaimed,
+            seconds=elapsed,
+        )
+        if recovered or reclaimed:
+            logger.info(
+                "Recovered %d and reclaimed %d message file(s) for %s in %.3fs",
+                len(recovered),
+                reclaimed,
+                self._manifest_path,
+                elapsed,
+            )
+        return items
+
+    async def _recover_unknown(self, on_disk, known):
+        """
+        Verifies the files in the message store that are not known to be
+        queued, in parallel batches on the file IO pool.  Returns the items
+        for intact messages, oldest first, and the number of files removed.
+        """
+        payloads = {}
+        for path in on_disk - known:
+            base, sep, digest = os.path.basename(path).partition(".")
+            if sep:
+                payloads[os.path.join(self._message_path, base)] = path
+        unknown = sorted(path for path in on_disk - known if path not in payloads.values())
+        batches = [
+            [(path, payloads.pop(path, None)) for path in unknown[i : i + VERIFY_BATCH]]
+            for i in range(0, len(unknown), VERIFY_BATCH)
+        ]
+        results = await asyncio.gather(
+            *(self.deferrer.defer(self._recover_batch, batch) for batch in batches)
+        )
+        recovered = sorted((item for batch in results for item in batch), key=deadline_of)
+        # Payload links left over belong to messages that were never fully written
+        for path in payloads.values():
+            logger.info("Reclaiming orphaned payload %s", path)
+            await self.deferrer.defer(self._remove_path, path)
+        reclaimed = sum(len(batch) for batch in batches) - len(recovered) + len(payloads)
+        return recovered, reclaimed
+
+    def _recover_batch(self, batch):
+        items = []
+        for path, payload_path in batch:
+            item = self._recover_item(path, payload_path)
+            if item is None:
+                logger.info("Reclaiming damaged or unknown message file %s", path)
+                self._remove_path(path)
+                if payload_path:
+                    self._remove_path(payload_path)
+            else:
+                items.append(item)
+        return items
+
+    def _recover_item(self, path, payload_path=None):
+        """
+        Returns a manifest item for a stored message, or None if the file
+        (and its payload link, if the payload is stored as a blob) is not a
+        complete framed message.
+        """
+        try:
+            with open(path, "rb") as fp:
+                stat = os.fstat(fp.fileno())
+                frame = Frame.deserialize(fp.read(Frame.fmt.size))
+                header = json.loads(fp.read(frame.length))
+                expected = Frame.fmt.size + frame.length
+                if frame.type == Frame.Types.HEADER:
+                    payload_frame = Frame.deserialize(fp.read(Frame.fmt.size))
+                    expected += Frame.fmt.size
+                    if payload_path is None:
+                        expected += payload_frame.length
+                    elif os.path.getsize(payload_path) != payload_frame.length:
+                        return None
+                elif frame.type != Frame.Types.COMMAND or payload_path is not None:
+                    return None
+        except (OSError, ValueError, struct.error):
+            return None
+        if stat.st_size != expected or not isinstance(header, dict):
+            return None
+        item = self._item_for(path, header, frame.msg_id, queued_at=stat.st_mtime)
+        if payload_path is not None:
+            item["payload"] = payload_path
+            item["blob"] = os.path.basename(payload_path).partition(".")[2]
+        return item
 
     def _remove_path(self, path):
         if os.path.exists(path):
@@ -105,31 +393,45 @@ class DurableBuffer:
             logger.info("Can't remove {}, doesn't exist".format(path))
 
     def is_expired(self, item):
-        return item["expire_time"] < datetime.datetime.utcnow()
+        return deadline_of(item) <= time.time()
 
     async def expire(self, item):
-        # TODO: we should do something more than just log expirations
-        # Consider sending a message to the sender
         logger.info("Expiring message %s", item["path"])
-        await self._deferrer.defer(self._remove_path, item["path"])
+        await self.deferrer.defer(self.release, item)
+        if self._on_expire is not None:
+            try:
+                await self._on_expire(item)
+            except Exception:
+                logger.exception("Failed to handle expiry of %s", item["path"])
 
     async def expire_all(self):
         async with self._manifest_lock:
-            old, self.q = self.q, asyncio.Queue(loop=self._loop)
-            while old.qsize() > 0:
-                item = await old.get()
-                if self.is_expired(item):
-                    await self.expire(item)
-                else:
-                    await self.q.put(item)
-            self.dirty()
+            expired = self.q.pop_expired(time.time())
+            for item in expired:
+                await self.expire(item)
+            if expired:
+                self.dirty()
+
+    async def next_deadline(self):
+        return self.q.next_deadline()
+
+    async def expire_watcher(self):
+        """Expires messages as their deadlines pass."""
+        while True:
+            self._deadline_changed.clear()
+            next_deadline = self._watched_deadline = await self.next_deadline()
+            timeout = None if next_deadline is None else max(0.0, next_deadline - time.time())
+            try:
+                await asyncio.wait_for(self._deadline_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                await self.expire_all()
 
     async def manifest_writer(self, write_time):
         while True:
             await self._manifest_dirty.wait()
             async with self._manifest_lock:
                 try:
-                    data = json.dumps(list(self.q._queue))
+                    data = json.dumps(list(self.q))
                     await fileio.write(self._manifest_path, data, mode="w")
                     self.clean()
                 except Exception:
@@ -138,10 +440,75 @@ class DurableBuffer:
 
 
 class FileBufferManager(defaultdict):
-    def __init__(self, path, loop=asyncio.get_event_loop()):
+    def __init__(
+        self, path, loop=asyncio.get_event_loop(), ttl=DEFAULT_TTL, on_expire=None, verify=False
+    ):
         self.path = path
         self.loop = loop
+        self.ttl = ttl
+        self.on_expire = on_expire
+        self.verify = verify
+        self.blobs = BlobStore(os.path.join(path, "blobs"))
 
     def __missing__(self, key):
-        self[key] = DurableBuffer(self.path, key, self.loop)
+        self[key] = DurableBuffer(
+            self.path,
+            key,
+            self.loop,
+            ttl=self.ttl,
+            on_expire=self.on_expire,
+            verify=self.verify,
+            blobs=self.blobs,
+        )
         return self[key]
+
+    async def recover(self):
+        """
+        Loads every buffer that has messages on disk, then reclaims message
+        files from older versions that no buffer's manifest refers to.
+        """
+        message_path = os.path.join(self.path, "messages")
+        try:
+            names = os.listdir(message_path)
+        except FileNotFoundError:
+            names = []
+        keys = {name for name in names if os.path.isdir(os.path.join(message_path, name))}
+        manifests = [name for name in os.listdir(self.path) if name.startswith("manifest-")]
+        keys.update(name[len("manifest-") :] for name in manifests)
+        buffers = [self[key] for key in keys]
+        await asyncio.gather(*(buffer.ready.wait() for buffer in buffers))
+
+        referenced = set()
+        for buffer in buffers:
+            referenced.update(buffer.legacy_paths)
+        orphans = [
+            os.path.join(message_path, name)
+            for name in names
+            if name not in keys and os.path.join(message_path, name) not in referenced
+        ]
+        for path in orphans:
+            logger.info("Reclaiming orphaned message file %s", path)
+            try:
+                os.remove(path)
+            except OSError:
+                logger.exception("Failed to reclaim %s", path)
+        await self.loop.run_in_executor(fileio.pool, self.blobs.collect)
+        return {key: self[key].recovery for key in keys}
+
+    async def queued_for(self, recipient):
+        """Returns the number of messages queued for a final recipient."""
+        count = sum(
+            1
+            for buffer in self.values()
+            for item in buffer.q
+            if isinstance(item, dict) and item.get("recipient") == recipient
+        )
+        return dict(messages=count)
+
+    async def summary(self):
+        """Returns the number of queued messages per next hop and priority."""
+        return {key: buffer.q.lane_sizes() for key, buffer in self.items()}
+
+    async def close(self):
+        """Stops every buffer's background tasks and writes their manifests."""
+        await asyncio.gather(*(buffer.close() for buffer in self.values()))
@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import heapq
+import itertools
+
+from ..messages.priority import Priority
+
+DEFAULT_WEIGHTS = {Priority.CONTROL: 8, Priority.INTERACTIVE: 4, Priority.BULK: 1}
+
+
+class WeightedRoundRobin:
+    """
+    Chooses which Priority lane to serve next.  While several lanes have
+    items, each may be chosen up to its weight in times per round.
+    """
+
+    def __init__(self, weights=None):
+        self._weights = dict(DEFAULT_WEIGHTS)
+        if weights:
+            self._weights.update({Priority.from_label(p): w for p, w in weights.items()})
+        self._credits = dict(self._weights)
+
+    def select(self, has_items):
+        """
+        Returns the next Priority to serve, given a callable reporting
+        whether a lane has items.  Raises asyncio.QueueEmpty if none do.
+        """
+        for _ in range(2):
+            for priority in Priority:
+                if self._credits[priority] > 0 and has_items(priority):
+                    self._credits[priority] -= 1
+                    return priority
+            self._credits = dict(self._weights)
+        raise asyncio.QueueEmpty
+
+
+class LaneQueue:
+    """
+    An asyncio queue made up of one FIFO lane per message Priority.
+
+    Lanes are drained by weighted round robin: while several lanes hold
+    items, each lane may hand out up to its weight in items per round, so
+    control traffic waits behind at most one bulk item and bulk traffic is
+    never starved outright.
+
+    Items are manifest dicts; their lane is taken from item["priority"] and
+    items without a usable priority are treated as bulk.
+
+    Items put with a deadline are also indexed in a heap so that expired
+    items can be found and removed without walking the whole queue.
+    """
+
+    def __init__(self, weights=None, loop=None):
+        self._scheduler = WeightedRoundRobin(weights)
+        self._lanes = {p: collections.OrderedDict() for p in Priority}
+        self._counter = itertools.count()
+        self._deadlines = []
+        self._not_empty = asyncio.Event(loop=loop)
+
+    @staticmethod
+    def lane_for(item):
+        try:
+            return Priority.from_label(item["priority"])
+        except (TypeError, KeyError):
+            return Priority.BULK
+
+    def put_nowait(self, item, deadline=None):
+        key = next(self._counter)
+        lane = self.lane_for(item)
+        self._lanes[lane][key] = item
+        if deadline is not None:
+            heapq.heappush(self._deadlines, (deadline, key, lane))
+            self._maybe_compact()
+        self._not_empty.set()
+
+    async def put(self, item, deadline=None):
+        self.put_nowait(item, deadline)
+
+    def get_nowait(self):
+        lane = self._scheduler.select(lambda p: bool(self._lanes[p]))
+        _, item = self._lanes[lane].popitem(last=False)
+        return item
+
+    async def get(self):
+        while True:
+            try:
+                return self.get_nowait()
+            except asyncio.QueueEmpty:
+                self._not_empty.clear()
+                await self._not_empty.wait()
+
+    def next_deadline(self):
+        """Returns the earliest deadline still indexed, or None."""
+        while self._deadlines:
+            deadline, key, lane = self._deadlines[0]
+            if key in self._lanes[lane]:
+                return deadline
+            heapq.heappop(self._deadlines)
+        return None
+
+    def pop_expired(self, now):
+        """
+        Removes and returns the queued items whose deadline is at or before
+        now.  Costs O(expired log n) rather than a pass over the queue.
+        """
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, key, lane = heapq.heappop(self._deadlines)
+            item = self._lanes[lane].pop(key, None)
+            if item is not None:
+                expired.append(item)
+        return expired
+
+    def _maybe_compact(self):
+        # Entries for items already handed out by get() are left in the heap
+        # and skipped lazily; rebuild it once they dominate.
+        if len(self._deadlines) > 2 * self.qsize() + 64:
+            live = [entry for entry in self._deadlines if entry[1] in self._lanes[entry[2]]]
+            heapq.heapify(live)
+            self._deadlines = live
+
+    def drain(self):
+        """Removes and returns every queued item, highest priority lane first."""
+        items = list(self)
+        for lane in self._lanes.values():
+            lane.clear()
+        self._deadlines = []
+        return items
+
+    def qsize(self):
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def empty(self):
+        return not any(self._lanes.values())
+
+    def lane_sizes(self):
+        return {priority.label: len(lane) for priority, lane in self._lanes.items()}
+
+    def __iter__(self):
+        for lane in self._lanes.values():
+            yield from lane.values()
+
+    def __len__(self):
+        return self.qsize()
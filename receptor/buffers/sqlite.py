@@ -0,0 +1,394 @@
+"""
+An outbound buffer backend that keeps its index in SQLite instead of a
+manifest file per buffer.
+
+Message files are still written to disk exactly as DurableBuffer writes them,
+so the connection workers are unchanged; the database records which messages
+are queued for each next hop along with their priority, deadline and final
+recipient.  That makes expiry an indexed range query and lets diagnostics ask
+how much is queued for a node without walking every buffer.
+
+All queries run on one dedicated thread.  Jobs that arrive while a
+transaction is in progress are batched into the next one, so a burst of puts
+costs one commit rather than one per message.
+"""
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from .. import fileio
+from .. import serde as json
+from ..exceptions import ReceptorBufferError
+from ..messages.priority import Priority
+from ..stats import buffer_recovery_seconds
+from .blobs import BlobStore
+from .file import DEFAULT_TTL, DurableBuffer, deadline_of
+from .lanes import LaneQueue, WeightedRoundRobin
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    deadline REAL NOT NULL,
+    path TEXT NOT NULL,
+    recipient TEXT,
+    size INTEGER,
+    item TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_lane ON messages (key, priority, id);
+CREATE INDEX IF NOT EXISTS messages_deadline ON messages (key, deadline);
+CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient);
+"""
+
+
+def _insert(conn, key, item):
+    try:
+        size = os.path.getsize(item["path"])
+    except OSError:
+        size = None
+    conn.execute(
+        "INSERT INTO messages (key, priority, deadline, path, recipient, size, item) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            key,
+            int(LaneQueue.lane_for(item)),
+            deadline_of(item),
+            item["path"],
+            item.get("recipient"),
+            size,
+            json.dumps(item),
+        ),
+    )
+
+
+def _pop(conn, key, priority):
+    row = conn.execute(
+        "SELECT id, item FROM messages WHERE key = ? AND priority = ? ORDER BY id LIMIT 1",
+        (key, int(priority)),
+    ).fetchone()
+    if row is None:
+        return None
+    conn.execute("DELETE FROM messages WHERE id = ?", (row[0],))
+    return json.loads(row[1])
+
+
+def _pop_expired(conn, key, now):
+    rows = conn.execute(
+        "SELECT id, item FROM messages WHERE key = ? AND deadline <= ? ORDER BY deadline",
+        (key, now),
+    ).fetchall()
+    conn.executemany("DELETE FROM messages WHERE id = ?", [(row[0],) for row in rows])
+    return [json.loads(row[1]) for row in rows]
+
+
+def _next_deadline(conn, key):
+    return conn.execute("SELECT MIN(deadline) FROM messages WHERE key = ?", (key,)).fetchone()[0]
+
+
+def _lane_counts(conn, key):
+    counts = {priority: 0 for priority in Priority}
+    for priority, count in conn.execute(
+        "SELECT priority, COUNT(*) FROM messages WHERE key = ? GROUP BY priority", (key,)
+    ):
+        counts[Priority(priority)] = count
+    return counts
+
+
+def _paths(conn, key):
+    return {
+        path: (rowid, json.loads(item).get("payload"))
+        for rowid, path, item in conn.execute(
+            "SELECT id, path, item FROM messages WHERE key = ?", (key,)
+        )
+    }
+
+
+def _repair(conn, key, missing, recovered):
+    conn.executemany("DELETE FROM messages WHERE id = ?", [(rowid,) for rowid in missing])
+    for item in recovered:
+        _insert(conn, key, item)
+
+
+def _keys(conn):
+    return [row[0] for row in conn.execute("SELECT DISTINCT key FROM messages")]
+
+
+def _queued_for(conn, recipient):
+    count, size = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM messages WHERE recipient = ?", (recipient,)
+    ).fetchone()
+    return dict(messages=count, bytes=size)
+
+
+def _summary(conn):
+    summary = defaultdict(lambda: {priority.label: 0 for priority in Priority})
+    for key, priority, count in conn.execute(
+        "SELECT key, priority, COUNT(*) FROM messages GROUP BY key, priority"
+    ):
+        summary[key][Priority(priority).label] = count
+    return dict(summary)
+
+
+class SQLiteStore:
+    """Owns the database connection and the thread every query runs on."""
+
+    def __init__(self, path, loop, batch_size=512):
+        self.path = path
+        self.loop = loop
+        self.batch_size = batch_size
+        self._jobs = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="receptor-sqlite", daemon=True)
+        self._thread.start()
+
+    async def run(self, func, *args):
+        """Runs func(connection, *args) on the database thread and returns its result."""
+        if self._closed:
+            raise ReceptorBufferError(f"{self.path} is closed")
+        future = self.loop.create_future()
+        self._jobs.put((func, args, future))
+        return await future
+
+    def close(self, timeout=10.0):
+        """Commits the queries already queued, then closes the database."""
+        if self._closed:
+            return
+        self._closed = True
+        self._jobs.put(None)
+        self._thread.join(timeout)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            jobs = [self._jobs.get()]
+            while len(jobs) < self.batch_size:
+                try:
+                    jobs.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in jobs
+            jobs = [job for job in jobs if job is not None]
+            results = []
+            conn.execute("BEGIN IMMEDIATE")
+            for func, args, future in jobs:
+                # A savepoint per job keeps one failed query from undoing the batch
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((future, func(conn, *args), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    results.append((future, None, e))
+                conn.execute("RELEASE job")
+            try:
+                conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                logger.exception("Failed to commit buffer changes to %s", self.path)
+                conn.execute("ROLLBACK")
+                results = [(future, None, e) for future, _, _ in results]
+            for future, result, exc in results:
+                self.loop.call_soon_threadsafe(self._resolve, future, result, exc)
+            if closing:
+                conn.close()
+                return
+
+    @staticmethod
+    def _resolve(future, result, exc):
+        if future.cancelled():
+            return
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+
+class SQLiteBuffer(DurableBuffer):
+    """
+    A DurableBuffer whose queue lives in a SQLite table shared by every
+    buffer of the node.  Dequeueing a message and deleting its row happen in
+    one transaction, so there is no separate manifest to keep in sync.
+    """
+
+    def __init__(
+        self, dir_, key, loop, store, ttl=DEFAULT_TTL, on_expire=None, weights=None, blobs=None,
+    ):
+        # Only the message store is shared with DurableBuffer: the queue and
+        # manifest state are replaced by the database
+        self.key = key
+        self.store = store
+        self._message_path = os.path.join(os.path.expanduser(dir_), "messages", key)
+        self._loop = loop
+        self.deferrer = fileio.Deferrer(loop=loop)
+        self._ttl = ttl
+        self._on_expire = on_expire
+        self._blobs = blobs
+        self._counts = {priority: 0 for priority in Priority}
+        self._scheduler = WeightedRoundRobin(weights)
+        self._available = asyncio.Event(loop=loop)
+        self._expiry_lock = asyncio.Lock(loop=loop)
+        self._deadline_changed = asyncio.Event(loop=loop)
+        self._watched_deadline = None
+        self.recovery = {}
+        self.ready = asyncio.Event(loop=loop)
+        self._tasks = [loop.create_task(self.start_manifest())]
+
+    async def start_manifest(self):
+        try:
+            os.makedirs(self._message_path, mode=0o700)
+        except Exception:
+            pass
+        await self.recover()
+        self._counts = await self.store.run(_lane_counts, self.key)
+        if any(self._counts.values()):
+            self._available.set()
+        self.ready.set()
+        self._tasks.append(self._loop.create_task(self.expire_watcher()))
+
+    async def close(self):
+        """Stops the expire watcher; the rows are already committed."""
+        async with self._expiry_lock:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def recover(self):
+        """
+        Drops rows whose message file is gone and queues intact message files
+        that have no row, deleting anything else found in the message store.
+        """
+        start = time.monotonic()
+        rows = await self.store.run(_paths, self.key)
+        names = await self.deferrer.defer(os.listdir, self._message_path)
+        on_disk = {os.path.join(self._message_path, name) for name in names}
+        missing = [
+            rowid
+            for path, (rowid, payload) in rows.items()
+            if path not in on_disk or payload not in (None, *on_disk)
+        ]
+        known = set(rows).union(payload for _, payload in rows.values() if payload)
+        recovered, reclaimed = await self._recover_unknown(on_disk, known)
+        if missing or recovered:
+            await self.store.run(_repair, self.key, missing, recovered)
+
+        elapsed = time.monotonic() - start
+        buffer_recovery_seconds.observe(elapsed)
+        self.recovery = dict(
+            manifest="sqlite",
+            queued=len(rows) - len(missing) + len(recovered),
+            recovered=len(recovered),
+            reclaimed=reclaimed,
+            seconds=elapsed,
+        )
+        return []
+
+    async def put_ident(self, ident):
+        await self.store.run(_insert, self.key, ident)
+        self._counts[LaneQueue.lane_for(ident)] += 1
+        self._available.set()
+        self._deadline_added(deadline_of(ident))
+
+    async def get(self):
+        await self.ready.wait()
+        while True:
+            try:
+                priority = self._scheduler.select(lambda p: self._counts[p] > 0)
+            except asyncio.QueueEmpty:
+                self._available.clear()
+                await self._available.wait()
+                continue
+            # Claim the row before yielding to the database thread so that
+            # concurrent readers do not race for the same message
+            self._counts[priority] -= 1
+            pop = asyncio.ensure_future(self.store.run(_pop, self.key, priority))
+            try:
+                item = await asyncio.shield(pop)
+            except asyncio.CancelledError:
+                # The row is deleted whether or not anyone is left to take it
+                self._loop.create_task(self._put_back(pop))
+                raise
+            if item is None:
+                self._counts = await self.store.run(_lane_counts, self.key)
+                continue
+            if self.is_expired(item):
+                await self.expire(item)
+                continue
+            return item
+
+    async def _put_back(self, pop):
+        """Queues the item popped for a cancelled get() again."""
+        try:
+            item = await pop
+            if item is not None:
+                await self.put_ident(item)
+        except ReceptorBufferError:
+            pass  # closed: recover() finds the message file on the next start
+
+    async def next_deadline(self):
+        return await self.store.run(_next_deadline, self.key)
+
+    async def expire_all(self):
+        async with self._expiry_lock:
+            for item in await self.store.run(_pop_expired, self.key, time.time()):
+                lane = LaneQueue.lane_for(item)
+                self._counts[lane] = max(0, self._counts[lane] - 1)
+                await self.expire(item)
+
+    def qsize(self):
+        return sum(self._counts.values())
+
+
+class SQLiteBufferManager(defaultdict):
+    def __init__(self, path, loop=asyncio.get_event_loop(), ttl=DEFAULT_TTL, on_expire=None):
+        self.path = path
+        self.loop = loop
+        self.ttl = ttl
+        self.on_expire = on_expire
+        self.store = SQLiteStore(os.path.join(path, "buffers.db"), loop)
+        self.blobs = BlobStore(os.path.join(path, "blobs"))
+
+    def __missing__(self, key):
+        self[key] = SQLiteBuffer(
+            self.path,
+            key,
+            self.loop,
+            self.store,
+            ttl=self.ttl,
+            on_expire=self.on_expire,
+            blobs=self.blobs,
+        )
+        return self[key]
+
+    async def recover(self):
+        """Loads every buffer that has messages queued in the database."""
+        keys = await self.store.run(_keys)
+        buffers = [self[key] for key in keys]
+        await asyncio.gather(*(buffer.ready.wait() for buffer in buffers))
+        await self.loop.run_in_executor(fileio.pool, self.blobs.collect)
+        return {key: self[key].recovery for key in keys}
+
+    async def queued_for(self, recipient):
+        """Returns the number of messages and bytes queued for a final recipient."""
+        return await self.store.run(_queued_for, recipient)
+
+    async def summary(self):
+        """Returns the number of queued messages per next hop and priority."""
+        return await self.store.run(_summary)
+
+    async def close(self):
+        """Stops every buffer's background tasks, then closes the database."""
+        await asyncio.gather(*(buffer.close() for buffer in self.values()))
+        self.store.close()
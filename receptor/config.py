@@ -3,7 +3,9 @@ import configparser
 import logging
 import os
 import ssl
+import sys
 
+from .connection.tls import ResumingSSLContext
 from .entrypoints import run_as_node, run_as_ping, run_as_send, run_as_status
 from .exceptions import ReceptorRuntimeError, ReceptorConfigError
 
@@ -22,6 +24,16 @@ SUBCOMMAND_EXTRAS = {
 }
 
 
+def _file_stamp(path):
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
 class ConfigOption:
     def __init__(self, value, value_type, listof=None):
         self.value = value
@@ -54,6 +66,7 @@ class ReceptorConfig:
         self._parsed_args = None
         self._config_file = configparser.ConfigParser(allow_no_value=True, delimiters=("=",))
         self._is_ephemeral = False
+        self._ssl_contexts = {}
 
         # Default options, which apply to all sub-commands.
         self.add_config_option(
@@ -97,6 +110,74 @@ class ReceptorConfig:
             hint=f"""Size of the thread pool for worker threads. If unspecified,
                      defaults to {default_max_workers}""",
         )
+        self.add_config_option(
+            section="default",
+            key="max_async_work",
+            default_value=256,
+            value_type="int",
+            hint="""Number of coroutine and async generator plugin actions that may run on the
+                    event loop at once, apart from the worker threads. The default is 256.""",
+        )
+        self.add_config_option(
+            section="default",
+            key="message_ttl",
+            default_value=300,
+            value_type="int",
+            hint="""Seconds a message may wait in an outbound buffer before it expires, unless
+                    its sender set a deadline. The default is 300.""",
+        )
+        self.add_config_option(
+            section="default",
+            key="response_timeout",
+            default_value=3600,
+            value_type="float",
+            hint="""Seconds to wait for the next response to a request before giving up on it.
+                    Its response stream then raises a timeout. The default is 3600.""",
+        )
+        self.add_config_option(
+            section="default",
+            key="send_window",
+            default_value=1024,
+            value_type="int",
+            hint="""Most requests a controller may have waiting for responses at once.
+                    Controller.send waits for one to finish before sending another.
+                    0 means no limit. The default is 1024.""",
+        )
+        self.add_config_option(
+            section="default",
+            key="send_window_per_recipient",
+            default_value=256,
+            value_type="int",
+            hint="""Most requests a controller may have waiting for responses from one node.
+                    0 means no limit. The default is 256.""",
+        )
+        self.add_config_option(
+            section="default",
+            key="buffer_backend",
+            default_value="file",
+            value_type="str",
+            hint="""Where outbound buffers keep track of queued messages. Options are "file",
+                    a manifest file per connection, and "sqlite", a SQLite database that can
+                    also be queried for diagnostics. The default is "file".""",
+        )
+        self.add_config_option(
+            section="default",
+            key="verify_buffers",
+            default_value=None,
+            set_value=True,
+            value_type="bool",
+            hint="""Rebuild outbound buffers at startup by checking every stored message
+                    instead of trusting the buffer manifests.""",
+        )
+        self.add_config_option(
+            section="default",
+            key="ingress_limit",
+            default_value=2 ** 26,
+            value_type="int",
+            hint="""Bytes of received messages a connection may hold before they are handled.
+                    Reading from the connection pauses while it is over the limit. Set to 0 for
+                    no limit. The default is 64MiB.""",
+        )
         self.add_config_option(
             section="default",
             key="logging_format",
@@ -188,7 +269,70 @@ class ReceptorConfig:
             default_value=[],
             value_type="list",
             listof="str",
-            hint="Set/override peer nodes to connect to. Use multiple times for multiple peers.",
+            hint="""Set/override peer nodes to connect to. Use multiple times for multiple peers.
+                    Equivalent endpoints for one peer, such as a hub and its standby, can be
+                    joined with "|".""",
+        )
+        self.add_config_option(
+            section="node",
+            key="dns_ttl",
+            default_value=30,
+            value_type="float",
+            hint="""Seconds to reuse the addresses looked up for a peer's host name. A failed
+                    connection always looks the name up again. The default is 30.""",
+        )
+        self.add_config_option(
+            section="node",
+            key="peer_streams",
+            default_value=1,
+            value_type="int",
+            hint="""Number of connections to open to each peer. Messages queued for a peer are
+                    sent on whichever of its connections is free, which helps on links where a
+                    single connection is limited by latency. The default is 1.""",
+        )
+        self.add_config_option(
+            section="node",
+            key="dispatch_concurrency",
+            default_value=256,
+            value_type="int",
+            hint="""Most received messages to handle at once, apart from running work. Messages
+                    beyond that wait in turn, with each sender and directive pair getting an
+                    equal share, and no pair may hold more than half. The default is 256.""",
+        )
+        self.add_config_option(
+            section="node",
+            key="gather_delay",
+            default_value=0.05,
+            value_type="float",
+            hint="""Seconds to hold responses to a gathered multicast passing through this node
+                    so they can be sent on together. The default is 0.05.""",
+        )
+        self.add_config_option(
+            section="node",
+            key="gather_bytes",
+            default_value=2 ** 20,
+            value_type="int",
+            hint="""Bytes of held responses to a gathered multicast that are sent on at once,
+                    without waiting for gather_delay. The default is 1048576.""",
+        )
+        self.add_config_option(
+            section="node",
+            key="shards",
+            default_value=1,
+            value_type="int",
+            hint="""Number of processes to run the node in. The first keeps the node ID and the
+                    others join the mesh as <node ID>-shard<n>. They share the listening
+                    ports and the configured peers, and reach each other over unix sockets in
+                    the data directory. Stats are served on stats_port plus the shard number.
+                    The default is 1.""",
+        )
+        self.add_config_option(
+            section="node",
+            key="shard",
+            default_value=0,
+            value_type="int",
+            hint="""Which shard this process is. Set by the first shard when it starts the
+                    others.""",
         )
         self.add_config_option(
             section="node",
@@ -222,6 +366,23 @@ class ReceptorConfig:
             hint="""If specified, the node will ping all other known nodes in the mesh
                     every N seconds. The default is -1, meaning no pings are sent.""",
         )
+        self.add_config_option(
+            section="node",
+            key="heartbeat_interval",
+            default_value=10,
+            value_type="int",
+            hint="""Seconds between heartbeats on rnp/rnps connections, which let both ends
+                    notice a peer that has silently gone away. Set to 0 to disable. The
+                    default is 10.""",
+        )
+        self.add_config_option(
+            section="node",
+            key="heartbeat_misses",
+            default_value=3,
+            value_type="int",
+            hint="""Number of heartbeat intervals a connection may stay silent before it is
+                    closed and routed around. The default is 3.""",
+        )
         self.add_config_option(
             section="node",
             key="groups",
@@ -232,6 +393,32 @@ class ReceptorConfig:
             listof="str",
             hint="Define membership in one or more groups to aid in message routing",
         )
+        self.add_config_option(
+            section="node",
+            key="load_interval",
+            default_value=1.0,
+            value_type="float",
+            hint="""Least number of seconds between advertisements of this node's load, which
+                    senders use to choose between the members of a group. The default is 1.""",
+        )
+        self.add_config_option(
+            section="node",
+            key="work_stealing",
+            long_option="--work-stealing",
+            default_value=False,
+            set_value=True,
+            value_type="bool",
+            hint="""Let idle members of this node's groups take over work waiting for a thread
+                    here, and take over theirs when idle. Both nodes need it enabled.""",
+        )
+        self.add_config_option(
+            section="node",
+            key="steal_interval",
+            default_value=1.0,
+            value_type="float",
+            hint="""Least number of seconds between requests for work from other members of
+                    this node's groups when work stealing is enabled. The default is 1.""",
+        )
         self.add_config_option(
             section="node",
             key="ws_extra_headers",
@@ -248,6 +435,33 @@ class ReceptorConfig:
             value_type="int",
             hint="Set heartbeat interval for websocket connections.",
         )
+        self.add_config_option(
+            section="node",
+            key="ws_compress",
+            default_value=None,
+            set_value=True,
+            value_type="bool",
+            hint="""Compress websocket messages with permessage-deflate when the other end
+                    supports it.""",
+        )
+        self.add_config_option(
+            section="node",
+            key="ws_max_message",
+            default_value=2 ** 20,
+            value_type="int",
+            hint="""Largest websocket message to send or accept, in bytes. Data is sent in
+                    messages of the largest power of two up to this size that both ends
+                    accept. The default is 1MiB.""",
+        )
+        self.add_config_option(
+            section="node",
+            key="unix_socket_mode",
+            default_value="600",
+            value_type="str",
+            hint="""Octal file mode for rnpu:// unix socket listeners. Only users allowed to
+                    write to the socket can connect, so use 660 to admit a group. The
+                    default is 600.""",
+        )
         # ping options
         self.add_config_option(
             section="ping",
@@ -469,6 +683,8 @@ class ReceptorConfig:
         return value
 
     def parse_options(self, args):
+        # kept so that a node can start its other shards with the same options
+        self._args = sys.argv[1:] if args is None else list(args)
         # first we parse the cli args
         self._parsed_args = self._cli_args.parse_args(args)
         # we manually force the config entry to be parsed first, since
@@ -570,12 +786,28 @@ class ReceptorConfig:
         self._parsed_args.func(self)
 
     def get_ssl_context(self, context_type):
+        """
+        Returns the SSL context of the given type, building it again only
+        when one of the certificate, key or CA files it was built from has
+        changed since.
+        """
         if context_type == "server":
-            return self.get_server_ssl_context()
+            build = self.get_server_ssl_context
+            files = (
+                self.auth_server_cert,
+                self.auth_server_key,
+                self.auth_client_verification_ca,
+            )
         elif context_type == "client":
-            return self.get_client_ssl_context()
+            build = self.get_client_ssl_context
+            files = (self.auth_client_cert, self.auth_client_key, self.auth_server_ca_bundle)
         else:
             raise ReceptorRuntimeError(f"Unknown SSL context type {context_type}")
+        stamp = tuple(_file_stamp(path) for path in files)
+        cached = self._ssl_contexts.get(context_type)
+        if cached is None or cached[0] != stamp:
+            cached = self._ssl_contexts[context_type] = (stamp, build())
+        return cached[1]
 
     def get_client_ssl_context(self):
         logger.debug("Loading TLS Client Context")
@@ -583,7 +815,7 @@ class ReceptorConfig:
         ca_bundle = (
             ca_bundle if ca_bundle else None
         )  # Make false-like values like '' explicitly None
-        sc = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        sc = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
         sc.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
         if self.auth_client_cipher_list:
             sc.set_ciphers(self.auth_client_cipher_list)
@@ -1,16 +1,38 @@
 import asyncio
+import collections
 import logging
-import os
+import time
 from abc import abstractmethod, abstractproperty
 from collections.abc import AsyncIterator
 
 from .. import fileio
 from ..bridgequeue import BridgeQueue
-from ..messages.framed import FramedBuffer
-from ..stats import bytes_recv
+from ..messages.framed import FramedBuffer, FramedMessage
+from ..stats import (
+    bytes_recv,
+    ingress_pauses_counter,
+    stream_bytes_recv,
+    stream_bytes_sent,
+    stream_messages_sent,
+)
 
 logger = logging.getLogger(__name__)
 
+HANDSHAKE_VERSION = 2
+# Link features this node can use; a link uses those both ends list in their HI
+LINK_FEATURES = frozenset({"heartbeat", "load", "multicast"})
+
+
+def negotiate_features(hi):
+    """
+    Returns the link features shared with the peer that sent the HI header
+    hi.  Peers from before handshake version 2 list no features, and the
+    only one they may have is heartbeats.
+    """
+    if "version" not in hi:
+        return LINK_FEATURES & ({"heartbeat"} if hi.get("heartbeat") else set())
+    return LINK_FEATURES.intersection(hi.get("features", ()))
+
 
 def log_ssl_detail(transport):
     peername = transport.get_extra_info("peername")
@@ -25,6 +47,46 @@ def log_ssl_detail(transport):
         logger.debug(f"Unencrypted connection with {str(peername)}.")
 
 
+class StreamStats:
+    """
+    Traffic counts for one connection.  Once the peer is known they are also
+    added to the per-peer prometheus counters, which sum over all of the
+    connections to that peer.
+    """
+
+    def __init__(self):
+        self.peer = None
+        self.started = time.monotonic()
+        self.bytes_sent = 0
+        self.bytes_recv = 0
+        self.messages_sent = 0
+
+    def sent(self, size):
+        self.bytes_sent += size
+        if self.peer is not None:
+            stream_bytes_sent.labels(self.peer).inc(size)
+
+    def received(self, size):
+        self.bytes_recv += size
+        if self.peer is not None:
+            stream_bytes_recv.labels(self.peer).inc(size)
+
+    def message_sent(self):
+        self.messages_sent += 1
+        if self.peer is not None:
+            stream_messages_sent.labels(self.peer).inc()
+
+    def snapshot(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return {
+            "bytes_sent": self.bytes_sent,
+            "bytes_recv": self.bytes_recv,
+            "messages_sent": self.messages_sent,
+            "send_rate": self.bytes_sent / elapsed,
+            "recv_rate": self.bytes_recv / elapsed,
+        }
+
+
 class Transport(AsyncIterator):
     @abstractmethod
     async def close(self):
@@ -38,18 +100,119 @@ class Transport(AsyncIterator):
     def send(self, q):
         pass
 
+    # Whether the transport needs heartbeats to notice a dead link
+    heartbeat = False
+
+    # How much of a message file to hand to send() at a time
+    read_size = 2 ** 12
+
+    # Link features negotiated in the handshake, see negotiate_features
+    features = frozenset()
+
+    def configure_liveness(self, interval, misses):
+        """Applies transport level timeouts matching the heartbeat settings."""
+
+    def pause_reading(self):
+        """Stops the transport reading from the network until resume_reading()."""
+
+    def resume_reading(self):
+        pass
+
+
+class Stripes:
+    """
+    Shares the messages queued for a peer between the connections open to
+    it.  A message goes out on whichever connection asks for one first,
+    except that the responses to one request are pinned, by a hash of the
+    request's id, to one connection, so that they arrive in the order they
+    were queued and the eof comes last.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.stripes = []
+
+    def join(self):
+        stripe = Stripe(self)
+        self.stripes.append(stripe)
+        return stripe
+
+    def owner(self, item):
+        flow = item.get("flow")
+        if flow is None or not self.stripes:
+            return None
+        return self.stripes[hash(flow) % len(self.stripes)]
+
+    def hand_over(self, item, taker):
+        """Returns True if item is for taker, else passes it to its connection."""
+        owner = self.owner(item)
+        if owner is None or owner is taker:
+            return True
+        owner.items.append(item)
+        owner.ready.set()
+        return False
+
+
+class Stripe:
+    """One connection's share of a peer's outbound buffer, see Stripes."""
+
+    def __init__(self, stripes):
+        self.stripes = stripes
+        self.items = collections.deque()
+        self.ready = asyncio.Event()
+        self.left = False
+
+    async def get(self):
+        while not self.items:
+            self.ready.clear()
+            pull = asyncio.ensure_future(self.stripes.buffer.get())
+            woken = asyncio.ensure_future(self.ready.wait())
+            try:
+                await asyncio.wait([pull, woken], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                woken.cancel()
+                if not pull.done():
+                    pull.cancel()
+                elif not pull.cancelled() and pull.exception() is None:
+                    self._take(pull.result())
+            if pull.done() and not pull.cancelled() and pull.exception() is not None:
+                raise pull.exception()
+        return self.items.popleft()
+
+    def _take(self, item):
+        if self.left:
+            asyncio.ensure_future(self.stripes.buffer.put_ident(item))
+        elif self.stripes.hand_over(item, self):
+            self.items.append(item)
+
+    async def leave(self):
+        """Stops taking messages, returning any pinned here to the buffer."""
+        self.left = True
+        self.stripes.stripes.remove(self)
+        while self.items:
+            await self.stripes.buffer.put_ident(self.items.popleft())
+
 
 class Worker:
     def __init__(self, receptor, loop):
         self.receptor = receptor
         self.loop = loop
         self.conn = None
-        self.buf = FramedBuffer(loop=self.loop)
+        self.buf = FramedBuffer(
+            loop=self.loop, max_pending=receptor.config.default_ingress_limit or None
+        )
         self.remote_id = None
         self.read_task = None
         self.handle_task = None
         self.write_task = None
+        self.heartbeat_task = None
         self.outbound = None
+        self.stripe = None
+        self.last_recv = None
+        self.reading_paused = False
+        self.remote_heartbeat = None
+        self.features = frozenset()
+        self.send_lock = asyncio.Lock(loop=self.loop)
         self.deferrer = fileio.Deferrer(loop=self.loop)
 
     def start_receiving(self):
@@ -60,8 +223,23 @@ class Worker:
             async for msg in self.conn:
                 if self.conn.closed:
                     break
+                self.last_recv = self.loop.time()
                 bytes_recv.inc(len(msg))
+                self.conn.stats.received(len(msg))
                 await self.buf.put(msg)
+                if not self.buf.has_room():
+                    # Let TCP flow control push back on the sender until the
+                    # messages already received have been handled.
+                    ingress_pauses_counter.inc()
+                    self.conn.pause_reading()
+                    self.reading_paused = True
+                    try:
+                        await self.buf.wait_for_room()
+                    finally:
+                        # The peer's silence while paused was our doing
+                        self.reading_paused = False
+                        self.last_recv = self.loop.time()
+                        self.conn.resume_reading()
         except ConnectionResetError:
             logger.debug("receive: other side closed the connection")
         except asyncio.CancelledError:
@@ -70,6 +248,7 @@ class Worker:
             logger.exception("receive")
 
     async def register(self):
+        self.conn.stats.peer = self.remote_id
         await self.receptor.update_connections(self.conn, id_=self.remote_id)
 
     async def unregister(self):
@@ -77,6 +256,10 @@ class Worker:
         self._cancel(self.read_task)
         self._cancel(self.handle_task)
         self._cancel(self.write_task)
+        self._cancel(self.heartbeat_task)
+        if self.stripe is not None:
+            await self.stripe.leave()
+            self.stripe = None
 
     def _cancel(self, task):
         if task:
@@ -84,49 +267,103 @@ class Worker:
 
     async def hello(self):
         msg = self.receptor._say_hi().serialize()
-        await self.conn.send(BridgeQueue.one(msg))
+        async with self.send_lock:
+            await self.conn.send(BridgeQueue.one(msg))
+
+    def _heartbeat_interval(self):
+        interval = self.receptor.config.node_heartbeat_interval
+        if not (self.conn.heartbeat and interval and self.remote_heartbeat):
+            return None
+        return max(interval, self.remote_heartbeat)
+
+    async def heartbeat(self, interval):
+        """
+        Sends a heartbeat whenever the connection is otherwise idle and closes
+        the connection once nothing has been received from the peer for
+        heartbeat_misses intervals.  Returns when the connection is dead.
+        Silence is not counted while reading is paused for ingress backpressure.
+        """
+        timeout = interval * self.receptor.config.node_heartbeat_misses
+        msg = FramedMessage(header={"cmd": "HEARTBEAT"}).serialize()
+        while not self.conn.closed:
+            await asyncio.sleep(interval)
+            silent = self.loop.time() - self.last_recv
+            if silent > timeout and not self.reading_paused:
+                logger.warning(
+                    "No data from %s for %.1fs, closing the connection", self.remote_id, silent
+                )
+                await self.close()
+                return
+            if not self.send_lock.locked():
+                try:
+                    async with self.send_lock:
+                        await self.conn.send(BridgeQueue.one(msg))
+                except Exception as e:
+                    logger.warning("heartbeat: error sending to %s: %s", self.remote_id, e)
+                    await self.close()
+                    return
 
     async def start_processing(self):
-        await self.receptor.recalculate_and_send_routes_soon()
         logger.debug("starting normal loop")
         self.handle_task = self.loop.create_task(self.receptor.message_handler(self.buf))
         self.outbound = self.receptor.buffer_mgr[self.remote_id]
+        stripes = self.receptor.outbound_stripes.get(self.remote_id)
+        if stripes is None or stripes.buffer is not self.outbound:
+            stripes = self.receptor.outbound_stripes[self.remote_id] = Stripes(self.outbound)
+        self.stripe = stripes.join()
         self.write_task = self.loop.create_task(self.watch_queue())
-        return await self.write_task
+        interval = self._heartbeat_interval()
+        if interval is None:
+            return await self.write_task
+        self.heartbeat_task = self.loop.create_task(self.heartbeat(interval))
+        await asyncio.wait(
+            [self.write_task, self.heartbeat_task], return_when=asyncio.FIRST_COMPLETED
+        )
 
     async def close(self):
         if self.conn is not None and not self.conn.closed:
-            return await self.conn.close()
+            closed = self.conn.close()
+            if asyncio.iscoroutine(closed):
+                await closed
 
     async def watch_queue(self):
         try:
             logger.debug(f"Watching queue {str(self.conn)}")
             while not self.conn.closed:
                 try:
-                    item = await asyncio.wait_for(self.outbound.get(), 5.0)
+                    item = await asyncio.wait_for(self.stripe.get(), 5.0)
                 except asyncio.TimeoutError:
                     continue
                 except Exception:
                     logger.exception("watch_queue: error getting data from buffer")
                     continue
                 else:
-                    # TODO: I think we need to wait for this to finish before
-                    # starting another .get
-                    asyncio.ensure_future(self.drain_buf(item))
+                    # Messages are written one at a time so that the wire order
+                    # is the order chosen by the buffer's priority lanes.
+                    await self.drain_buf(item)
 
         except asyncio.CancelledError:
             logger.debug("watch_queue: cancel request received")
             await self.close()
 
     async def drain_buf(self, item):
+        if self.conn.closed:
+            logger.debug("Message not sent: connection already closed")
+            # Left for the peer's next connection, or for a shard handover
+            await self.outbound.put_ident(item)
+            return
         try:
-            if self.conn.closed:
-                logger.debug("Message not sent: connection already closed")
-            else:
-                q = BridgeQueue(maxsize=1)
+            q = BridgeQueue(maxsize=1)
+            paths = self.outbound.message_paths(item)
+            async with self.send_lock:
                 await asyncio.gather(
-                    self.deferrer.defer(q.read_from, item["path"]), self.conn.send(q)
+                    self.deferrer.defer(q.read_files, paths, self.conn.read_size),
+                    self.conn.send(q),
                 )
+        except asyncio.CancelledError:
+            # Torn down mid-message; the peer discards the partial frame
+            await self.outbound.put_ident(item)
+            raise
         except Exception:
             # TODO: Break out these exceptions to deal with file problems
             # and network problem separately?
@@ -134,8 +371,9 @@ class Worker:
             await self.outbound.put_ident(item)
             return await self.close()
         else:
+            self.conn.stats.message_sent()
             try:
-                await self.deferrer.defer(os.remove, item["path"])
+                await self.deferrer.defer(self.outbound.release, item)
             except TypeError:
                 logger.exception("failed to os.remove %s", item["path"])
                 pass  # some messages aren't actually files
@@ -143,27 +381,47 @@ class Worker:
     async def _wait_handshake(self):
         logger.debug("waiting for HI")
         response = await self.buf.get(timeout=20.0)
+        self.buf.release(response)
         self.remote_id = response.header["id"]
+        self.features = self.conn.features = negotiate_features(response.header)
+        if "heartbeat" in self.features:
+            self.remote_heartbeat = response.header.get("heartbeat")
+        interval = self._heartbeat_interval()
+        if interval is not None:
+            self.conn.configure_liveness(interval, self.receptor.config.node_heartbeat_misses)
         await self.register()
-        await self.receptor.recalculate_and_send_routes_soon()
+        # Route over the new link right away and tell the peer what we can
+        # reach, rather than waiting for the next advertisement round
+        await self.receptor.recalculate_routes()
+        await self.receptor.send_routes([self.remote_id])
 
-    async def client(self, transport):
+    async def client(self, transport, established=None):
+        """
+        Runs the connection to a peer until it closes.  established, if
+        given, is a future set to whether the handshake succeeded.
+        """
         try:
             self.conn = transport
             self.start_receiving()
             await self.hello()
             await self._wait_handshake()
+            if established is not None and not established.done():
+                established.set_result(True)
             await self.start_processing()
             logger.debug("normal exit")
         finally:
+            if established is not None and not established.done():
+                established.set_result(False)
             await self.unregister()
 
     async def server(self, transport):
+        # Both ends say HI without waiting for the other, so the handshake
+        # takes one round trip
         try:
             self.conn = transport
             self.start_receiving()
-            await self._wait_handshake()
             await self.hello()
+            await self._wait_handshake()
             await self.start_processing()
         finally:
             await self.unregister()
@@ -2,30 +2,69 @@ import functools
 import asyncio
 from urllib.parse import urlparse
 
+import aiohttp
+
+from .reconnect import supervise
+from .resolver import Resolver
 from . import sock, ws
 
-default_scheme_ports = {"rnp": 8888, "rnps": 8899, "ws": 80, "wss": 443}
+default_scheme_ports = {"rnp": 8888, "rnps": 8899, "rnpu": None, "ws": 80, "wss": 443}
 
 
 def parse_peer(peer, role):
+    """
+    Parses a peer or listener url.  rnpu://<path> names a unix socket, as
+    in rnpu:///var/run/receptor.sock; the other schemes take a host and port.
+    """
     if "://" not in peer:
         peer = f"rnp://{peer}"
     if peer.startswith("receptor://"):
         peer = peer.replace("receptor", "rnp", 1)
     parsed_peer = urlparse(peer)
-    if (parsed_peer.scheme not in default_scheme_ports) or (
-        role == "server"
-        and (parsed_peer.path or parsed_peer.params or parsed_peer.query or parsed_peer.fragment)
-    ):
+    if parsed_peer.scheme == "rnpu":
+        invalid = parsed_peer.netloc not in ("", "localhost") or not parsed_peer.path
+    else:
+        invalid = role == "server" and (
+            parsed_peer.path or parsed_peer.params or parsed_peer.query or parsed_peer.fragment
+        )
+    if parsed_peer.scheme not in default_scheme_ports or invalid:
         raise RuntimeError(f"Invalid Receptor peer specified: {peer}")
     return parsed_peer
 
 
 class Manager:
-    def __init__(self, factory, ssl_context_factory, loop=None):
+    def __init__(
+        self,
+        factory,
+        ssl_context_factory,
+        loop=None,
+        ws_compress=False,
+        ws_max_message=ws.MAX_MESSAGE,
+        unix_mode=0o600,
+        reuse_port=False,
+        dns_ttl=30.0,
+    ):
         self.factory = factory
         self.ssl_context_factory = ssl_context_factory
         self.loop = loop or asyncio.get_event_loop()
+        self.ws_compress = ws_compress
+        self.ws_max_message = max(ws_max_message, ws.MIN_MESSAGE)
+        self.unix_mode = unix_mode
+        # Lets several processes listen on the same address, as node shards do
+        self.reuse_port = reuse_port or None
+        self.resolver = Resolver(dns_ttl, self.loop)
+        self._session = None
+
+    def _client_session(self):
+        # Shared by every websocket peer; created lazily so that it belongs
+        # to the running loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(loop=self.loop)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
 
     def get_listener(self, listen_url):
         service = parse_peer(listen_url, "server")
@@ -38,44 +77,98 @@ class Manager:
                 host=service.hostname,
                 port=service.port or default_scheme_ports[service.scheme],
                 ssl=ssl_context,
+                limit=sock.MAX_CHUNK,
+                reuse_port=self.reuse_port,
+            )
+        elif service.scheme == "rnpu":
+            # Access is controlled by the permissions on the socket file
+            return asyncio.start_unix_server(
+                functools.partial(sock.serve, factory=self.factory),
+                sock=sock.unix_listener(service.path, self.unix_mode),
+                limit=sock.MAX_CHUNK,
             )
         elif service.scheme in ("ws", "wss"):
             return self.loop.create_server(
-                ws.app(self.factory).make_handler(),
+                ws.app(
+                    self.factory, compress=self.ws_compress, max_message=self.ws_max_message
+                ).make_handler(),
                 service.hostname,
                 service.port or default_scheme_ports[service.scheme],
                 ssl=ssl_context,
+                reuse_port=self.reuse_port,
             )
         else:
             raise RuntimeError(f"Unknown URL scheme {service.scheme}")
 
+    def _client_ssl_context(self, scheme):
+        return self.ssl_context_factory("client") if scheme in ("rnps", "wss") else None
+
     def get_peer(self, peer, reconnect=True, ws_extra_headers=None, ws_heartbeat=None):
-        service = parse_peer(peer, "client")
-        ssl_context = (
-            self.ssl_context_factory("client") if service.scheme in ("rnps", "wss") else None
-        )
-        if service.scheme in ("rnp", "rnps"):
-            return self.loop.create_task(
-                sock.connect(
-                    service.hostname,
-                    service.port or default_scheme_ports[service.scheme],
-                    self.factory,
-                    self.loop,
-                    ssl_context,
-                    reconnect,
-                )
-            )
-        elif service.scheme in ("ws", "wss"):
-            return self.loop.create_task(
-                ws.connect(
-                    peer,
+        """
+        Returns a task that keeps a connection to peer open, reconnecting with
+        backoff when it fails or closes.  Without reconnect the task makes one
+        attempt and returns whether a connection was established.
+
+        peer may list several equivalent endpoints separated by "|", as in
+        rnps://hub-a:8899|rnps://hub-b:8899; each attempt connects to the
+        first of them that accepts.
+
+        The SSL context is looked up again for each attempt; it is cached, so
+        this costs nothing unless the certificates have changed.
+        """
+        urls = peer.split("|")
+        services = [parse_peer(url, "client") for url in urls]
+        scheme = services[0].scheme
+        if any(service.scheme != scheme for service in services):
+            raise RuntimeError(f"Invalid Receptor peer specified: {peer}, schemes differ")
+        self._client_ssl_context(scheme)  # fail early on bad TLS settings
+        if scheme in ("rnp", "rnps"):
+            endpoints = [
+                (service.hostname, service.port or default_scheme_ports[scheme])
+                for service in services
+            ]
+
+            async def connect(established):
+                ssl_context = self._client_ssl_context(scheme)
+                return await sock.connect(
+                    endpoints,
                     self.factory,
                     self.loop,
                     ssl_context,
-                    reconnect,
-                    ws_extra_headers,
-                    ws_heartbeat,
+                    resolver=self.resolver,
+                    established=established,
                 )
-            )
+
+        elif scheme == "rnpu":
+
+            async def connect(established):
+                for service in services:
+                    if await sock.connect(
+                        None, self.factory, self.loop, path=service.path, established=established
+                    ):
+                        return True
+                return False
+
+        elif scheme in ("ws", "wss"):
+
+            async def connect(established):
+                for url in urls:
+                    connected = await ws.connect(
+                        url,
+                        self.factory,
+                        self.loop,
+                        self._client_ssl_context(scheme),
+                        ws_extra_headers,
+                        ws_heartbeat,
+                        session=self._client_session(),
+                        compress=self.ws_compress,
+                        max_message=self.ws_max_message,
+                        established=established,
+                    )
+                    if connected:
+                        return True
+                return False
+
         else:
-            raise RuntimeError(f"Unknown URL scheme {service.scheme}")
+            raise RuntimeError(f"Unknown URL scheme {scheme}")
+        return self.loop.create_task(supervise(connect, scheme, reconnect, loop=self.loop))
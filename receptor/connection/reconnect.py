@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import random
+
+from ..stats import connect_attempts_counter
+
+logger = logging.getLogger(__name__)
+
+
+class Backoff:
+    """
+    Capped exponential backoff with full jitter.
+
+    The first retry is immediate.  After that each delay is drawn uniformly
+    from zero to base * 2 ** n seconds, capped at cap, so peers that lost the
+    same hub spread their reconnects out instead of arriving together.
+    """
+
+    def __init__(self, base=0.5, cap=60.0, rand=random.random):
+        self.base = base
+        self.cap = cap
+        self.rand = rand
+        self.attempt = 0
+
+    def reset(self):
+        self.attempt = 0
+
+    def next_delay(self):
+        if self.attempt == 0:
+            delay = 0.0
+        else:
+            delay = self.rand() * min(self.cap, self.base * 2 ** (self.attempt - 1))
+        self.attempt += 1
+        return delay
+
+
+async def supervise(connect, scheme, reconnect=True, backoff=None, stable_after=10.0, loop=None):
+    """
+    Keeps a peer connected by calling connect() again whenever the previous
+    connection fails or ends.
+
+    connect is a coroutine function making one attempt: it returns False if
+    no connection could be established, or True once an established
+    connection has closed.  It is passed a future to set to whether the
+    handshake succeeded, so that the attempt is counted when that is known
+    rather than when the connection ends.  A connection that stayed up for
+    stable_after seconds starts the backoff over.
+
+    Without reconnect, returns the result of the single attempt.
+    """
+    loop = loop or asyncio.get_event_loop()
+    backoff = backoff or Backoff()
+    while True:
+        started = loop.time()
+        established = loop.create_future()
+        attempt = asyncio.ensure_future(connect(established), loop=loop)
+        try:
+            await asyncio.wait([attempt, established], return_when=asyncio.FIRST_COMPLETED)
+            result = "connected" if established.done() and established.result() else "failed"
+            connect_attempts_counter.labels(scheme, result).inc()
+            connected = await attempt
+        except asyncio.CancelledError:
+            attempt.cancel()
+            raise
+        if not reconnect:
+            return connected
+        if connected and loop.time() - started >= stable_after:
+            backoff.reset()
+        delay = backoff.next_delay()
+        logger.debug("Reconnecting to %s peer in %.1fs", scheme, delay)
+        await asyncio.sleep(delay)
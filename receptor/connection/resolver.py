@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import socket
+
+from ..stats import dns_lookups_counter
+
+logger = logging.getLogger(__name__)
+
+# RFC 8305 recommends 250ms between connection attempts
+ATTEMPT_DELAY = 0.25
+
+
+def interleave(addrs):
+    """
+    Orders (family, sockaddr) pairs so that address families alternate,
+    starting with the family of the first address, as RFC 8305 section 4
+    describes.  Duplicates are dropped.
+    """
+    by_family = {}
+    for family, addr in addrs:
+        family_addrs = by_family.setdefault(family, [])
+        if addr not in family_addrs:
+            family_addrs.append(addr)
+    ordered = []
+    queues = list(by_family.items())
+    while queues:
+        for family, family_addrs in queues:
+            ordered.append((family, family_addrs.pop(0)))
+        queues = [(family, family_addrs) for family, family_addrs in queues if family_addrs]
+    return ordered
+
+
+class Resolver:
+    """
+    Looks up stream addresses for a host and port, remembering the answer
+    for ttl seconds.  Concurrent lookups of the same name share one query.
+    """
+
+    def __init__(self, ttl=30.0, loop=None):
+        self.ttl = ttl
+        self.loop = loop or asyncio.get_event_loop()
+        self._cache = {}
+        self._pending = {}
+
+    async def resolve(self, host, port):
+        """Returns the (family, sockaddr) pairs for host and port, interleaved by family."""
+        key = (host, port)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > self.loop.time():
+            dns_lookups_counter.labels("cached").inc()
+            return cached[1]
+        if key not in self._pending:
+            self._pending[key] = self.loop.create_task(self._lookup(host, port))
+        return await asyncio.shield(self._pending[key])
+
+    async def _lookup(self, host, port):
+        try:
+            infos = await self.loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except OSError:
+            dns_lookups_counter.labels("failed").inc()
+            raise
+        finally:
+            del self._pending[(host, port)]
+        dns_lookups_counter.labels("resolved").inc()
+        addrs = interleave((family, sockaddr) for family, _, _, _, sockaddr in infos)
+        if self.ttl > 0:
+            self._cache[(host, port)] = (self.loop.time() + self.ttl, addrs)
+        return addrs
+
+    def forget(self, host, port):
+        """Drops the cached answer for host and port, so the next lookup asks again."""
+        self._cache.pop((host, port), None)
+
+
+async def _attempt(loop, host, family, addr):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        await loop.sock_connect(sock, addr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock, host
+
+
+async def race(candidates, delay=ATTEMPT_DELAY, loop=None):
+    """
+    Connects to the first of candidates, (host, family, sockaddr) triples,
+    that accepts.  Each attempt starts delay seconds after the previous one,
+    or as soon as it fails, and the first to succeed wins; the others are
+    cancelled.  Returns the connected socket and the host it belongs to.
+    Raises OSError if every attempt fails.
+    """
+    loop = loop or asyncio.get_event_loop()
+    candidates = list(candidates)
+    pending = set()
+    errors = []
+    try:
+        while candidates or pending:
+            if candidates:
+                pending.add(loop.create_task(_attempt(loop, *candidates.pop(0))))
+            done, pending = await asyncio.wait(
+                pending, timeout=delay if candidates else None, return_when=asyncio.FIRST_COMPLETED,
+            )
+            winners = [task.result() for task in done if task.exception() is None]
+            errors.extend(task.exception() for task in done if task.exception() is not None)
+            if winners:
+                for sock, _ in winners[1:]:
+                    sock.close()
+                return winners[0]
+    finally:
+        for task in pending:
+            task.cancel()
+    reasons = ", ".join(str(error) for error in errors) or "no addresses"
+    raise OSError(f"All connection attempts failed: {reasons}")
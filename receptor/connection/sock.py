@@ -1,24 +1,91 @@
 import asyncio
+import errno
 import logging
+import os
+import socket
+import stat
+import struct
 
-from .base import Transport, log_ssl_detail
+from ..stats import connect_seconds
+from .base import StreamStats, Transport, log_ssl_detail
+from .resolver import Resolver, race
+from .tls import ResumingSSLContext
 
 logger = logging.getLogger(__name__)
 
 
+MIN_CHUNK = 2 ** 12
+MAX_CHUNK = 2 ** 20
+
+
 class RawSocket(Transport):
-    def __init__(self, reader, writer, chunk_size=2 ** 16):
+    """
+    A Transport over an asyncio stream.
+
+    The read size follows the recent read sizes: it doubles while reads come
+    back full and halves once the moving average drops below a quarter of it,
+    so a busy connection is read in few large chunks and an idle one does not
+    hold on to large buffers.
+    """
+
+    read_size = 2 ** 16
+
+    def __init__(
+        self, reader, writer, chunk_size=2 ** 16, min_chunk=MIN_CHUNK, max_chunk=MAX_CHUNK
+    ):
         self.reader = reader
         self.writer = writer
         self._closed = False
         self.chunk_size = chunk_size
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.avg_read = float(chunk_size)
+        self.stats = StreamStats()
 
     async def __anext__(self):
         bytes_ = await self.reader.read(self.chunk_size)
         if not bytes_:
             self.close()
+        else:
+            self._adapt(len(bytes_))
         return bytes_
 
+    def _adapt(self, size):
+        self.avg_read += (size - self.avg_read) / 4
+        if size >= self.chunk_size:
+            self.chunk_size = min(self.max_chunk, self.chunk_size * 2)
+        elif self.avg_read < self.chunk_size / 4:
+            self.chunk_size = max(self.min_chunk, self.chunk_size // 2)
+
+    heartbeat = True
+
+    def configure_liveness(self, interval, misses):
+        """
+        Has the kernel give up on the connection after interval * misses
+        seconds without acknowledgement or keepalive reply, where supported.
+        """
+        sock = self.writer.get_extra_info("socket")
+        if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        options = [
+            ("TCP_KEEPIDLE", interval),
+            ("TCP_KEEPINTVL", interval),
+            ("TCP_KEEPCNT", misses),
+            ("TCP_USER_TIMEOUT", interval * misses * 1000),
+        ]
+        for name, value in options:
+            if hasattr(socket, name):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+    def pause_reading(self):
+        self.writer.transport.pause_reading()
+
+    def resume_reading(self):
+        if not self.closed:
+            self.writer.transport.resume_reading()
+
     @property
     def closed(self):
         return self._closed
@@ -30,46 +97,169 @@ class RawSocket(Transport):
     async def send(self, q):
         async for chunk in q:
             self.writer.write(chunk)
+            self.stats.sent(len(chunk))
         await self.writer.drain()
 
     def _diagnostics(self):
         t = self.writer._transport.get_extra_info
-        addr, port = t("peername", (None, None))
+        peername = t("peername")
+        addr, port = peername if isinstance(peername, tuple) else (peername or None, None)
         return {
             "address": addr,
             "port": port,
+            "peercred": peer_credentials(t("socket")),
             "compression": t("compression"),
             "cipher": t("cipher"),
             "peercert": t("peercert"),
             "sslcontext": t("sslcontext"),
             "closed": self.closed,
             "chunk_size": self.chunk_size,
+            "avg_read": self.avg_read,
+            "stats": self.stats.snapshot(),
         }
 
 
-async def connect(host, port, factory, loop=None, ssl=None, reconnect=True):
+def peer_credentials(sock):
+    """
+    Returns the pid, uid and gid of the process at the other end of a unix
+    socket, or None where the platform does not report them.
+    """
+    if sock is None or sock.family != socket.AF_UNIX or not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return dict(zip(("pid", "uid", "gid"), struct.unpack("3i", creds)))
+
+
+def _remove_stale_socket(path):
+    """
+    Removes the socket file at path if nothing listens on it any more, and
+    raises EADDRINUSE if something might.
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    probe.settimeout(1.0)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+    except OSError:
+        pass
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, f"Address already in use: {path}")
+
+
+def unix_listener(path, mode=0o600):
+    """
+    Binds a unix socket at path that only users with write permission
+    under mode can connect to.  The mode is applied before the socket
+    starts listening, so there is no window in which it is more open.  A
+    stale socket left behind by an earlier run is replaced, but one that
+    another process is still listening on is left alone.
+    """
+    _remove_stale_socket(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        os.chmod(path, mode)
+        sock.listen(100)
+    except Exception:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+async def open_endpoints(endpoints, loop=None, ssl=None, resolver=None):
+    """
+    Opens a stream to whichever of endpoints, (host, port) pairs for
+    equivalent peers, accepts first.  Every address of every endpoint is a
+    candidate, in the order given, and they are raced as RFC 8305 describes,
+    so an endpoint that is down costs one failed or delayed attempt rather
+    than a reconnect cycle.  Returns the reader, the writer and the host
+    connected to.
+    """
+    loop = loop or asyncio.get_event_loop()
+    resolver = resolver or Resolver(ttl=0, loop=loop)
+    answers = await asyncio.gather(
+        *(resolver.resolve(host, port) for host, port in endpoints), return_exceptions=True
+    )
+    candidates = []
+    for (host, port), addrs in zip(endpoints, answers):
+        if isinstance(addrs, Exception):
+            logger.info(f"sock.connect: unable to resolve {host}, {str(addrs)}")
+            continue
+        candidates.extend((host, family, addr) for family, addr in addrs)
+    try:
+        sock, host = await race(candidates, loop=loop)
+    except OSError:
+        # The peer may have moved; look it up again next time
+        for host, port in endpoints:
+            resolver.forget(host, port)
+        raise
+    r, w = await asyncio.open_connection(
+        sock=sock, ssl=ssl, server_hostname=host if ssl else None, limit=MAX_CHUNK
+    )
+    return r, w, host
+
+
+async def connect(
+    endpoints, factory, loop=None, ssl=None, path=None, resolver=None, established=None
+):
+    """
+    Connects to a peer and runs a worker on the connection until it closes.
+    Returns False if the connection could not be established.  established,
+    if given, is passed on to Worker.client.
+
+    endpoints is a list of (host, port) pairs for the peer, tried as
+    open_endpoints describes.  With path, connects to the unix socket at
+    path instead.
+    """
     if not loop:
         loop = asyncio.get_event_loop()
 
-    worker = factory()
+    scheme = "rnpu" if path else "rnps" if ssl else "rnp"
+    where = path or "|".join(f"{host}:{port}" for host, port in endpoints)
+    host = None
+    start = loop.time()
+    try:
+        if path:
+            r, w = await asyncio.open_unix_connection(path, loop=loop, limit=MAX_CHUNK)
+        else:
+            r, w, host = await open_endpoints(endpoints, loop, ssl, resolver)
+    except Exception as ex:
+        logger.info(f"sock.connect: connection to {where} failed, {str(ex)}")
+        return False
+    connect_seconds.labels(scheme).observe(loop.time() - start)
+    ssl_object = w.get_extra_info("ssl_object")
+    if isinstance(ssl, ResumingSSLContext):
+        ssl.established(host, ssl_object)
+
     try:
-        r, w = await asyncio.open_connection(host, port, loop=loop, ssl=ssl)
         log_ssl_detail(w._transport)
         t = RawSocket(r, w)
-        await worker.client(t)
+        await factory().client(t, established)
     except Exception as ex:
-        logger.info(f"sock.connect: connection failed, {str(ex)}")
-        if not reconnect:
-            return False
+        logger.info(f"sock.connect: connection to {where} lost, {str(ex)}")
     finally:
-        if reconnect:
-            await asyncio.sleep(5)
-            logger.debug("sock.connect: reconnection")
-            loop.create_task(connect(host, port, factory, loop))
+        if isinstance(ssl, ResumingSSLContext):
+            ssl.remember(host, ssl_object)
     return True
 
 
 async def serve(reader, writer, factory):
-    log_ssl_detail(writer._transport)
+    creds = peer_credentials(writer.get_extra_info("socket"))
+    if creds:
+        logger.debug("Unix socket connection from pid %(pid)s uid %(uid)s gid %(gid)s", creds)
+    else:
+        log_ssl_detail(writer._transport)
     t = RawSocket(reader, writer)
     await factory().server(t)
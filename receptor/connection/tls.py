@@ -0,0 +1,40 @@
+import ssl
+
+from ..stats import tls_sessions_resumed
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    A client SSLContext that offers the last TLS session it saw for a host
+    when connecting to that host again, so reconnects can skip the full
+    handshake.
+    """
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        self.sessions = {}
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(
+            incoming,
+            outgoing,
+            server_side=server_side,
+            server_hostname=server_hostname,
+            session=session,
+        )
+
+    def established(self, server_hostname, ssl_object):
+        """Records a completed handshake with a host."""
+        if ssl_object is not None and ssl_object.session_reused:
+            tls_sessions_resumed.inc()
+        self.remember(server_hostname, ssl_object)
+
+    def remember(self, server_hostname, ssl_object):
+        """
+        Keeps the session of a connection for the next one to that host.  With
+        TLS 1.3 the session ticket arrives after the handshake, so this is
+        worth calling again once the connection has been in use.
+        """
+        if ssl_object is not None and ssl_object.session is not None:
+            self.sessions[server_hostname] = ssl_object.session
@@ -7,14 +7,58 @@ import aiohttp.web
 from aiohttp.helpers import proxies_from_env
 from urllib.parse import urlparse
 
-from .base import Transport, log_ssl_detail
+from ..stats import connect_seconds
+from .base import StreamStats, Transport, log_ssl_detail
+from .tls import ResumingSSLContext
 
 logger = logging.getLogger(__name__)
 
+MIN_MESSAGE = 2 ** 16
+MAX_MESSAGE = 2 ** 20
+PROTOCOL_PREFIX = "receptor.max-message."
+
+
+def message_protocols(max_message):
+    """
+    Returns the websocket subprotocols offering every message size from
+    max_message down to MIN_MESSAGE, largest first.  The server picks the
+    first of its own offers that the client also made, which is the largest
+    size both ends can receive.
+    """
+    size = MIN_MESSAGE
+    while size * 2 <= max_message:
+        size *= 2
+    protocols = []
+    while size >= MIN_MESSAGE:
+        protocols.append(f"{PROTOCOL_PREFIX}{size}")
+        size //= 2
+    return protocols
+
+
+def receive_limit(max_message):
+    # aiohttp applies max_msg_size to compressed messages as well, and
+    # incompressible data comes out of deflate slightly larger than it went in
+    return 2 * max_message
+
+
+def negotiated_message_size(protocol):
+    if protocol and protocol.startswith(PROTOCOL_PREFIX):
+        return int(protocol[len(PROTOCOL_PREFIX) :])
+    return MIN_MESSAGE  # peers that do not negotiate take the chunks as they come
+
 
 class WebSocket(Transport):
-    def __init__(self, ws):
+    """
+    A Transport over a websocket.  Outgoing data is coalesced into messages
+    of up to max_message bytes rather than sent one queue chunk at a time.
+    """
+
+    def __init__(self, ws, max_message=None):
         self.ws = ws
+        self.stats = StreamStats()
+        # The chosen subprotocol is ws_protocol on the server side
+        protocol = getattr(ws, "ws_protocol", None) or getattr(ws, "protocol", None)
+        self.max_message = max_message or negotiated_message_size(protocol)
 
     async def __anext__(self):
         msg = await self.ws.__anext__()
@@ -27,9 +71,32 @@ class WebSocket(Transport):
     def closed(self):
         return self.ws.closed
 
+    @property
+    def read_size(self):
+        return self.max_message
+
     async def send(self, q):
+        pending = bytearray()
         async for chunk in q:
-            await self.ws.send_bytes(chunk)
+            pending += chunk
+            if len(pending) >= self.max_message:
+                await self._send_message(pending[: self.max_message])
+                del pending[: self.max_message]
+        while pending:
+            await self._send_message(pending[: self.max_message])
+            del pending[: self.max_message]
+
+    async def _send_message(self, data):
+        await self.ws.send_bytes(bytes(data))
+        self.stats.sent(len(data))
+
+    def _diagnostics(self):
+        return {
+            "closed": self.closed,
+            "compression": self.ws.compress,
+            "max_message": self.max_message,
+            "stats": self.stats.snapshot(),
+        }
 
 
 async def connect(
@@ -37,56 +104,82 @@ async def connect(
     factory,
     loop=None,
     ssl_context=None,
-    reconnect=True,
     ws_extra_headers=None,
     ws_heartbeat=None,
+    session=None,
+    compress=False,
+    max_message=MAX_MESSAGE,
+    established=None,
 ):
+    """
+    Connects to a peer and runs a worker on the connection until it closes.
+    Returns False if the connection could not be established.  A session
+    passed in is left open for the next attempt.  established, if given, is
+    passed on to Worker.client.
+
+    With compress, permessage-deflate is offered to the server.
+    """
     if not loop:
         loop = asyncio.get_event_loop()
 
-    worker = factory()
+    scheme = urlparse(uri).scheme
+    proxy_scheme = {"ws": "http", "wss": "https"}[scheme]
+    proxies = proxies_from_env()
+    if proxy_scheme in proxies:
+        proxy = proxies[proxy_scheme].proxy
+        proxy_auth = proxies[proxy_scheme].proxy_auth
+    else:
+        proxy = None
+        proxy_auth = None
+
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession()
     try:
-        proxy_scheme = {"ws": "http", "wss": "https"}[urlparse(uri).scheme]
-        proxies = proxies_from_env()
-        if proxy_scheme in proxies:
-            proxy = proxies[proxy_scheme].proxy
-            proxy_auth = proxies[proxy_scheme].proxy_auth
-        else:
-            proxy = None
-            proxy_auth = None
-        async with aiohttp.ClientSession().ws_connect(
-            uri,
-            ssl=ssl_context,
-            headers=ws_extra_headers,
-            proxy=proxy,
-            proxy_auth=proxy_auth,
-            heartbeat=ws_heartbeat,
-        ) as ws:
-            log_ssl_detail(ws)
-            t = WebSocket(ws)
-            await worker.client(t)
-    except Exception:
-        logger.exception("ws.connect")
-        return False
-    finally:
-        if reconnect:
-            await asyncio.sleep(5)
-            logger.debug("ws.connect: reconnecting")
-            loop.create_task(
-                connect(
-                    uri,
-                    factory=factory,
-                    loop=loop,
-                    ssl_context=ssl_context,
-                    ws_extra_headers=ws_extra_headers,
-                    ws_heartbeat=ws_heartbeat,
-                )
+        start = loop.time()
+        try:
+            ws = await session.ws_connect(
+                uri,
+                ssl=ssl_context,
+                headers=ws_extra_headers,
+                proxy=proxy,
+                proxy_auth=proxy_auth,
+                heartbeat=ws_heartbeat,
+                protocols=message_protocols(max_message),
+                compress=15 if compress else 0,
+                max_msg_size=receive_limit(max_message),
             )
+        except Exception as ex:
+            logger.info(f"ws.connect: connection to {uri} failed, {str(ex)}")
+            return False
+        connect_seconds.labels(scheme).observe(loop.time() - start)
+        host = urlparse(uri).hostname
+        ssl_object = ws.get_extra_info("ssl_object")
+        if isinstance(ssl_context, ResumingSSLContext):
+            ssl_context.established(host, ssl_object)
+
+        async with ws:
+            try:
+                log_ssl_detail(ws)
+                t = WebSocket(ws)
+                await factory().client(t, established)
+            except Exception:
+                logger.exception("ws.connect")
+            finally:
+                if isinstance(ssl_context, ResumingSSLContext):
+                    ssl_context.remember(host, ssl_object)
         return True
+    finally:
+        if own_session:
+            await session.close()
 
 
-async def serve(request, factory):
-    ws = aiohttp.web.WebSocketResponse()
+async def serve(request, factory, compress=False, max_message=MAX_MESSAGE):
+    ws = aiohttp.web.WebSocketResponse(
+        protocols=message_protocols(max_message),
+        compress=compress,
+        max_msg_size=receive_limit(max_message),
+    )
     log_ssl_detail(request.transport)
     await ws.prepare(request)
 
@@ -94,8 +187,8 @@ async def serve(request, factory):
     await factory().server(t)
 
 
-def app(factory):
-    handler = functools.partial(serve, factory=factory)
+def app(factory, compress=False, max_message=MAX_MESSAGE):
+    handler = functools.partial(serve, factory=factory, compress=compress, max_message=max_message)
     app = aiohttp.web.Application()
     app.add_routes([aiohttp.web.get("/", handler)])
     return app
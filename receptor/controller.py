@@ -4,13 +4,17 @@ import io
 import logging
 import os
 import shutil
+import time
 from contextlib import suppress
 
 from .connection.base import Worker
 from .connection.manager import Manager
 from .diagnostics import status
 from .messages.framed import FileBackedBuffer, FramedMessage
+from .messages.priority import Priority
 from .receptor import Receptor
+from .responses import ResponseStream
+from .window import SendWindow
 
 logger = logging.getLogger(__name__)
 
@@ -28,21 +32,36 @@ class Controller:
     :type config: :class:`receptor.config.ReceptorConfig`
     :type loop: asyncio event loop
     :type queue: asyncio.Queue
+
+    The controller's :class:`receptor.window.SendWindow`, sized by the ``send_window`` and
+    ``send_window_per_recipient`` options, is available as ``window``; ``window.stats()``
+    reports how many requests are outstanding and their recent throughput and latency.
     """
 
     def __init__(self, config, loop=asyncio.get_event_loop(), queue=None):
         self.receptor = Receptor(config)
         self.loop = loop
         self.connection_manager = Manager(
-            lambda: Worker(self.receptor, loop), self.receptor.config.get_ssl_context, loop
+            lambda: Worker(self.receptor, loop),
+            self.receptor.config.get_ssl_context,
+            loop,
+            ws_compress=bool(config.node_ws_compress),
+            ws_max_message=config.node_ws_max_message,
+            unix_mode=int(config.node_unix_socket_mode, 8),
+            reuse_port=config.node_shards > 1,
+            dns_ttl=config.node_dns_ttl,
         )
         self.queue = queue
         if self.queue is None:
             self.queue = asyncio.Queue(loop=loop)
         self.receptor.response_queue = self.queue
+        self.window = SendWindow(
+            config.default_send_window, config.default_send_window_per_recipient, loop=loop
+        )
         self.status_task = loop.create_task(status(self.receptor))
 
     async def shutdown_loop(self):
+        await self.connection_manager.close()
         tasks = [
             task for task in asyncio.Task.all_tasks() if task is not asyncio.Task.current_task()
         ]
@@ -73,6 +92,8 @@ class Controller:
         * rnp://1.2.3.4:8888 - Insecure receptor protocol bound to the interface of 1.2.3.4
           port 8888
         * wss://0.0.0.0:443 - Secure websocket protocol bound on all interfaces port 443
+        * rnpu:///var/run/receptor.sock - Receptor protocol on a unix socket, for clients
+          on the same host
 
         The services are started as asyncio tasks and will start listening once
         :meth:`receptor.controller.Controller.run` is called.
@@ -86,7 +107,7 @@ class Controller:
             tasks.append(self.loop.create_task(listener))
         return tasks
 
-    def add_peer(self, peer, ws_extra_headers=None, ws_heartbeat=None):
+    def add_peer(self, peer, ws_extra_headers=None, ws_heartbeat=None, streams=1):
         """
         Adds a Receptor Node *Peer*. A connection will be established to this node once
         :meth:`receptor.controller.Controller.run` is called.
@@ -94,27 +115,49 @@ class Controller:
         Example format:
         rnps://10.0.1.1:8888
 
+        Equivalent endpoints, such as a hub and its standby, can be given
+        together separated by "|": rnps://hub-a:8888|rnps://hub-b:8888
+
         :param peer: remote peer url
+        :param streams: number of connections to open to the peer. Messages queued
+                        for the peer are sent on whichever connection is free first.
+        :return: the task for the first connection
         """
         logger.info("Connecting to peer {}".format(peer))
-        return self.connection_manager.get_peer(
-            peer,
-            reconnect=not self.receptor.config._is_ephemeral,
-            ws_extra_headers=ws_extra_headers,
-            ws_heartbeat=ws_heartbeat,
-        )
+        tasks = [
+            self.connection_manager.get_peer(
+                peer,
+                reconnect=not self.receptor.config._is_ephemeral,
+                ws_extra_headers=ws_extra_headers,
+                ws_heartbeat=ws_heartbeat,
+            )
+            for _ in range(max(1, streams))
+        ]
+        return tasks[0]
 
     async def recv(self):
         """
         Fetch a single response message from the response queue, this method blocks
         and should be *await* ed or assigned to a Future
 
+        Responses to messages sent with ``stream=True`` arrive on the stream :meth:`send`
+        returns instead, unless its reader falls too far behind.
+
         :return: A single response message
         :rtype: :class:`receptor.messages.framed.FramedMessage`
         """
         return await self.receptor.response_queue.get()
 
-    async def send(self, payload, recipient, directive, expect_response=True):
+    async def send(
+        self,
+        payload,
+        recipient,
+        directive,
+        expect_response=True,
+        priority=None,
+        ttl=None,
+        stream=False,
+    ):
         """
         Sends a payload to a recipient *Node* to execute under a given *directive*.
 
@@ -134,18 +177,170 @@ class Controller:
         the `Receptor HTTP Plugin <https://github.com/project-receptor/receptor-http>`_ would take
         the form of ``receptor-http:execute``
 
-        This method returns a message identifier, that message identifier can be used to reference
-        responses returned from the plugin as having originated from the message sent by this
-        request.
+        This method returns a message identifier, which is the ``in_response_to`` header of the
+        plugin's responses. They are placed in the response queue, see :meth:`recv`.
+
+        With *stream*, it returns a :class:`receptor.responses.ResponseStream` for the message
+        instead, and the responses go to the stream rather than the queue. Iterate over it with
+        ``async for`` to receive them; iteration ends after the response marked ``eof``. A stream
+        holds up to 64 unread responses. If its reader falls further behind, reading past those
+        raises :class:`receptor.exceptions.ResponseOverflowError` and the rest of the responses go
+        to the response queue. A stream that receives no response for ``response_timeout``
+        seconds raises :class:`asyncio.TimeoutError`. The stream compares equal to the message id,
+        which is also available as its ``msg_id``.
+
+        A request counts against the controller's send window until its ``eof`` response arrives,
+        its stream is closed or it times out. When the window is full, or *recipient* already
+        has its share of it, this method waits for an earlier request to finish before reading
+        the payload.
 
         :param payload: See above
         :param recipient: The node id of a Receptor Node on the mesh
         :param directive: See above
         :param expect_response: Optional Whether it is expected that the plugin will emit a
             response.
-
-        :return: a message-id that can be used to reference responses
+        :param priority: Optional priority class for the message, one of ``"control"``,
+            ``"interactive"`` or ``"bulk"``. Directives default to ``"bulk"``.
+        :param ttl: Optional number of seconds the message may spend in transit. Every node on
+            the path drops the message once this deadline passes and an expiry response with
+            ``code`` 1 is returned to the sender.
+        :param stream: Optional Whether to return a response stream rather than a message id.
+
+        :return: a message id, or with *stream* a response stream, for the message
+        """
+        release = await self.window.acquire(recipient)
+        try:
+            return await self._send(
+                payload,
+                dict(recipient=recipient),
+                directive,
+                expect_response,
+                priority,
+                ttl,
+                stream,
+                release,
+            )
+        except BaseException:
+            release()
+            raise
+
+    async def send_many(
+        self,
+        payload,
+        recipients,
+        directive,
+        expect_response=True,
+        priority=None,
+        ttl=None,
+        gather=False,
+        stream=False,
+    ):
         """
+        Sends a payload to several recipient *Nodes* to execute under a given *directive*.
+
+        Rather than a copy per recipient, one copy goes to each neighbor on the way to the
+        recipients, and the nodes along the way copy it again wherever the paths to the
+        recipients part, so every link carries the payload once. The arguments are as for
+        :meth:`send`, except that *recipients* is a list of node ids.
+
+        Every recipient receives the same message id, and the responses from all of them arrive in
+        the response queue, or with *stream* on the returned stream, in the order they arrive; the
+        ``sender`` header of a response names the recipient it came from. Iteration over a stream
+        ends once each recipient's ``eof`` has arrived.
+        Recipients the mesh has no route to are answered with an error response with ``code`` 1.
+        The request counts once against the controller's send window.
+
+        With *gather*, the nodes that copy the message also gather the responses coming back
+        through them and send them on in batches, holding them for up to their ``gather_delay``
+        setting. Far fewer messages then reach the controller for a large fan-out, at the cost of
+        that much latency per level of the tree. Batches are unpacked on arrival, so each response
+        is still delivered on its own.
+
+        :return: a message id, or with *stream* a response stream, for the message
+        """
+        recipients = list(dict.fromkeys(recipients))
+        addressing = dict(recipients=recipients)
+        if gather:
+            addressing["gather"] = True
+        release = await self.window.acquire(None)
+        try:
+            return await self._send(
+                payload,
+                addressing,
+                directive,
+                expect_response,
+                priority,
+                ttl,
+                stream,
+                release,
+                eofs=len(recipients),
+            )
+        except BaseException:
+            release()
+            raise
+
+    async def send_group(
+        self,
+        payload,
+        group,
+        directive,
+        expect_response=True,
+        priority=None,
+        ttl=None,
+        spillover=True,
+        affinity_key=None,
+        stream=False,
+    ):
+        """
+        Sends a payload to execute under a given *directive* on one member of a group of *Nodes*.
+
+        Nodes join groups with the ``groups`` option and advertise their load along with their
+        routes. The member is chosen for the least work in progress for its number of work threads,
+        with each hop further away counting against it as much as a tenth of its threads being
+        busy. With *spillover*, a member that receives the message with all its work threads busy
+        passes it on to the next best member that has not had it yet; when every member has had it,
+        the response is an error with ``code`` 1 and a ``busy`` header. Without it, the chosen
+        member queues the work however busy it is.
+
+        With an *affinity_key*, such as a project name, the member is instead the one the key maps
+        to on a consistent hash ring of the group's members, so work with the same key keeps going
+        to the same member and can use what it cached last time. A member joining or leaving the
+        group only moves the keys it takes over or held. Spillover then passes work on to the next
+        member round the ring.
+
+        The other arguments and the return value are as for :meth:`send`; the ``sender`` header
+        of a response names the member that handled it. The request counts against the
+        controller's send window as a whole, not against any one member.
+
+        :raises receptor.exceptions.UnrouteableError: if no member of the group is reachable
+        :return: a message id, or with *stream* a response stream, for the message
+        """
+        addressing = dict(group=group)
+        if affinity_key is not None:
+            addressing["affinity_key"] = str(affinity_key)
+        if spillover:
+            addressing["spillover"] = True
+        release = await self.window.acquire(None)
+        try:
+            return await self._send(
+                payload, addressing, directive, expect_response, priority, ttl, stream, release
+            )
+        except BaseException:
+            release()
+            raise
+
+    async def _send(
+        self,
+        payload,
+        addressing,
+        directive,
+        expect_response,
+        priority,
+        ttl,
+        stream,
+        release,
+        eofs=1,
+    ):
         if os.path.exists(payload):
             buffer = FileBackedBuffer.from_path(payload)
         elif isinstance(payload, (str, bytes)):
@@ -154,17 +349,28 @@ class Controller:
             buffer = FileBackedBuffer.from_dict(payload)
         elif isinstance(payload, io.BytesIO):
             buffer = FileBackedBuffer.from_buffer(payload)
-        message = FramedMessage(
-            header=dict(
-                sender=self.receptor.node_id,
-                recipient=recipient,
-                timestamp=datetime.datetime.utcnow(),
-                directive=directive,
-            ),
-            payload=buffer,
+        header = dict(
+            sender=self.receptor.node_id,
+            timestamp=datetime.datetime.utcnow(),
+            directive=directive,
+            **addressing,
+        )
+        if priority is not None:
+            header["priority"] = Priority.from_label(priority).label
+        if ttl is not None:
+            header["deadline"] = time.time() + ttl
+        message = FramedMessage(header=header, payload=buffer)
+        responses = None
+        if stream:
+            responses = ResponseStream(
+                message.msg_id, done=not expect_response, eofs=eofs, loop=self.loop
+            )
+        await self.receptor.router.send(
+            message, expected_response=expect_response, stream=responses, on_done=release
         )
-        await self.receptor.router.send(message, expected_response=expect_response)
-        return message.msg_id
+        if not expect_response:
+            release()
+        return message.msg_id if responses is None else responses
 
     async def ping(self, destination, expected_response=True):
         """
@@ -195,6 +401,7 @@ class Controller:
         except KeyboardInterrupt:
             pass
         finally:
+            self.loop.run_until_complete(self.receptor.buffer_mgr.close())
             self.loop.stop()
 
     def cleanup_tmpdir(self):
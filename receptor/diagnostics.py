@@ -132,6 +132,10 @@ async def status(receptor_object):
             for conn in connections
         ]
         doc["routes"] = format_router(receptor_object.router)
+        try:
+            doc["buffers"] = await receptor_object.buffer_mgr.summary()
+        except Exception:
+            logger.exception("failed to summarize buffers")
         doc["tasks"] = tasks()
         doc["metrics"] = generate_latest()
         try:
@@ -0,0 +1,86 @@
+import asyncio
+import collections
+import logging
+import time
+
+from .stats import dispatch_active_gauge, dispatch_queued_gauge, dispatch_wait_seconds
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    """
+    Runs message handlers with bounded concurrency, sharing the slots fairly
+    between flows.
+
+    Each submitted handler belongs to a flow, such as a (sender, directive)
+    pair.  Flows with handlers waiting take turns, one handler each per
+    round, so a flow that submits thousands of messages delays the others
+    by at most one handler per round rather than by its whole backlog.  At
+    most concurrency handlers run at once, and at most flow_limit of them
+    from one flow, so long running handlers from one flow cannot hold every
+    slot.  The handlers of an ordered flow run one at a time, in the order
+    they were submitted.
+    """
+
+    def __init__(self, concurrency=256, flow_limit=None):
+        self.concurrency = max(1, concurrency)
+        self.flow_limit = flow_limit or max(1, self.concurrency // 2)
+        self._flows = collections.OrderedDict()
+        self._ordered = set()
+        self._running = collections.Counter()
+        self.active = 0
+        self.queued = 0
+
+    def submit(self, flow, handler, ordered=False):
+        """
+        Queues handler, a coroutine function taking no arguments, to run as
+        part of flow once it has a turn and a free slot.  With ordered, the
+        flow's handlers wait for each other.
+        """
+        if ordered:
+            self._ordered.add(flow)
+        self._flows.setdefault(flow, collections.deque()).append((time.monotonic(), handler))
+        self.queued += 1
+        dispatch_queued_gauge.inc()
+        self._pump()
+
+    def _next(self):
+        for flow in self._flows:
+            limit = 1 if flow in self._ordered else self.flow_limit
+            if self._running[flow] < limit:
+                waiting = self._flows.pop(flow)
+                item = waiting.popleft()
+                if waiting:
+                    self._flows[flow] = waiting  # to the back of the round
+                return flow, item
+        return None
+
+    def _pump(self):
+        while self.active < self.concurrency:
+            chosen = self._next()
+            if chosen is None:
+                return
+            flow, (queued_at, handler) = chosen
+            self.queued -= 1
+            self.active += 1
+            self._running[flow] += 1
+            dispatch_queued_gauge.dec()
+            dispatch_active_gauge.inc()
+            dispatch_wait_seconds.observe(time.monotonic() - queued_at)
+            asyncio.ensure_future(self._run(flow, handler))
+
+    async def _run(self, flow, handler):
+        try:
+            await handler()
+        except Exception:
+            logger.exception("Dispatched handler for %s failed", flow)
+        finally:
+            self.active -= 1
+            self._running[flow] -= 1
+            if not self._running[flow]:
+                del self._running[flow]
+                if flow not in self._flows:
+                    self._ordered.discard(flow)
+            dispatch_active_gauge.dec()
+            self._pump()
@@ -1,10 +1,12 @@
 import asyncio
 import logging
+import signal
 import sys
 import time
 
 from prometheus_client import start_http_server
 
+from . import shards as sharding
 from .controller import Controller
 
 logger = logging.getLogger(__name__)
@@ -22,28 +24,52 @@ def run_as_node(config):
         ) * config.node_keepalive_interval
         controller.loop.call_at(absolute_call_time, controller.loop.create_task, node_keepalive())
 
+    shard, shards = config.node_shard, max(1, config.node_shards)
+    node_id = config.default_node_id
+    if shard:
+        config._config_options["default_node_id"].value = sharding.shard_node_id(node_id, shard)
+    procs = []
     try:
         controller = Controller(config)
         logger.info(f"Running as Receptor node with ID: {controller.receptor.node_id}")
+        node_id = node_id or controller.receptor.node_id
         if config.node_stats_enable:
-            logger.info(f"Starting stats on port {config.node_stats_port}")
-            start_http_server(config.node_stats_port)
-        if not config.node_server_disable:
-            listen_tasks = controller.enable_server(config.node_listen)
+            logger.info(f"Starting stats on port {config.node_stats_port + shard}")
+            start_http_server(config.node_stats_port + shard)
+        listen = [] if config.node_server_disable else list(config.node_listen)
+        peers = sharding.shard_peers(config.node_peers, shard, shards)
+        if shards > 1:
+            data_dir = config.default_data_dir
+            listen.append(sharding.shard_listen_url(data_dir, node_id, shard))
+            for peer in sharding.shard_peer_urls(data_dir, node_id, shard):
+                controller.add_peer(peer)
+        if listen:
+            listen_tasks = controller.enable_server(listen)
             controller.loop.create_task(controller.exit_on_exceptions_in(listen_tasks))
-        for peer in config.node_peers:
+        for peer in peers:
             controller.add_peer(
                 peer,
                 ws_extra_headers=config.node_ws_extra_headers,
                 ws_heartbeat=config.node_ws_heartbeat,
+                streams=config.node_peer_streams,
             )
         if config.node_keepalive_interval > 1:
             controller.loop.create_task(node_keepalive())
+        controller.loop.create_task(controller.receptor.buffer_mgr.recover())
         controller.loop.create_task(
             controller.receptor.connection_manifest.watch_expire(controller.receptor.buffer_mgr)
         )
+        if shard:
+            controller.loop.create_task(sharding.watch_parent(controller.receptor))
+        elif shards > 1:
+            procs = sharding.spawn_shards(config._args, node_id, shards)
+            # Shut down rather than die on SIGTERM, so the other shards stop too
+            controller.loop.add_signal_handler(
+                signal.SIGTERM, setattr, controller.receptor, "stop", True
+            )
         controller.run()
     finally:
+        sharding.stop_shards(procs)
         controller.cleanup_tmpdir()
 
 
@@ -133,31 +159,32 @@ def run_as_send(config):
             data = sys.stdin.buffer.read()
         else:
             data = config.send_payload
-        await controller.send(
-            payload=data, recipient=config.send_recipient, directive=config.send_directive
+        responses.set_result(
+            await controller.send(
+                payload=data,
+                recipient=config.send_recipient,
+                directive=config.send_directive,
+                stream=True,
+            )
         )
 
     async def read_responses():
-        while True:
-            message = await controller.recv()
+        async for message in await responses:
             logger.debug(f"{message}")
-            if message.header.get("in_response_to", None):
-                logger.debug("Received response message")
-                if message.header.get("eof", False):
-                    logger.info("Received EOF")
-                    if message.header.get("code", 0) != 0:
-                        logger.error(f"EOF was an error result")
-                        if message.payload:
-                            print(f"ERROR: {message.payload.readall().decode()}")
-                        else:
-                            print(f"No EOF Error Payload")
-                    break
+            if message.header.get("eof", False):
+                logger.info("Received EOF")
+                if message.header.get("code", 0) != 0:
+                    logger.error(f"EOF was an error result")
+                    if message.payload:
+                        print(f"ERROR: {message.payload.readall().decode()}")
+                    else:
+                        print(f"No EOF Error Payload")
                 elif message.payload:
                     print(message.payload.readall().decode())
-                else:
-                    print("---")
+            elif message.payload:
+                print(message.payload.readall().decode())
             else:
-                logger.warning(f"Received unknown message {message}")
+                print("---")
 
     try:
         logger.info(
@@ -165,6 +192,7 @@ def run_as_send(config):
                 via {config.send_peer}"""
         )
         controller = Controller(config)
+        responses = controller.loop.create_future()
         controller.run(send_entrypoint)
     finally:
         controller.cleanup_tmpdir()
@@ -6,6 +6,10 @@ class ReceptorBufferError(ReceptorRuntimeError):
     pass
 
 
+class ResponseOverflowError(ReceptorRuntimeError):
+    pass
+
+
 class ReceptorMessageError(ValueError):
     pass
 
@@ -0,0 +1,179 @@
+"""
+Merging the responses to a multicast on their way back to its sender.
+
+A message multicast with the "gather" header asks the relays that fan it
+out to gather the responses coming back through them.  Instead of
+forwarding each response on its own, a relay holds the responses to the
+request for up to a short delay, or until they reach a size bound or the
+last recipient behind the relay has finished, and forwards them as one
+batch message.  Batches passing through a relay further up the tree are
+merged into its own batches in the same way.
+
+A batch is a response to the request with a "batch" header giving the
+number of responses it carries and an "eofs" header giving how many of
+them end the request for a recipient.  Its payload is the responses one
+after another in their wire format, which unpack() turns back into
+messages at the sender.
+"""
+import asyncio
+import datetime
+import logging
+
+from .messages.framed import FileBackedBuffer, FramedBuffer, FramedMessage
+from .responses import DEFAULT_TIMEOUT, eofs_in
+from .stats import gathered_responses_counter
+
+logger = logging.getLogger(__name__)
+
+
+def responses_in(msg):
+    return msg.header.get("batch") or 1
+
+
+def eofs_within(msg):
+    return msg.header["eofs"] if "batch" in msg.header else eofs_in(msg)
+
+
+async def unpack(batch, chunksize=2 ** 12):
+    """Returns the responses carried in batch, in the order they were gathered."""
+    buf = FramedBuffer()
+    batch.payload.seek(0)
+    # Fed a chunk at a time: the parser recurses for each frame in a chunk
+    for chunk in iter(lambda: batch.payload.read(chunksize), b""):
+        await buf.put(chunk)
+    responses = []
+    while not buf.q.empty():
+        responses.append(buf.get_nowait())
+    if len(responses) != batch.header["batch"]:
+        logger.warning(
+            "Batch of responses to %s held %d of %d responses",
+            batch.header["in_response_to"],
+            len(responses),
+            batch.header["batch"],
+        )
+    return responses
+
+
+class _Gathering:
+    __slots__ = ("sender", "eofs", "held", "size", "timer", "expiry", "sending")
+
+    def __init__(self, sender, eofs):
+        self.sender = sender
+        self.eofs = eofs
+        self.held = []
+        self.size = 0
+        self.timer = None
+        self.expiry = None
+        self.sending = None
+
+
+class Gatherer:
+    """
+    The requests this node is gathering responses to, and the responses
+    held for each.  Held responses are sent on once the first of them has
+    waited delay seconds, or once they add up to max_bytes, each batch
+    after the one before it.
+    """
+
+    def __init__(self, router, delay=0.05, max_bytes=2 ** 20, timeout=DEFAULT_TIMEOUT):
+        self.router = router
+        self.delay = delay
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._gathering = {}
+
+    def expect(self, msg, recipients):
+        """
+        Starts gathering the responses to the multicast msg from the number
+        of recipients it is being sent on to from here.
+        """
+        if msg.msg_id in self._gathering:
+            return
+        gathering = self._gathering[msg.msg_id] = _Gathering(msg.header["sender"], recipients)
+        if self.timeout:
+            gathering.expiry = asyncio.get_event_loop().call_later(
+                self.timeout, self._finish, msg.msg_id
+            )
+
+    def __contains__(self, msg_id):
+        return msg_id in self._gathering
+
+    def gather(self, msg):
+        """
+        Holds msg, a response or batch of responses on its way to its
+        request's sender, if this node is gathering them.  Returns False if
+        it is not, and the message should be forwarded as usual.
+        """
+        msg_id = msg.header["in_response_to"]
+        gathering = self._gathering.get(msg_id)
+        if gathering is None or msg.header.get("recipient") != gathering.sender:
+            return False
+        gathering.held.append(msg)
+        gathering.size += len(msg.payload or ()) + 256
+        gathering.eofs -= eofs_within(msg)
+        if gathering.eofs <= 0:
+            self._finish(msg_id)
+        elif gathering.size >= self.max_bytes:
+            self._flush(msg_id, gathering)
+        elif gathering.timer is None:
+            gathering.timer = asyncio.get_event_loop().call_later(
+                self.delay, self._flush, msg_id, gathering
+            )
+        return True
+
+    def _finish(self, msg_id):
+        gathering = self._gathering.pop(msg_id, None)
+        if gathering is None:
+            return
+        if gathering.expiry is not None:
+            gathering.expiry.cancel()
+        self._flush(msg_id, gathering)
+
+    def _flush(self, msg_id, gathering):
+        if gathering.timer is not None:
+            gathering.timer.cancel()
+            gathering.timer = None
+        held, gathering.held, gathering.size = gathering.held, [], 0
+        if not held:
+            return
+        msg = held[0] if len(held) == 1 else self._batch(msg_id, gathering.sender, held)
+        next_hop = self.router.next_hop(gathering.sender)
+        if next_hop is None:
+            logger.warning(f"No route to {gathering.sender} for responses to {msg_id}")
+            return
+        gathering.sending = asyncio.ensure_future(self._forward(gathering.sending, msg, next_hop))
+
+    async def _forward(self, previous, msg, next_hop):
+        # A batch is only queued once the one flushed before it has been,
+        # so that the request's responses and its eofs keep their order.
+        if previous is not None:
+            await asyncio.wait([previous])
+        await self.router.forward(msg, next_hop, gather=False)
+
+    def _batch(self, msg_id, sender, held):
+        payload = FileBackedBuffer.from_temp()
+        for msg in held:
+            if "batch" in msg.header:
+                # Merge its responses rather than nesting the batch
+                msg.payload.seek(0)
+                for chunk in iter(lambda: msg.payload.read(2 ** 16), b""):
+                    payload.write(chunk)
+            else:
+                for chunk in msg:
+                    payload.write(chunk)
+        payload.flush()
+        count = sum(responses_in(msg) for msg in held)
+        gathered_responses_counter.inc(count)
+        logger.debug(f"Sending {count} responses to {msg_id} on to {sender} as one batch")
+        return FramedMessage(
+            header=dict(
+                sender=self.router.node_id,
+                recipient=sender,
+                route_list=[self.router.node_id],
+                in_response_to=msg_id,
+                timestamp=datetime.datetime.utcnow(),
+                batch=count,
+                eofs=sum(eofs_within(msg) for msg in held),
+            ),
+            payload=payload,
+        )
@@ -0,0 +1,146 @@
+import bisect
+import hashlib
+import heapq
+import logging
+
+logger = logging.getLogger(__name__)
+
+# How much an extra unit of path cost, about one hop, counts against a
+# member compared to the share of its work threads that are busy
+COST_WEIGHT = 0.1
+
+
+def _point(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    A consistent hash ring over a set of nodes, each placed at replicas
+    points.  A key belongs to the node at the first point after the key's
+    hash, so when a node leaves, only the keys that belonged to it move,
+    spread over the others, and when one joins it only takes keys over.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        points = sorted((_point(f"{node}#{n}"), node) for node in nodes for n in range(replicas))
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+        self.members = frozenset(nodes)
+
+    def get(self, key, exclude=()):
+        """
+        Returns the node key belongs to, or if that is in exclude, the next
+        node round the ring that is not.  Returns None if there is none.
+        """
+        if not self._nodes:
+            return None
+        start = bisect.bisect(self._points, _point(str(key)))
+        seen = set()
+        for n in range(len(self._nodes)):
+            node = self._nodes[(start + n) % len(self._nodes)]
+            if node not in exclude:
+                return node
+            seen.add(node)
+            if len(seen) == len(self.members):
+                break
+        return None
+
+
+def load_of(caps):
+    """Returns the share of a node's work threads that are busy, from its capabilities."""
+    return caps.get("active_work", 0) / max(1, caps.get("max_work_threads") or 1)
+
+
+class GroupIndex:
+    """
+    The members of each node group, ordered by how good a choice each is
+    for the next message sent to the group: the share of its work threads
+    in use plus COST_WEIGHT per unit of path cost from here.
+
+    The index is built from the advertised capabilities and the routing
+    table when a group is first used after either changes, so choosing a
+    member only looks at the top of a heap.  Each choice also counts the
+    message against the chosen member until its next advertisement, which
+    spreads a burst of messages across members rather than sending them
+    all to whichever was idle when it last advertised.
+
+    Messages with an affinity key are placed with a hash ring per group
+    instead, which is only rebuilt when the group's members change.
+    """
+
+    def __init__(self, receptor):
+        self.receptor = receptor
+        self._heaps = None
+        self._members = {}
+        self._rings = {}
+
+    def invalidate(self):
+        """Called when capabilities or routes change."""
+        self._heaps = None
+
+    def _build(self):
+        router = self.receptor.router
+        heaps = {}
+        for node, info in list(self.receptor.known_nodes.items()):
+            caps = info["capabilities"]
+            if node == self.receptor.node_id:
+                cost = 0
+            elif node in router.routing_table:
+                cost = router.routing_table[node][1]
+            else:
+                continue  # no route, so not a candidate
+            step = 1 / max(1, caps.get("max_work_threads") or 1)
+            for group in caps.get("groups", ()):
+                heaps.setdefault(group, []).append([load_of(caps) + COST_WEIGHT * cost, node, step])
+        for heap in heaps.values():
+            heapq.heapify(heap)
+        self._heaps = heaps
+        self._members = {
+            group: frozenset(node for _, node, _ in heap) for group, heap in heaps.items()
+        }
+
+    def members(self, group):
+        """Returns the reachable members of group, best first."""
+        if self._heaps is None:
+            self._build()
+        return [node for _, node, _ in sorted(self._heaps.get(group, ()))]
+
+    def affinity(self, group, key, exclude=()):
+        """
+        Returns the member of group that key maps to on the group's hash
+        ring, skipping round the ring past members in exclude.  Every node
+        that knows the same members maps a key to the same member, and the
+        key stays there for as long as that member is reachable.
+        """
+        if self._heaps is None:
+            self._build()
+        members = self._members.get(group, frozenset())
+        ring = self._rings.get(group)
+        if ring is None or ring.members is not members:
+            if ring is None or ring.members != members:
+                ring = self._rings[group] = HashRing(members)
+            ring.members = members  # unchanged by the rebuild, skip comparing next time
+        return ring.get(key, exclude)
+
+    def choose(self, group, exclude=()):
+        """
+        Returns the best reachable member of group not in exclude, or None
+        if there is none.
+        """
+        if self._heaps is None:
+            self._build()
+        heap = self._heaps.get(group)
+        if not heap:
+            return None
+        skipped = []
+        while heap and heap[0][1] in exclude:
+            skipped.append(heapq.heappop(heap))
+        chosen = None
+        if heap:
+            entry = heap[0]
+            chosen = entry[1]
+            heapq.heapreplace(heap, [entry[0] + entry[2], entry[1], entry[2]])
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return chosen
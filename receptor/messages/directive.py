@@ -1,4 +1,6 @@
 import datetime
+import inspect
+import json
 import logging
 
 from ..exceptions import UnknownDirective
@@ -14,23 +16,35 @@ class Directive:
 
 
 class Control:
-    CONTROL_DIRECTIVES = ["ping"]
+    CONTROL_DIRECTIVES = ["ping", "steal"]
 
     async def __call__(self, router, msg):
         _, action = msg.header["directive"].split(":", 1)
         if action not in self.CONTROL_DIRECTIVES:
             raise UnknownDirective(f"Unknown control directive: {action}")
         action_method = getattr(self, action)
+        responses = action_method(router.receptor, msg)
+        if not inspect.isasyncgen(responses):
+            await responses  # an action that sends no response
+            return
+        # Responses are sent one behind so that the last can be marked eof,
+        # which lets the sender forget the request
         serial = 0
-        async for response in action_method(router.receptor, msg):
-            serial += 1
-            resp_msg = FramedMessage(
-                header=dict(
-                    recipient=msg.header["sender"], in_response_to=msg.msg_id, serial=serial
-                ),
-                payload=FileBackedBuffer.from_dict(response),
-            )
-            await router.send(resp_msg)
+        previous = None
+        async for response in responses:
+            if previous is not None:
+                serial += 1
+                await router.send(self._response(msg, serial, previous))
+            previous = response
+        if previous is not None:
+            await router.send(self._response(msg, serial + 1, previous, eof=True))
+
+    @staticmethod
+    def _response(msg, serial, response, eof=False):
+        header = dict(recipient=msg.header["sender"], in_response_to=msg.msg_id, serial=serial)
+        if eof:
+            header["eof"] = True
+        return FramedMessage(header=header, payload=FileBackedBuffer.from_dict(response))
 
     async def ping(self, receptor, msg):
         logger.info(f'Received ping from {msg.header["sender"]}')
@@ -40,5 +54,10 @@ class Control:
             active_work=receptor.work_manager.get_work(),
         )
 
+    async def steal(self, receptor, msg):
+        request = json.loads(msg.payload.readall())
+        logger.info(f'{msg.header["sender"]} asked for up to {request["count"]} queued messages')
+        await receptor.work_manager.give_away(msg.header["sender"], request["count"])
+
 
 control = Control()
@@ -205,7 +205,7 @@ class FramedMessage:
     def __repr__(self):
         return f"FramedMessage(msg_id={self.msg_id}, header={self.header}, payload={self.payload})"
 
-    def __iter__(self):
+    def _header_frames(self):
         header_bytes = json.dumps(self.header).encode("utf-8")
         yield Frame.wrap(
             header_bytes,
@@ -215,6 +215,10 @@ class FramedMessage:
         yield header_bytes
         if self.payload:
             yield Frame.wrap(self.payload, msg_id=self.msg_id).serialize()
+
+    def __iter__(self):
+        yield from self._header_frames()
+        if self.payload:
             self.payload.seek(0)
             reader = functools.partial(self.payload.read, size=self.payload.chunksize)
             for chunk in iter(reader, b""):
@@ -223,6 +227,13 @@ class FramedMessage:
     def serialize(self):
         return b"".join(self)
 
+    def serialize_header(self):
+        """
+        Returns everything serialize() would except the payload bytes, which
+        follow immediately after on the wire.
+        """
+        return b"".join(self._header_frames())
+
 
 class FramedBuffer:
     """
@@ -231,11 +242,22 @@ class FramedBuffer:
 
     This buffer assumes that an entire message (denoted by msg_id) will be
     sent before another message is sent.
+
+    Messages count against max_pending bytes from the time they are parsed
+    until release() is called for them.  The buffer keeps accepting data past
+    the limit; readers are expected to check has_room() and stop reading from
+    the connection until wait_for_room() returns.
     """
 
-    def __init__(self, loop=None):
+    def __init__(self, loop=None, max_pending=None):
         self.q = asyncio.Queue(loop=loop)
+        self.max_pending = max_pending
+        self.pending_bytes = 0
+        self._pending = {}
+        self._room = asyncio.Event(loop=loop)
+        self._room.set()
         self.header = None
+        self.header_length = 0
         self.framebuffer = bytearray()
         self.bb = FileBackedBuffer.from_temp()
         self.current_frame = None
@@ -274,21 +296,40 @@ class FramedBuffer:
         if self.current_frame.type == Frame.Types.HEADER:
             self.bb.seek(0)
             self.header = json.load(self.bb)
+            self.header_length = self.current_frame.length
         elif self.current_frame.type == Frame.Types.PAYLOAD:
-            await self.q.put(
-                FramedMessage(self.current_frame.msg_id, header=self.header, payload=self.bb)
-            )
+            msg = FramedMessage(self.current_frame.msg_id, header=self.header, payload=self.bb)
+            await self._enqueue(msg, self.header_length + self.current_frame.length)
             self.header = None
+            self.header_length = 0
         elif self.current_frame.type == Frame.Types.COMMAND:
             self.bb.seek(0)
-            await self.q.put(
-                FramedMessage(msg_id=self.current_frame.msg_id, header=json.load(self.bb))
-            )
+            msg = FramedMessage(msg_id=self.current_frame.msg_id, header=json.load(self.bb))
+            await self._enqueue(msg, self.current_frame.length)
         else:
             raise Exception("Unknown Frame Type")
         self.to_read = 0
         self.bb = FileBackedBuffer.from_temp()
 
+    async def _enqueue(self, msg, size):
+        self._pending[msg] = size
+        self.pending_bytes += size
+        if not self.has_room():
+            self._room.clear()
+        await self.q.put(msg)
+
+    def release(self, msg):
+        """Stops counting a message that has been handled against max_pending."""
+        self.pending_bytes -= self._pending.pop(msg, 0)
+        if self.has_room():
+            self._room.set()
+
+    def has_room(self):
+        return self.max_pending is None or self.pending_bytes < self.max_pending
+
+    async def wait_for_room(self):
+        await self._room.wait()
+
     async def get(self, timeout=None):
         return await asyncio.wait_for(self.q.get(), timeout)
 
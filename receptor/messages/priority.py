@@ -0,0 +1,52 @@
+"""
+Priority classes carried in the ``priority`` header of a message.
+
+The sender of a message may set the header explicitly, otherwise a class is
+derived from the shape of the message so that mesh-internal traffic (route
+advertisements, pings) and responses are never queued behind bulk work.
+"""
+from enum import IntEnum
+
+
+class Priority(IntEnum):
+    CONTROL = 0
+    INTERACTIVE = 1
+    BULK = 2
+
+    @property
+    def label(self):
+        return self.name.lower()
+
+    @classmethod
+    def from_label(cls, label, default=None):
+        """
+        Returns the Priority for a header value, accepting either the label
+        ("control") or the integer value.  Unknown values map to default.
+        """
+        if isinstance(label, cls):
+            return label
+        try:
+            if isinstance(label, str):
+                return cls[label.upper()]
+            return cls(label)
+        except (KeyError, ValueError, TypeError):
+            return cls.BULK if default is None else default
+
+
+def classify(header):
+    """
+    Returns the Priority a message should travel with, based on its header.
+    """
+    if not header:
+        return Priority.BULK
+    if "priority" in header:
+        return Priority.from_label(header["priority"])
+    if "cmd" in header:
+        return Priority.CONTROL
+    if header.get("directive", "").startswith("receptor:"):
+        return Priority.CONTROL
+    if "in_response_to" in header:
+        # The eof shares its lane with the responses before it so it cannot
+        # overtake them
+        return Priority.INTERACTIVE
+    return Priority.BULK
@@ -34,6 +34,19 @@ def plugin_export(payload_type):
     You can then send messages to this plugin across the Receptor mesh with the directive
     ``your_package_name:execute``
 
+    Functions like this run in a worker thread.  A plugin that spends its time waiting on I/O
+    can export an ``async def`` function or an async generator instead, which runs on the
+    node's event loop and takes no result queue.  An async generator's values are sent as
+    responses as they are yielded, and a coroutine's return value, unless it is None, is sent
+    as its only response::
+
+        @receptor.plugin_export(payload_type=receptor.BYTES_PAYLOAD)
+        async def fetch(message, config):
+            async with aiohttp.ClientSession() as session:
+                async with session.get(message.decode()) as response:
+                    async for chunk in response.content.iter_chunked(2 ** 16):
+                        yield chunk
+
     Depending on what kind of data you expect to receive you can select from one
     of 3 different incoming payload types. This determines the incoming type of the
     ``message`` data type:
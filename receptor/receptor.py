@@ -1,5 +1,7 @@
 import asyncio
 import collections
+import datetime
+import functools
 import json
 import logging
 import os
@@ -8,14 +10,19 @@ import uuid
 
 import pkg_resources
 
-from . import exceptions, fileio, stats
+from . import exceptions, fileio, gather, shards, stats
+from .connection.base import HANDSHAKE_VERSION, LINK_FEATURES
 from .buffers.file import FileBufferManager
+from .buffers.sqlite import SQLiteBufferManager
+from .dispatch import Dispatcher
 from .exceptions import ReceptorMessageError
 from .messages import directive, framed
 from .router import MeshRouter
 from .work import WorkManager
 
 RECEPTOR_DIRECTIVE_NAMESPACE = "receptor"
+# The capabilities that make up a node's load, see send_load
+LOAD_KEYS = ("active_work", "queue_depth")
 logger = logging.getLogger(__name__)
 
 
@@ -83,18 +90,44 @@ class Receptor:
         self.node_id = node_id or self.config.default_node_id or self._find_node_id()
         self.router = (router_cls or MeshRouter)(self)
         self.route_sender_task = None
+        self.load_advertiser_task = None
+        self.load_seq = 0
+        self.last_sent_load = None
         self.route_send_time = time.time()
         self.last_sent_seq = None
         self.route_adv_seen = dict()
         self.work_manager = (work_manager_cls or WorkManager)(self)
+        self.dispatcher = Dispatcher(self.config.node_dispatch_concurrency)
         self.connections = dict()
+        # Shares each peer's outbound buffer between its connections
+        self.outbound_stripes = dict()
         self.response_queue = response_queue
         self.base_path = os.path.join(self.config.default_data_dir, self.node_id)
         if not os.path.exists(self.base_path):
             os.makedirs(os.path.join(self.config.default_data_dir, self.node_id))
         self.connection_manifest = Manifest(os.path.join(self.base_path, "connection_manifest"))
         path = os.path.join(os.path.expanduser(self.base_path))
-        self.buffer_mgr = FileBufferManager(path)
+        if self.config.default_buffer_backend == "sqlite":
+            self.buffer_mgr = SQLiteBufferManager(
+                path, ttl=self.config.default_message_ttl, on_expire=self.message_expired
+            )
+        elif self.config.default_buffer_backend == "file":
+            self.buffer_mgr = FileBufferManager(
+                path,
+                ttl=self.config.default_message_ttl,
+                on_expire=self.message_expired,
+                verify=bool(self.config.default_verify_buffers),
+            )
+        else:
+            raise exceptions.ReceptorConfigError(
+                f"Unknown buffer backend {self.config.default_buffer_backend}"
+            )
+        self.shard_handover = None
+        if self.config.node_shards > 1:
+            siblings = shards.sibling_ids(
+                self.node_id, self.config.node_shard, self.config.node_shards
+            )
+            self.shard_handover = shards.Handover(self, siblings)
         self.stop = False
         self.known_nodes = collections.defaultdict(
             lambda: dict(capabilities=dict(), sequence=0, seq_epoch=0.0, connections=dict())
@@ -130,10 +163,48 @@ class Receptor:
                 logger.exception("message_handler")
                 break
             else:
-                if "cmd" in data.header and data.header["cmd"].startswith("ROUTE"):
-                    await self.handle_route_advertisement(data.header)
+                if data.header.get("cmd") == "HEARTBEAT":
+                    buf.release(data)  # only there to show the link is alive
+                elif "cmd" in data.header and data.header["cmd"].startswith("ROUTE"):
+                    await self._handle_advertisement(self.handle_route_advertisement, data, buf)
+                elif data.header.get("cmd") == "LOAD":
+                    await self._handle_advertisement(self.handle_load_advertisement, data, buf)
                 else:
-                    asyncio.ensure_future(self.handle_message(data))
+                    self.dispatch(data, buf)
+
+    async def _handle_advertisement(self, handler, data, buf):
+        try:
+            await handler(data.header)
+        except Exception:
+            # Logged rather than raised: it would end the connection's message_handler
+            logger.exception("Error handling %s from %s", data.header["cmd"], data.header.get("id"))
+        finally:
+            buf.release(data)
+
+    def dispatch(self, msg, buf=None):
+        """
+        Queues msg, received into buf or sent from this node, to be handled
+        by the dispatcher.
+
+        Every message holds its ingress space and a dispatcher slot until it
+        is handled.  For work that means until the work manager gives it a
+        thread and starts it, not until it finishes; the work manager bounds
+        it from there.  Anything else is handled in order, so that a
+        request's responses and its eof cannot overtake each other on the
+        way through.
+        """
+        local_work = msg.header.get("recipient") == self.node_id and "directive" in msg.header
+        flow = (msg.header.get("sender"), msg.header.get("directive"), local_work)
+        self.dispatcher.submit(
+            flow, functools.partial(self._dispatch, buf, msg), ordered=not local_work
+        )
+
+    async def _dispatch(self, buf, msg):
+        try:
+            await self.handle_message(msg)
+        finally:
+            if buf is not None:
+                buf.release(msg)
 
     async def update_connections(self, protocol_obj, id_=None):
         if id_ is None:
@@ -148,6 +219,7 @@ class Receptor:
             self.connections[id_] = [protocol_obj]
             routing_changed = True
         await self.connection_manifest.update(id_)
+        stats.peer_streams_gauge.labels(id_).set(len(self.connections[id_]))
 
         if routing_changed:
             await self.recalculate_and_send_routes_soon()
@@ -172,11 +244,12 @@ class Receptor:
             if protocol_obj in self.connections[connection_node]:
                 routing_changed = True
                 logger.info(f"Removing connection for node {connection_node}")
-                if self.is_ephemeral(connection_node):
-                    self.connections[connection_node].remove(protocol_obj)
+                self.connections[connection_node].remove(protocol_obj)
+                remaining = len(self.connections[connection_node])
+                stats.peer_streams_gauge.labels(connection_node).set(remaining)
+                if self.is_ephemeral(connection_node) and not remaining:
                     await self.remove_ephemeral(connection_node)
                 else:
-                    self.connections[connection_node].remove(protocol_obj)
                     await self.connection_manifest.update(connection_node)
         if routing_changed:
             await self.recalculate_and_send_routes_soon()
@@ -201,16 +274,15 @@ class Receptor:
             await asyncio.sleep(1)
 
     def _say_hi(self):
+        # Capabilities travel in route advertisements, so the HI only
+        # identifies the node and the link features it supports
         return framed.FramedMessage(
             header={
                 "cmd": "HI",
                 "id": self.node_id,
-                "expire_time": time.time() + 10,
-                "meta": dict(
-                    capabilities=self.work_manager.get_capabilities(),
-                    groups=self.config.node_groups,
-                    work=self.work_manager.get_work(),
-                ),
+                "version": HANDSHAKE_VERSION,
+                "features": sorted(LINK_FEATURES),
+                "heartbeat": self.config.node_heartbeat_interval,
             }
         )
 
@@ -241,15 +313,23 @@ class Receptor:
         else:
             self.router.add_or_update_edges(new_edges, replace_all=True)
             logger.debug(f"   Routing updated. New table: {self.router.get_edges()}")
+            if self.shard_handover is not None:
+                asyncio.ensure_future(self.shard_handover.run())
             return True
 
-    async def send_routes(self):
-        """Send routing update to connected peers"""
+    async def send_routes(self, node_ids=None):
+        """
+        Send routing update to connected peers, or only to node_ids.  An
+        update sent to some peers leaves the others to the next full round.
+        """
         route_adv_id = str(uuid.uuid4())
         seq = self.known_nodes[self.node_id]["sequence"] + 1
         self.known_nodes[self.node_id]["sequence"] = seq
         logger.debug(f"Sending route advertisement {route_adv_id} seq {seq}")
-        self.last_sent_seq = seq
+        if node_ids is None:
+            self.last_sent_seq = seq
+            # A copy, as peers may connect or leave while the update is queued
+            node_ids = list(self.connections)
 
         advertised_connections = dict()
         for node1, node2, cost in self.router.get_edges():
@@ -260,8 +340,8 @@ class Receptor:
                 advertised_connections[other_node] = cost
         logger.debug(f"   Advertised connections: {advertised_connections}")
 
-        for node_id in self.connections:
-            if not self.connections[node_id]:
+        for node_id in node_ids:
+            if not self.connections.get(node_id):
                 continue
             buf = self.buffer_mgr[node_id]
             try:
@@ -281,7 +361,7 @@ class Receptor:
                         },
                     }
                 )
-                await buf.put(msg.serialize())
+                await buf.put(msg)
                 logger.debug(f"   Sent to {node_id}")
             except Exception as e:
                 logger.exception("Error trying to send route update: {}".format(e))
@@ -303,6 +383,69 @@ class Receptor:
         if not self.route_sender_task:
             self.route_sender_task = asyncio.ensure_future(self.route_send_check(force_send))
 
+    def load_changed(self):
+        """
+        Called when work starts, finishes or queues.  The new load is advertised
+        at most once every node_load_interval seconds.
+        """
+        caps = self.known_nodes[self.node_id]["capabilities"]
+        caps["active_work"] = len(self.work_manager.active_work)
+        caps["queue_depth"] = len(self.work_manager.pending)
+        self.router.groups.invalidate()
+        if self.load_advertiser_task is None:
+            self.load_advertiser_task = asyncio.ensure_future(self._advertise_load())
+
+    async def _advertise_load(self):
+        await asyncio.sleep(self.config.node_load_interval)
+        self.load_advertiser_task = None
+        await self.send_load()
+
+    async def send_load(self):
+        """
+        Sends this node's load, and nothing else, to every node.  Unlike a
+        route advertisement it does not grow with the mesh.  Peers whose
+        link lacks the "load" feature see the load with the next routes.
+        """
+        caps = self.known_nodes[self.node_id]["capabilities"]
+        load = {key: caps[key] for key in LOAD_KEYS if key in caps}
+        if load == self.last_sent_load:
+            return
+        self.last_sent_load = load
+        self.load_seq += 1
+        await self._flood_load(
+            {
+                "cmd": "LOAD",
+                "origin": self.node_id,
+                "seq_epoch": self.known_nodes[self.node_id]["seq_epoch"],
+                "load_seq": self.load_seq,
+                "load": load,
+            }
+        )
+
+    async def _flood_load(self, data, came_from=None):
+        for conn in list(self.connections):
+            if conn in (came_from, data["origin"]) or not self.router.link_supports(conn, "load"):
+                continue
+            try:
+                msg = framed.FramedMessage(header=dict(data, id=self.node_id, recipient=conn))
+                await self.buffer_mgr[conn].put(msg)
+            except Exception as e:
+                logger.exception("Error trying to send load update: {}".format(e))
+
+    async def handle_load_advertisement(self, data):
+        origin = data["origin"]
+        if origin == self.node_id or origin not in self.known_nodes:
+            return  # a node is only tracked once its routes have arrived
+        known = self.known_nodes[origin]
+        seq = (data["seq_epoch"], data["load_seq"])
+        if seq <= known.get("load_seq", (0.0, 0)):
+            return  # already seen, or older than one that has been
+        known["load_seq"] = seq
+        known["capabilities"].update(data["load"])
+        self.router.groups.invalidate()
+        self.work_manager.maybe_steal()
+        await self._flood_load(data, came_from=data["id"])
+
     async def handle_route_advertisement(self, data):
 
         # Sanity checks of the message
@@ -344,23 +487,33 @@ class Receptor:
         if origin not in self.known_nodes:
             await self.recalculate_and_send_routes_soon(force_send=True)
 
-        # Check that the epoch and sequence epoch are not older than what we already have
+        # Check that the epoch and sequence epoch are not older than what we already have.
+        # A node that restarts begins a new epoch and counts its sequence from 1 again.
         if origin in self.known_nodes and (
-            self.known_nodes[origin]["seq_epoch"] > data["seq_epoch"]
-            or self.known_nodes[origin]["sequence"] >= data["sequence"]
-        ):
+            self.known_nodes[origin]["seq_epoch"],
+            self.known_nodes[origin]["sequence"],
+        ) >= (data["seq_epoch"], data["sequence"]):
             logger.warn(
                 f"Ignoring routing update {data['route_adv_id']} from {origin} "
                 + f"epoch {data['seq_epoch']} seq {data['sequence']} because we already have "
                 + f"epoch {self.known_nodes[origin]['seq_epoch']} "
-                + f"seq {self.known_nodes[origin['sequence']]}"
+                + f"seq {self.known_nodes[origin]['sequence']}"
             )
             return
 
         # TODO: don't just assume this is all correct
         if "node_capabilities" in data:
             for node, caps in data["node_capabilities"].items():
-                self.known_nodes[node]["capabilities"] = caps
+                if node == self.node_id:
+                    continue
+                known = self.known_nodes[node]
+                if node != origin and "load_seq" in known:
+                    # The load sent by the node itself is fresher than origin's copy
+                    current = known["capabilities"]
+                    caps = dict(caps, **{k: current[k] for k in LOAD_KEYS if k in current})
+                known["capabilities"] = caps
+            self.router.groups.invalidate()
+            self.work_manager.maybe_steal()
 
         # Remove any orphaned leaf nodes
         unreachable = set()
@@ -384,7 +537,7 @@ class Receptor:
         await self.recalculate_routes()
 
         # Re-send the routing update to all our connections except the one it came in on
-        for conn in self.connections:
+        for conn in list(self.connections):
             if conn == data["id"]:
                 continue
             send_data = dict(data)
@@ -393,7 +546,7 @@ class Receptor:
                 send_data["id"] = self.node_id
                 send_data["recipient"] = conn
                 msg = framed.FramedMessage(header=send_data)
-                await buf.put(msg.serialize())
+                await buf.put(msg)
             except Exception as e:
                 logger.exception("Error trying to forward route broadcast: {}".format(e))
 
@@ -403,9 +556,16 @@ class Receptor:
             logger.debug(f"directive namespace is {namespace}")
             if namespace == RECEPTOR_DIRECTIVE_NAMESPACE:
                 await directive.control(self.router, msg)
+            elif msg.header.get("spillover") and self.work_manager.saturated(
+                msg.header["directive"]
+            ):
+                if not await self.router.spill(msg):
+                    await self.send_busy_response(msg)
             else:
                 # TODO: other namespace/work directives
-                await self.work_manager.handle(msg)
+                # Waits for a work thread but not for the work to finish,
+                # which would hold a dispatcher slot for the whole run
+                await self.work_manager.start(msg)
         except ReceptorMessageError as e:
             logger.error(f"Receptor Message Error '{e}''")
         except ValueError:
@@ -438,19 +598,94 @@ class Receptor:
             )
             await self.router.send(err_resp)
 
+    async def send_busy_response(self, msg):
+        group = msg.header["group"]
+        logger.info(f"Rejecting {msg.msg_id}: every member of group {group} is busy")
+        err_resp = framed.FramedMessage(
+            header=dict(
+                recipient=msg.header["sender"],
+                in_response_to=msg.msg_id,
+                serial=1,
+                code=1,
+                busy=True,
+                timestamp=datetime.datetime.utcnow(),
+                eof=True,
+            ),
+            payload=framed.FileBackedBuffer.from_data(f"Every member of group {group} is busy"),
+        )
+        await self.router.send(err_resp)
+
     async def handle_response(self, msg):
         logger.debug("handle_response: %s", msg)
+        if "batch" in msg.header:
+            for response in await gather.unpack(msg):
+                await self.handle_response(response)
+            return
         in_response_to = msg.header["in_response_to"]
-        if in_response_to in self.router.response_registry:
+        entry = self.router.response_registry.received(msg)
+        if entry is not None and entry["stream"] is not None:
+            if entry["stream"].put_nowait(msg):
+                return
+            logger.warning(
+                f"Stream for {in_response_to} is not being read, "
+                "delivering its responses to the response queue instead"
+            )
+            entry["stream"].overflow()
+            entry["stream"] = None
+            await self.response_queue.put(msg)
+        elif entry is not None:
             logger.info(f"Handling response to {in_response_to} with callback.")
             await self.response_queue.put(msg)
         else:
             logger.warning(f"Received response to {in_response_to} but no record of sent message.")
 
+    async def message_expired(self, item):
+        """Called by the outbound buffers when a queued message passes its deadline."""
+        stats.expired_messages_counter.inc()
+        if "sender" in item:
+            await self.send_expiry_response(item["sender"], item["msg_id"], item.get("covers"))
+
+    async def send_expiry_response(self, sender, msg_id, covers=None):
+        header = dict(
+            recipient=sender,
+            in_response_to=msg_id,
+            serial=1,
+            code=1,
+            expired=True,
+            timestamp=datetime.datetime.utcnow(),
+            eof=True,
+        )
+        if covers:
+            # a multicast copy, which expired for all the recipients it was carrying
+            header["covers"] = covers
+        err_resp = framed.FramedMessage(
+            header=header,
+            payload=framed.FileBackedBuffer.from_data(
+                f"Message expired in transit at node {self.node_id}"
+            ),
+        )
+        try:
+            await self.router.send(err_resp)
+        except exceptions.UnrouteableError:
+            logger.warning(f"Unable to notify {sender} that {msg_id} expired: no route")
+
     async def handle_message(self, msg):
         try:
             stats.messages_received_counter.inc()
 
+            deadline = msg.header.get("deadline")
+            if deadline is not None and deadline <= time.time():
+                logger.info(f"Dropping message {msg.msg_id}: deadline has passed")
+                stats.expired_messages_counter.inc()
+                if "directive" in msg.header:
+                    await self.send_expiry_response(
+                        msg.header["sender"], msg.msg_id, msg.header.get("recipients")
+                    )
+                return
+
+            if "recipients" in msg.header:
+                return await self.router.multicast(msg)
+
             if msg.header["recipient"] != self.node_id:
                 next_hop = self.router.next_hop(msg.header["recipient"])
                 return await self.router.forward(msg, next_hop)
@@ -0,0 +1,199 @@
+import asyncio
+import collections
+import logging
+
+from .exceptions import ResponseOverflowError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 3600.0
+
+
+def eofs_in(msg):
+    """
+    Returns how many of a request's recipients a response finishes.  A
+    response that ends the request for several recipients of a multicast
+    at once, such as an expiry, lists them in its "covers" header.
+    """
+    if not msg.header.get("eof"):
+        return 0
+    return len(msg.header.get("covers") or ()) or 1
+
+
+class ResponseStream:
+    """
+    The responses to one request, as an async iterator that ends after the
+    response marked eof, or for a request sent to several recipients, after
+    eofs of them.
+
+    Responses are buffered up to maxsize.  Delivery never waits for the
+    reader, since that would hold up every other response arriving on the
+    same connection, so once the buffer is full put_nowait() refuses the
+    response and the stream is closed with ResponseOverflowError.  A stream
+    that is closed before its eof, by close(), by overflowing or because no
+    response came for the registry's timeout, raises the error it was
+    closed with once its buffered responses have been read.
+
+    A stream compares equal to its message id, so it can be used wherever
+    the id returned by earlier versions of Controller.send was.
+    """
+
+    def __init__(self, msg_id, maxsize=64, done=False, eofs=1, loop=None):
+        self.msg_id = msg_id
+        self.maxsize = maxsize
+        self.done = done
+        self.eofs = eofs
+        self.error = None
+        self._items = collections.deque()
+        self._readable = asyncio.Event(loop=loop)
+        self._on_close = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._items:
+            if self.error is not None:
+                raise self.error
+            if self.done:
+                raise StopAsyncIteration
+            self._readable.clear()
+            await self._readable.wait()
+        return self._items.popleft()
+
+    def put_nowait(self, msg):
+        """
+        Adds a response for the reader.  Returns False, without adding it,
+        if the buffer is full.
+        """
+        if self.closed:
+            logger.debug("Dropping response to %s: stream closed", self.msg_id)
+            return True
+        if len(self._items) >= self.maxsize:
+            return False
+        self._items.append(msg)
+        self.eofs -= eofs_in(msg)
+        if self.eofs <= 0:
+            self.done = True
+        self._readable.set()
+        return True
+
+    def overflow(self):
+        """
+        Closes the stream because its reader has fallen maxsize responses
+        behind.  Its request stays registered, so the rest of its responses
+        can be delivered elsewhere.
+        """
+        self._on_close = None
+        self.close(
+            ResponseOverflowError(f"More than {self.maxsize} unread responses to {self.msg_id}")
+        )
+
+    @property
+    def closed(self):
+        return self.done or self.error is not None
+
+    def close(self, error=None):
+        """
+        Stops the stream.  Responses already buffered can still be read;
+        later ones are dropped.  With error, reading past the buffered
+        responses raises it.
+        """
+        if self.closed:
+            return
+        if error is None:
+            self.done = True
+        else:
+            self.error = error
+        self._readable.set()
+        if self._on_close is not None:
+            self._on_close(self.msg_id)
+
+    def __eq__(self, other):
+        if isinstance(other, ResponseStream):
+            return self.msg_id == other.msg_id
+        return self.msg_id == other
+
+    def __hash__(self):
+        return hash(self.msg_id)
+
+    def __str__(self):
+        return str(self.msg_id)
+
+    def __repr__(self):
+        return f"<ResponseStream {self.msg_id}>"
+
+
+class ResponseRegistry:
+    """
+    The requests sent from this node that are waiting for responses.
+
+    An entry goes away when its eof response arrives, or one from each of
+    its recipients for a multicast, when its stream is closed, or when no
+    response has arrived for timeout seconds, which closes its stream with
+    asyncio.TimeoutError.  Its on_done callback, if any, is called when it
+    goes.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self._entries = {}
+
+    def register(self, msg_id, sent_time, stream=None, on_done=None, eofs=1):
+        entry = dict(
+            message_sent_time=sent_time, stream=stream, timer=None, on_done=on_done, eofs=eofs
+        )
+        self._entries[msg_id] = entry
+        self._reset_timer(msg_id, entry)
+        if stream is not None:
+            stream._on_close = self.discard
+
+    def _reset_timer(self, msg_id, entry):
+        if entry["timer"] is not None:
+            entry["timer"].cancel()
+        if self.timeout:
+            entry["timer"] = asyncio.get_event_loop().call_later(self.timeout, self._expire, msg_id)
+
+    def _expire(self, msg_id):
+        entry = self._entries.pop(msg_id, None)
+        if entry is None:
+            return
+        logger.info("No response to %s for %ss, forgetting it", msg_id, self.timeout)
+        self._done(entry)
+        if entry["stream"] is not None:
+            entry["stream"].close(asyncio.TimeoutError(f"No response to {msg_id}"))
+
+    @staticmethod
+    def _done(entry):
+        if entry["on_done"] is not None:
+            entry["on_done"]()
+
+    def received(self, msg):
+        """
+        Records a response arriving and returns its request's entry, or None
+        if the request is unknown.
+        """
+        msg_id = msg.header["in_response_to"]
+        entry = self._entries.get(msg_id)
+        if entry is None:
+            return None
+        entry["eofs"] -= eofs_in(msg)
+        if entry["eofs"] <= 0:
+            self.discard(msg_id)
+        else:
+            self._reset_timer(msg_id, entry)
+        return entry
+
+    def discard(self, msg_id):
+        entry = self._entries.pop(msg_id, None)
+        if entry is None:
+            return
+        if entry["timer"] is not None:
+            entry["timer"].cancel()
+        self._done(entry)
+
+    def __contains__(self, msg_id):
+        return msg_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
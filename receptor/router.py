@@ -1,4 +1,3 @@
-import asyncio
 import datetime
 import heapq
 import itertools
@@ -7,7 +6,11 @@ import sys
 from collections import defaultdict
 
 from .exceptions import ReceptorBufferError, UnrouteableError
-from .messages.framed import FramedMessage
+from .gather import Gatherer
+from .groups import GroupIndex
+from .messages.framed import FileBackedBuffer, FramedMessage
+from .messages.priority import classify
+from .responses import DEFAULT_TIMEOUT, ResponseRegistry
 from .stats import route_counter, route_info
 
 logger = logging.getLogger(__name__)
@@ -58,7 +61,9 @@ class MeshRouter:
         self._nodes = set()
         self._edges = dict()
         self._neighbors = defaultdict(set)
-        self.response_registry = dict()
+        self.response_registry = ResponseRegistry(
+            receptor.config.default_response_timeout if receptor else DEFAULT_TIMEOUT
+        )
         self.receptor = receptor
         if node_id:
             self.node_id = node_id
@@ -66,6 +71,16 @@ class MeshRouter:
             self.node_id = receptor.node_id
         else:
             raise RuntimeError("Unknown node_id")
+        self.groups = GroupIndex(receptor) if receptor else None
+        if receptor:
+            self.gatherer = Gatherer(
+                self,
+                delay=receptor.config.node_gather_delay,
+                max_bytes=receptor.config.node_gather_bytes,
+                timeout=receptor.config.default_response_timeout,
+            )
+        else:
+            self.gatherer = Gatherer(self)
         self.routing_table = dict()
         route_info.info(dict(edges="()"))
 
@@ -166,6 +181,8 @@ class MeshRouter:
                 p = prev[p]
             new_routing_table[dest] = (p, cost[dest])
         self.routing_table = new_routing_table
+        if self.groups is not None:
+            self.groups.invalidate()
 
     def next_hop(self, recipient):
         """
@@ -190,10 +207,14 @@ class MeshRouter:
         )
         return await self.send(message, expected_response)
 
-    async def forward(self, msg, next_hop):
+    async def forward(self, msg, next_hop, gather=True):
         """
-        Forward a message on to the next hop closer to its destination
+        Forward a message on to the next hop closer to its destination.
+        Responses to a multicast this node is gathering for are held to be
+        sent on in a batch instead, unless gather is False.
         """
+        if gather and "in_response_to" in msg.header and self.gatherer.gather(msg):
+            return
         buffer_obj = self.receptor.buffer_mgr[next_hop]
         if "route_list" not in msg.header or msg.header["route_list"][-1] != self.node_id:
             msg.header["route_list"].append(self.node_id)
@@ -209,10 +230,27 @@ class MeshRouter:
         except Exception as e:
             logger.exception("Error trying to forward message to {}: {}".format(next_hop, e))
 
-    async def send(self, message, expected_response=False):
+    async def send(self, message, expected_response=False, stream=None, on_done=None):
         """
-        Send a new message with the given outer envelope.
+        Send a new message with the given outer envelope.  Responses to an
+        expected_response directive go to stream if one is given, and to
+        the receptor's response queue otherwise.  on_done is called once
+        the request is finished with, see ResponseRegistry.
+
+        A message whose header lists "recipients" instead of naming one
+        recipient is multicast to all of them, see multicast().  One that
+        names a "group" instead goes to the member of the group chosen by
+        the group index, or with an "affinity_key", to the member the key
+        maps to.
         """
+        if "recipients" in message.header:
+            return await self._send_multicast(message, expected_response, stream, on_done)
+        if "recipient" not in message.header and "group" in message.header:
+            group = message.header["group"]
+            member = self._group_member(message.header)
+            if member is None:
+                raise UnrouteableError(f"No reachable member of group {group}")
+            message.header["recipient"] = member
         recipient = message.header["recipient"]
         next_node_id = self.next_hop(recipient)
         if not next_node_id:
@@ -222,13 +260,132 @@ class MeshRouter:
         # TODO: Not signing/serializing in order to finish buffered output work
 
         message.header.update({"sender": self.node_id, "route_list": [self.node_id]})
+        message.header.setdefault("priority", classify(message.header).label)
         logger.debug(f"Sending {message.msg_id} to {recipient} via {next_node_id}")
         if expected_response and "directive" in message.header:
-            self.response_registry[message.msg_id] = dict(
-                message_sent_time=message.header["timestamp"]
+            self.response_registry.register(
+                message.msg_id, message.header["timestamp"], stream=stream, on_done=on_done
             )
         if next_node_id == self.node_id:
-            asyncio.ensure_future(self.receptor.handle_message(message))
+            self.receptor.dispatch(message)
         else:
             await self.forward(message, next_node_id)
         return message.msg_id
+
+    async def _send_multicast(self, message, expected_response, stream, on_done):
+        recipients = list(dict.fromkeys(message.header["recipients"]))
+        if not any(self.next_hop(recipient) for recipient in recipients):
+            raise UnrouteableError(f"No route found to any of {', '.join(recipients)}")
+        message.header.update(
+            {"sender": self.node_id, "route_list": [self.node_id], "recipients": recipients}
+        )
+        message.header.setdefault("priority", classify(message.header).label)
+        if expected_response and "directive" in message.header:
+            self.response_registry.register(
+                message.msg_id,
+                message.header["timestamp"],
+                stream=stream,
+                on_done=on_done,
+                eofs=len(recipients),
+            )
+        await self.multicast(message)
+        return message.msg_id
+
+    def _group_member(self, header, exclude=()):
+        if "affinity_key" in header:
+            return self.groups.affinity(header["group"], header["affinity_key"], exclude)
+        return self.groups.choose(header["group"], exclude)
+
+    async def spill(self, msg):
+        """
+        Passes msg, a directive sent to a group, on to the best member of
+        the group that has not already passed it on, or for one with an
+        affinity key, the next such member round the hash ring.  Returns
+        False if there is no such member.
+        """
+        tried = list(msg.header.get("tried", ())) + [self.node_id]
+        member = self._group_member(msg.header, exclude=tried)
+        if member is None:
+            return False
+        logger.info(f"Spilling {msg.msg_id} over from {self.node_id} to {member}")
+        msg.header.update(recipient=member, tried=tried)
+        await self.forward(msg, self.next_hop(member))
+        return True
+
+    def link_supports(self, node_id, feature):
+        """Returns True if every connection to the neighbor node_id negotiated feature."""
+        connections = self.receptor.connections.get(node_id) if self.receptor else None
+        return bool(connections) and all(feature in conn.features for conn in connections)
+
+    @staticmethod
+    def _copy(msg, recipient, recipients=None):
+        header = dict(msg.header, recipient=recipient, route_list=list(msg.header["route_list"]))
+        header.pop("recipients")
+        if recipients:
+            header["recipients"] = recipients
+        return FramedMessage(msg_id=msg.msg_id, header=header, payload=msg.payload)
+
+    async def multicast(self, msg):
+        """
+        Delivers a message to each node listed in its "recipients" header.
+
+        The recipients are split up by the next hop towards them, and each
+        next hop gets one copy listing the recipients behind it, so a link
+        carries the message once however many recipients are beyond it.
+        The next hop splits its list again in the same way.  Neighbors that
+        did not negotiate the multicast link feature, and branches with a
+        single recipient, get ordinary copies addressed to each recipient.
+
+        Every copy keeps the message id, so the sender sees the responses of
+        all the recipients as responses to one request.  Recipients without
+        a route are answered with an error on their behalf.  If the message
+        asks for its responses to be gathered, this node gathers those that
+        come back through it, see receptor.gather.
+        """
+        branches = defaultdict(list)
+        local = False
+        unroutable = []
+        for recipient in dict.fromkeys(msg.header["recipients"]):
+            next_hop = self.next_hop(recipient)
+            if next_hop == self.node_id:
+                local = True
+            elif next_hop is None:
+                unroutable.append(recipient)
+            else:
+                branches[next_hop].append(recipient)
+
+        if msg.header.get("gather") and msg.header["sender"] != self.node_id:
+            self.gatherer.expect(msg, len(unroutable) + local + sum(map(len, branches.values())))
+        for next_hop, recipients in branches.items():
+            logger.debug(f"Multicasting {msg.msg_id} to {recipients} via {next_hop}")
+            if len(recipients) > 1 and self.link_supports(next_hop, "multicast"):
+                await self.forward(self._copy(msg, next_hop, recipients), next_hop)
+            else:
+                for recipient in recipients:
+                    await self.forward(self._copy(msg, recipient), next_hop)
+        if unroutable and "directive" in msg.header:
+            await self._unroutable_response(msg, unroutable)
+        if local:
+            # Last, as the copies share the payload being read here
+            self.receptor.dispatch(self._copy(msg, self.node_id))
+
+    async def _unroutable_response(self, msg, recipients):
+        logger.warning(f"No route from {self.node_id} to {recipients} for {msg.msg_id}")
+        err_resp = FramedMessage(
+            header=dict(
+                recipient=msg.header["sender"],
+                in_response_to=msg.msg_id,
+                serial=1,
+                code=1,
+                eof=True,
+                covers=recipients,
+                timestamp=datetime.datetime.utcnow(),
+            ),
+            payload=FileBackedBuffer.from_data(
+                f"No route from {self.node_id} to {', '.join(recipients)}"
+            ),
+        )
+        try:
+            await self.send(err_resp)
+        except UnrouteableError:
+            logger.warning(f"Unable to tell {msg.header['sender']} about unroutable recipients")
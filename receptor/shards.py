@@ -0,0 +1,126 @@
+"""
+Running one node as several processes.
+
+A node configured with node_shards > 1 starts that many copies of itself.
+Each shard is a mesh node in its own right with its own connections,
+buffers and work: the first keeps the configured node id and the others
+are named "<node id>-shard<n>".  Every shard listens on the node's
+addresses with SO_REUSEPORT, so the kernel spreads incoming peers across
+them, and configured peers are dealt out between them.
+
+The shards are fully meshed with each other over unix sockets in the data
+directory.  Route advertisements travel over those links like any other,
+so every shard knows the whole mesh, and a message that arrives at the
+wrong shard is one local hop away from the shard that holds the
+connection to its next hop.
+
+A peer that reconnects may land on a different shard than before.  The
+messages the old shard still has queued for it are then handed over to
+the shard it is connected to now, see Handover.
+
+The other shards are started as fresh interpreters with the same command
+line rather than forked: an event loop and its selector must not be
+shared between processes.
+"""
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+
+logger = logging.getLogger(__name__)
+
+
+def shard_node_id(node_id, shard):
+    return node_id if shard == 0 else f"{node_id}-shard{shard}"
+
+
+def sibling_ids(node_id, shard, shards):
+    """Returns the node ids of the other shards of the node that shard node_id belongs to."""
+    base = node_id[: -len(f"-shard{shard}")] if shard else node_id
+    return {shard_node_id(base, n) for n in range(shards)} - {node_id}
+
+
+def shard_socket(data_dir, node_id, shard):
+    """Returns the path of the unix socket shard listens on for the other shards."""
+    return os.path.join(data_dir, node_id, f"shard-{shard}.sock")
+
+
+def shard_listen_url(data_dir, node_id, shard):
+    return f"rnpu://{shard_socket(data_dir, node_id, shard)}"
+
+
+def shard_peer_urls(data_dir, node_id, shard):
+    """Each shard connects to the shards before it, which makes a full mesh."""
+    return [f"rnpu://{shard_socket(data_dir, node_id, n)}" for n in range(shard)]
+
+
+def shard_peers(peers, shard, shards):
+    """Returns the configured peers that shard is responsible for connecting to."""
+    return [peer for n, peer in enumerate(peers) if n % shards == shard]
+
+
+def spawn_shards(args, node_id, shards):
+    """
+    Starts shards 1 to shards - 1 running the node command line args, and
+    returns their Popen objects.
+    """
+    procs = []
+    for shard in range(1, shards):
+        env = dict(os.environ, RECEPTOR_NODE_SHARD=str(shard), RECEPTOR_DEFAULT_NODE_ID=node_id)
+        procs.append(subprocess.Popen([sys.executable, "-m", "receptor", *args], env=env))
+        logger.info("Started shard %d of %s as pid %d", shard, node_id, procs[-1].pid)
+    return procs
+
+
+def stop_shards(procs, timeout=10):
+    for proc in procs:
+        if proc.poll() is None:
+            proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning("Shard pid %d did not exit, killing it", proc.pid)
+            proc.kill()
+
+
+async def watch_parent(receptor, interval=1.0):
+    """Stops a shard once the first shard, which started it, has gone away."""
+    parent = os.getppid()
+    while os.getppid() == parent:
+        await asyncio.sleep(interval)
+    logger.warning("Shard 0 of %s exited, stopping", receptor.node_id)
+    receptor.stop = True
+
+
+class Handover:
+    """
+    Moves the messages a shard has queued for a peer that is no longer
+    connected to it over to the shard the peer has reconnected to.  Run
+    whenever the routing table changes.
+    """
+
+    def __init__(self, receptor, siblings):
+        self.receptor = receptor
+        self.siblings = siblings
+        self.lock = asyncio.Lock()
+
+    async def run(self):
+        async with self.lock:
+            receptor = self.receptor
+            for key, buffer in list(receptor.buffer_mgr.items()):
+                if key in self.siblings or receptor.connections.get(key) or not buffer.qsize():
+                    continue
+                shard = receptor.router.next_hop(key)
+                if shard not in self.siblings:
+                    continue
+                try:
+                    # Relayed to the peer ahead of the messages, so that it
+                    # has a route back to their senders when they arrive
+                    await receptor.send_routes([shard])
+                    moved = await buffer.hand_over(receptor.buffer_mgr[shard])
+                except Exception:
+                    logger.exception("Failed to hand messages for %s over to %s", key, shard)
+                else:
+                    logger.info("Handed %d messages for %s over to %s", moved, key, shard)
@@ -1,8 +1,18 @@
-from prometheus_client import Counter, Gauge, Info
+from prometheus_client import Counter, Gauge, Info, Summary
 
 bytes_recv = Counter("bytes_recv", "Number of bytes received")
+ingress_pauses_counter = Counter(
+    "ingress_pauses", "Times a connection stopped reading until received messages were handled"
+)
 messages_received_counter = Counter("incoming_messages", "Messages received from Receptor Peers")
+expired_messages_counter = Counter(
+    "expired_messages", "Messages dropped at this node because their deadline passed"
+)
 connected_peers_gauge = Gauge("connected_peers", "Number of active peer connections")
+peer_streams_gauge = Gauge("peer_streams", "Number of open connections to a peer", ["peer"])
+stream_bytes_sent = Counter("stream_bytes_sent", "Bytes sent to a peer", ["peer"])
+stream_bytes_recv = Counter("stream_bytes_recv", "Bytes received from a peer", ["peer"])
+stream_messages_sent = Counter("stream_messages_sent", "Messages sent to a peer", ["peer"])
 work_counter = Counter(
     "work_events", "A count of the number of work events that have been received"
 )
@@ -13,3 +23,29 @@ route_counter = Counter(
 route_info = Info("routing_table", "This nodes view of the mesh routing table")
 receptor_info = Info("receptor_info", "Version and Node information of the current node")
 work_info = Info("worker_info", "Plugin information and versions")
+buffer_recovery_seconds = Summary(
+    "buffer_recovery_seconds", "Time taken to rebuild an outbound buffer from disk at startup"
+)
+blob_dedup_bytes = Counter(
+    "blob_dedup_bytes", "Payload bytes not written to disk because an identical payload was queued"
+)
+connect_attempts_counter = Counter(
+    "connect_attempts", "Attempts to connect to a configured peer", ["scheme", "result"]
+)
+tls_sessions_resumed = Counter(
+    "tls_sessions_resumed", "Connections to peers that resumed an earlier TLS session"
+)
+connect_seconds = Summary(
+    "connect_seconds", "Time taken to establish a connection to a peer", ["scheme"]
+)
+dns_lookups_counter = Counter(
+    "dns_lookups", "Peer address lookups by result: cached, resolved or failed", ["result"]
+)
+dispatch_wait_seconds = Summary(
+    "dispatch_wait_seconds", "Time received messages waited for a dispatcher slot"
+)
+dispatch_active_gauge = Gauge("dispatch_active", "Received messages being handled")
+dispatch_queued_gauge = Gauge("dispatch_queued", "Received messages waiting for a dispatcher slot")
+gathered_responses_counter = Counter(
+    "gathered_responses", "Responses to multicasts forwarded inside a gathered batch"
+)
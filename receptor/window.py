@@ -0,0 +1,122 @@
+import asyncio
+import collections
+import time
+
+
+class SendWindow:
+    """
+    Limits how many requests a controller has outstanding, in total and per
+    recipient.
+
+    acquire() waits for a slot and returns a callable that gives it back;
+    a request holds its slot until its last response arrives or it is
+    given up on.  Slots are handed out first come first served for each
+    recipient, taking the recipients in turn, so a recipient at its own
+    limit does not hold up requests for the others.
+
+    A limit of zero or None means no limit.  Requests without a single
+    recipient, acquired for None, only count against the total.
+    """
+
+    def __init__(self, limit=None, per_recipient=None, loop=None, samples=1024):
+        self.limit = limit or None
+        self.per_recipient = per_recipient or None
+        self.loop = loop or asyncio.get_event_loop()
+        self.outstanding = 0
+        self.sent = 0
+        self.completed = 0
+        self._by_recipient = collections.Counter()
+        self._waiters = collections.OrderedDict()
+        self._latencies = collections.deque(maxlen=samples)
+        self._completions = collections.deque(maxlen=samples)
+
+    def _has_room(self, recipient):
+        return (self.limit is None or self.outstanding < self.limit) and (
+            self.per_recipient is None
+            or recipient is None
+            or self._by_recipient[recipient] < self.per_recipient
+        )
+
+    def _take(self, recipient):
+        self.outstanding += 1
+        self.sent += 1
+        self._by_recipient[recipient] += 1
+        started = time.monotonic()
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self._give_back(recipient, started)
+
+        return release
+
+    async def acquire(self, recipient):
+        """Waits for a slot for a request to recipient and returns its release callable."""
+        if recipient not in self._waiters and self._has_room(recipient):
+            return self._take(recipient)
+        waiter = self.loop.create_future()
+        self._waiters.setdefault(recipient, collections.deque()).append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                waiter.result()()  # granted just as we were cancelled
+            else:
+                self._forget(recipient, waiter)
+            raise
+
+    def _forget(self, recipient, waiter):
+        waiting = self._waiters.get(recipient)
+        if waiting is not None and waiter in waiting:
+            waiting.remove(waiter)
+            if not waiting:
+                del self._waiters[recipient]
+
+    def _give_back(self, recipient, started):
+        now = time.monotonic()
+        self.outstanding -= 1
+        self.completed += 1
+        self._by_recipient[recipient] -= 1
+        if not self._by_recipient[recipient]:
+            del self._by_recipient[recipient]
+        self._latencies.append(now - started)
+        self._completions.append(now)
+        self._wake()
+
+    def _wake(self):
+        for recipient in list(self._waiters):
+            if self.limit is not None and self.outstanding >= self.limit:
+                return
+            waiting = self._waiters.pop(recipient)
+            while waiting and self._has_room(recipient):
+                waiter = waiting.popleft()
+                if not waiter.done():
+                    waiter.set_result(self._take(recipient))
+            if waiting:
+                self._waiters[recipient] = waiting  # to the back of the line
+
+    @property
+    def waiting(self):
+        return sum(len(waiting) for waiting in self._waiters.values())
+
+    def stats(self):
+        """
+        Returns the window's limits and occupancy, with the throughput and
+        latency of the most recently completed requests.
+        """
+        latencies = sorted(self._latencies)
+        completions = self._completions
+        span = completions[-1] - completions[0] if len(completions) > 1 else 0
+        return {
+            "limit": self.limit,
+            "per_recipient": self.per_recipient,
+            "outstanding": self.outstanding,
+            "waiting": self.waiting,
+            "sent": self.sent,
+            "completed": self.completed,
+            "throughput": (len(completions) - 1) / span if span else None,
+            "latency_mean": sum(latencies) / len(latencies) if latencies else None,
+            "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else None,
+        }
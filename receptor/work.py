@@ -1,7 +1,10 @@
 import asyncio
+import collections
 import concurrent.futures
 import datetime
+import inspect
 import logging
+import time
 
 import pkg_resources
 
@@ -11,37 +14,108 @@ from .messages.framed import FileBackedBuffer, FramedMessage
 from .plugin_utils import BUFFER_PAYLOAD, BYTES_PAYLOAD, FILE_PAYLOAD
 from .stats import active_work_gauge, work_counter, work_info
 
+try:
+    from importlib import metadata
+except ImportError:  # Python < 3.8
+    metadata = None
+
 logger = logging.getLogger(__name__)
 
 
+def discover_plugins():
+    """Returns the receptor.worker entry points of the installed plugins, by name."""
+    if metadata is not None:
+        entry_points = metadata.entry_points()
+        if hasattr(entry_points, "select"):
+            found = entry_points.select(group="receptor.worker")
+        else:
+            found = entry_points.get("receptor.worker", ())
+    else:
+        found = pkg_resources.iter_entry_points("receptor.worker")
+    plugins = {}
+    for entry_point in found:
+        plugins.setdefault(entry_point.name, entry_point)
+    return plugins
+
+
+def plugin_version(entry_point, module):
+    # pkg_resources, and importlib.metadata since Python 3.10, know the
+    # distribution an entry point came from
+    dist = getattr(entry_point, "dist", None)
+    if dist is not None:
+        return dist.version
+    # Otherwise guess that the distribution is named after the package,
+    # which it need not be
+    package = (module.__package__ or module.__name__).partition(".")[0]
+    if metadata is not None and package:
+        try:
+            return metadata.version(package)
+        except metadata.PackageNotFoundError:
+            pass
+    for found in pkg_resources.iter_entry_points("receptor.worker", entry_point.name):
+        if found.dist is not None:
+            return found.dist.version
+    return "unknown"
+
+
 class WorkManager:
     def __init__(self, receptor):
         self.receptor = receptor
+        self._discover_plugins()
         work_info.info(dict(plugins=str(self.get_capabilities())))
         self.active_work = []
         self.thread_pool = concurrent.futures.ThreadPoolExecutor(
             max_workers=self.receptor.config.default_max_workers
         )
+        # Work waiting for a thread, as (message, future) pairs.  It is kept
+        # here rather than in the thread pool's queue so that idle members of
+        # this node's groups can take it over, see give_away().
+        self.pending = collections.deque()
+        self.running = 0
+        self._next_steal = 0
+        # Coroutine and async generator actions run on the loop, not in a
+        # thread, but are limited separately
+        self.native_slots = asyncio.Semaphore(self.receptor.config.default_max_async_work)
+
+    def _discover_plugins(self):
+        self.plugins = discover_plugins()
+        self._modules = {name: entry_point.load() for name, entry_point in self.plugins.items()}
+        self._actions = {}
+        self._worker_versions = {
+            name: plugin_version(self.plugins[name], module)
+            for name, module in self._modules.items()
+        }
+
+    def reload_plugins(self):
+        """
+        Discovers the installed plugins again and advertises their versions
+        in a route advertisement.  Plugins are otherwise only discovered when
+        the node starts, so one installed or removed later is not seen until
+        this is called.  Modules that were already imported are not
+        re-imported.
+        """
+        self._discover_plugins()
+        caps = self.receptor.known_nodes[self.receptor.node_id]["capabilities"]
+        caps["worker_versions"] = dict(self._worker_versions)
+        work_info.info(dict(plugins=str(caps)))
+        # Versions travel with the routes; a load advertisement leaves them out
+        asyncio.ensure_future(self.receptor.send_routes())
 
     def load_receptor_worker(self, name):
-        entry_points = [
-            x
-            for x in filter(
-                lambda x: x.name == name, pkg_resources.iter_entry_points("receptor.worker")
-            )
-        ]
-        if not entry_points:
+        try:
+            return self._modules[name]
+        except KeyError:
             raise exceptions.UnknownDirective(f"Error loading directive handlers for {name}")
-        return entry_points[0].load()
 
     def get_capabilities(self):
         caps = {
-            "worker_versions": {
-                x.name: pkg_resources.get_distribution(x.resolve().__package__).version
-                for x in pkg_resources.iter_entry_points("receptor.worker")
-            },
+            "worker_versions": dict(self._worker_versions),
             "max_work_threads": self.receptor.config.default_max_workers,
+            "active_work": 0,
+            "queue_depth": 0,
         }
+        if self.receptor.config.node_groups:
+            caps["groups"] = list(self.receptor.config.node_groups)
         if self.receptor.config._is_ephemeral:
             caps["ephemeral"] = True
         return caps
@@ -49,6 +123,138 @@ class WorkManager:
     def get_work(self):
         return self.active_work
 
+    def saturated(self, directive=None):
+        """
+        Returns True if every work thread is busy, or if directive is for a
+        coroutine action, if every slot for those is.
+        """
+        if directive is not None and self.is_native(directive):
+            return self.native_slots.locked()
+        return self.running >= self.receptor.config.default_max_workers
+
+    async def _wait_for_thread(self, message):
+        """
+        Waits until message can have a work thread.  Returns False if it was
+        given away to another node instead.
+        """
+        if self.running < self.receptor.config.default_max_workers and not self.pending:
+            self.running += 1
+            return True
+        started = asyncio.get_event_loop().create_future()
+        entry = (message, started)
+        self.pending.append(entry)
+        self.receptor.load_changed()
+        try:
+            return await started
+        except asyncio.CancelledError:
+            if entry in self.pending:
+                self.pending.remove(entry)
+            raise
+
+    def _thread_done(self):
+        self.running -= 1
+        while self.pending and self.running < self.receptor.config.default_max_workers:
+            _, started = self.pending.popleft()
+            if not started.done():
+                self.running += 1
+                started.set_result(True)
+        self.receptor.load_changed()
+        self.maybe_steal()
+
+    def _steal_victim(self):
+        groups = set(self.receptor.config.node_groups)
+        victim, deepest = None, 0
+        for node, info in list(self.receptor.known_nodes.items()):
+            caps = info["capabilities"]
+            if (
+                node != self.receptor.node_id
+                and caps.get("queue_depth", 0) > deepest
+                and groups.intersection(caps.get("groups", ()))
+                and self.receptor.router.next_hop(node)
+            ):
+                victim, deepest = node, caps["queue_depth"]
+        return victim
+
+    def maybe_steal(self):
+        """
+        Asks the member of this node's groups with the most work waiting for
+        a thread to hand some over, if work stealing is on and this node has
+        idle threads.  Called when a thread frees up and when other nodes
+        advertise their queues.
+        """
+        config = self.receptor.config
+        idle = config.default_max_workers - self.running
+        if not config.node_work_stealing or self.pending or idle <= 0:
+            return
+        if time.monotonic() < self._next_steal:
+            return
+        victim = self._steal_victim()
+        if victim is None:
+            return
+        self._next_steal = time.monotonic() + config.node_steal_interval
+        asyncio.ensure_future(self._request_work(victim, idle))
+
+    async def _request_work(self, victim, count):
+        logger.info(f"Asking {victim} for up to {count} of its queued work")
+        request = FramedMessage(
+            header=dict(
+                recipient=victim, directive="receptor:steal", timestamp=datetime.datetime.utcnow()
+            ),
+            payload=FileBackedBuffer.from_dict(dict(count=count)),
+        )
+        try:
+            await self.receptor.router.send(request)
+        except exceptions.UnrouteableError:
+            logger.warning(f"Unable to ask {victim} for work: no route")
+
+    async def give_away(self, thief, count):
+        """
+        Hands up to count messages waiting for a thread over to thief, a
+        member of one of this node's groups with idle threads.  The newest
+        are taken first, leaving the ones that have waited longest to start
+        here soonest.  Work pinned by an affinity key, work already taken
+        over once, work sent to a group the thief is not a reachable member
+        of, and work for plugins the thief does not have stays.  A thief
+        that is unknown or shares none of this node's groups gets nothing.
+        The thief responds to the original sender as if it had been sent
+        the work in the first place.
+        """
+        if not self.receptor.config.node_work_stealing:
+            return
+        info = self.receptor.known_nodes.get(thief)
+        if info is None:
+            logger.warning(f"Ignoring request for work from unknown node {thief}")
+            return
+        groups = self.receptor.router.groups
+        shared = {g for g in self.receptor.config.node_groups if thief in groups.members(g)}
+        if not shared:
+            logger.warning(f"Ignoring request for work from {thief}: not in any of our groups")
+            return
+        plugins = info["capabilities"].get("worker_versions", {})
+        taken = []
+        for message, started in reversed(self.pending):
+            if len(taken) >= count:
+                break
+            header = message.header
+            if (
+                "affinity_key" not in header
+                and "stolen_from" not in header
+                and ("group" not in header or header["group"] in shared)
+                and header["directive"].split(":", 1)[0] in plugins
+            ):
+                taken.append((message, started))
+        if not taken:
+            return
+        next_hop = self.receptor.router.next_hop(thief)
+        for message, started in taken:
+            self.pending.remove((message, started))
+            started.set_result(False)
+        self.receptor.load_changed()
+        logger.info(f"Handing {len(taken)} queued messages over to {thief}")
+        for message, _ in reversed(taken):
+            message.header.update(recipient=thief, stolen_from=self.receptor.node_id)
+            await self.receptor.router.forward(message, next_hop)
+
     def add_work(self, message):
         work_counter.inc()
         active_work_gauge.inc()
@@ -59,12 +265,14 @@ class WorkManager:
                 sender=message.header["sender"],
             )
         )
+        self.receptor.load_changed()
 
     def remove_work(self, message):
         for work in self.active_work:
             if message.msg_id == work["id"]:
                 active_work_gauge.dec()
                 self.active_work.remove(work)
+                self.receptor.load_changed()
 
     def resolve_payload_input(self, payload_type, payload):
         if payload_type == BUFFER_PAYLOAD:
@@ -76,6 +284,10 @@ class WorkManager:
         return payload.readall()
 
     def get_action_method(self, directive):
+        try:
+            return self._actions[directive]
+        except KeyError:
+            pass
         namespace, action = directive.split(":", 1)
         worker_module = self.load_receptor_worker(namespace)
         try:
@@ -91,9 +303,70 @@ class WorkManager:
             raise exceptions.InvalidDirectiveAction(
                 f"Access denied calling {action} for {namespace}"
             )
+        self._actions[directive] = action_method, namespace
         return action_method, namespace
 
+    def is_native(self, directive):
+        """
+        Returns True if directive is for a coroutine or async generator
+        action, which runs on the event loop rather than in a work thread.
+        """
+        try:
+            action_method, _ = self.get_action_method(directive)
+        except exceptions.ReceptorMessageError:
+            return False
+        return inspect.iscoroutinefunction(action_method) or inspect.isasyncgenfunction(
+            action_method
+        )
+
+    def _run_in_thread(self, action_method, payload, config):
+        response_queue = BridgeQueue()
+        asyncio.wrap_future(
+            self.thread_pool.submit(action_method, payload, config, response_queue)
+        ).add_done_callback(lambda fut: response_queue.close())
+        return response_queue
+
+    async def _run_on_loop(self, action_method, payload, config):
+        if inspect.isasyncgenfunction(action_method):
+            async for response in action_method(payload, config):
+                yield response
+        else:
+            response = await action_method(payload, config)
+            if response is not None:
+                yield response
+
+    async def start(self, message):
+        """
+        Waits until message has a work thread, or a slot if it is for a
+        coroutine action, then handles it in a task of its own.  Returns the
+        task, or None if the message was given away to another node instead.
+        """
+        if self.is_native(message.header["directive"]):
+            await self.native_slots.acquire()
+            return asyncio.ensure_future(self._run_native(message))
+        if await self._wait_for_thread(message):
+            return asyncio.ensure_future(self._run_threaded(message))
+        logger.info(f"Handed {message.msg_id} over to {message.header['recipient']}")
+        return None
+
     async def handle(self, message):
+        task = await self.start(message)
+        if task is not None:
+            await task
+
+    async def _run_native(self, message):
+        try:
+            await self._handle(message, self._run_on_loop)
+        finally:
+            self.native_slots.release()
+
+    async def _run_threaded(self, message):
+        try:
+            await self._handle(message, self._run_in_thread)
+        finally:
+            self._thread_done()
+
+    async def _handle(self, message, run):
         directive = message.header["directive"]
         logger.info(f"Handling work for {message.msg_id} as {directive}")
         try:
@@ -103,17 +376,13 @@ class WorkManager:
             payload_input_type = getattr(action_method, "payload_type", BYTES_PAYLOAD)
 
             self.add_work(message)
-            response_queue = BridgeQueue()
-            asyncio.wrap_future(
-                self.thread_pool.submit(
-                    action_method,
-                    self.resolve_payload_input(payload_input_type, message.payload),
-                    self.receptor.config.plugins.get(namespace, {}),
-                    response_queue,
-                )
-            ).add_done_callback(lambda fut: response_queue.close())
+            responses = run(
+                action_method,
+                self.resolve_payload_input(payload_input_type, message.payload),
+                self.receptor.config.plugins.get(namespace, {}),
+            )
 
-            async for response in response_queue:
+            async for response in responses:
                 serial += 1
                 logger.debug(f"Response emitted for {message.msg_id}, serial {serial}")
                 response_message = FramedMessage(
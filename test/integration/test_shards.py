@@ -0,0 +1,80 @@
+import asyncio
+import contextlib
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from receptor.config import ReceptorConfig
+from receptor.controller import Controller
+from receptor.shards import shard_socket
+
+
+@pytest.fixture
+def spawn():
+    procs = []
+
+    def _spawn(data_dir, node_id, *args):
+        command = [sys.executable, "-m", "receptor", "--node-id", node_id, "--data-dir", data_dir]
+        command += ["node", "--server-disable", *args]
+        # In a session of its own, so its shards can be stopped with it
+        proc = subprocess.Popen(command, start_new_session=True)
+        procs.append(proc)
+        return proc
+
+    yield _spawn
+    for proc in procs:
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(proc.pid, signal.SIGTERM)
+    for proc in procs:
+        proc.wait(10)
+    for proc in procs:
+        # Anything left in the group, such as a shard that did not exit
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(proc.pid, signal.SIGKILL)
+
+
+async def wait_until(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.1)
+
+
+def test_queued_messages_follow_peer_to_another_shard(tmpdir, spawn):
+    data_dir = tmpdir.strpath
+    spawn(data_dir, "hub", "--shards", "2")
+    sockets = [shard_socket(data_dir, "hub", shard) for shard in range(2)]
+    spoke = spawn(data_dir, "spoke", "--peer", f"rnpu://{sockets[0]}")
+
+    config = ReceptorConfig(["--node-id", "ctl", "--data-dir", data_dir, "ping", "spoke"])
+    controller = Controller(config)
+    receptor = controller.receptor
+
+    def spoke_on(shard):
+        return lambda: receptor.known_nodes["spoke"]["connections"].get(shard) == 1
+
+    async def scenario():
+        await wait_until(lambda: all(map(os.path.exists, sockets)))
+        controller.add_peer(f"rnpu://{sockets[0]}")
+        await wait_until(spoke_on("hub"))
+
+        spoke.terminate()
+        spoke.wait(10)
+        # hub holds the ping for spoke until it comes back, on the other shard
+        msg_id = await controller.ping("spoke")
+        spawn(data_dir, "spoke", "--peer", f"rnpu://{sockets[1]}")
+        # ctl learns of the new link through hub, so hub has the route by now
+        await wait_until(spoke_on("hub-shard1"))
+
+        response = await asyncio.wait_for(controller.recv(), 20)
+        assert response.header["in_response_to"] == msg_id
+        assert response.header["sender"] == "spoke"
+
+    try:
+        controller.loop.run_until_complete(scenario())
+    finally:
+        controller.cleanup_tmpdir()
@@ -0,0 +1,58 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+import pytest
+
+from receptor.buffers.file import DurableBuffer
+from receptor.messages.framed import FileBackedBuffer, FramedMessage
+
+BACKLOG = int(os.environ.get("RECEPTOR_PERF_BACKLOG", "20000"))
+
+
+async def fill(dir_, count):
+    b = DurableBuffer(dir_, "backlog", asyncio.get_event_loop(), write_time=0.0)
+    for n in range(count):
+        msg = FramedMessage(
+            header={"sender": "controller", "recipient": "node", "directive": "perf:run"},
+            payload=FileBackedBuffer.from_data(f"payload {n}"),
+        )
+        await b.put(msg)
+    await b._manifest_clean.wait()
+    return b._manifest_path
+
+
+async def restart(dir_):
+    start = time.monotonic()
+    b = DurableBuffer(dir_, "backlog", asyncio.get_event_loop())
+    await b.ready.wait()
+    return time.monotonic() - start, b
+
+
+@pytest.fixture(scope="module")
+def backlog():
+    dir_ = tempfile.mkdtemp()
+    loop = asyncio.get_event_loop()
+    manifest_path = loop.run_until_complete(fill(dir_, BACKLOG))
+    with open(manifest_path) as fp:
+        manifest = fp.read()
+    yield dir_, manifest_path, manifest
+    shutil.rmtree(dir_)
+
+
+@pytest.mark.parametrize("lose_manifest", [False, True], ids=["manifest", "no-manifest"])
+def test_restart_with_backlog(backlog, lose_manifest):
+    dir_, manifest_path, manifest = backlog
+    if lose_manifest:
+        os.remove(manifest_path)
+    else:
+        with open(manifest_path, "w") as fp:
+            fp.write(manifest)
+
+    elapsed, b = asyncio.get_event_loop().run_until_complete(restart(dir_))
+
+    print(f"{time.time()} - restart with {BACKLOG} queued messages took {elapsed:.3f}s")
+    print(f"{time.time()} - recovery: {b.recovery}")
+    assert b.q.qsize() == BACKLOG
@@ -0,0 +1,50 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pkg_resources
+import pytest
+
+from receptor.work import WorkManager, discover_plugins
+
+DIRECTIVE = os.environ.get("RECEPTOR_PERF_DIRECTIVE", "receptor_sleep:execute")
+LOOKUPS = int(os.environ.get("RECEPTOR_PERF_LOOKUPS", "1000"))
+
+
+@pytest.fixture(scope="module")
+def work_manager():
+    if DIRECTIVE.split(":", 1)[0] not in discover_plugins():
+        pytest.skip(f"no plugin installed for {DIRECTIVE}")
+    config = SimpleNamespace(
+        default_max_workers=1, default_max_async_work=1, node_groups=[], _is_ephemeral=False
+    )
+    return WorkManager(SimpleNamespace(config=config))
+
+
+def scan_entry_points(work_manager):
+    # how every directive found its plugin before plugins were discovered once
+    namespace, action = DIRECTIVE.split(":", 1)
+    for entry_point in pkg_resources.iter_entry_points("receptor.worker"):
+        if entry_point.name == namespace:
+            return getattr(entry_point.load(), action)
+
+
+def rediscover(work_manager):
+    work_manager._discover_plugins()
+    return work_manager.get_action_method(DIRECTIVE)
+
+
+def cached(work_manager):
+    return work_manager.get_action_method(DIRECTIVE)
+
+
+@pytest.mark.parametrize(
+    "lookup", [scan_entry_points, rediscover, cached], ids=["scan", "rediscover", "cached"],
+)
+def test_lookup(work_manager, lookup):
+    start = time.perf_counter()
+    for _ in range(LOOKUPS):
+        lookup(work_manager)
+    elapsed = time.perf_counter() - start
+    print(f"{time.time()} - {lookup.__name__}: {elapsed / LOOKUPS * 1e6:.1f}us each, ", end="")
+    print(f"{LOOKUPS} lookups in {elapsed:.3f}s")
@@ -0,0 +1,91 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import pytest
+
+from receptor.config import ReceptorConfig
+
+CLIENTS = int(os.environ.get("RECEPTOR_PERF_CLIENTS", "500"))
+
+pytestmark = pytest.mark.skipif(shutil.which("openssl") is None, reason="needs openssl")
+
+
+def openssl(command, cwd):
+    subprocess.run(["openssl", *command.split()], cwd=cwd, check=True, capture_output=True)
+
+
+@pytest.fixture(scope="module")
+def config():
+    dir_ = tempfile.mkdtemp()
+    openssl("req -x509 -newkey rsa:2048 -nodes -keyout ca.key -out ca.pem -subj /CN=ca", dir_)
+    openssl("req -newkey rsa:2048 -nodes -keyout hub.key -out hub.csr -subj /CN=localhost", dir_)
+    with open(os.path.join(dir_, "ext"), "w") as fp:
+        fp.write("subjectAltName=DNS:localhost\n")
+    openssl(
+        "x509 -req -in hub.csr -CA ca.pem -CAkey ca.key -CAcreateserial -out hub.pem -extfile ext",
+        dir_,
+    )
+    conf = os.path.join(dir_, "receptor.conf")
+    with open(conf, "w") as fp:
+        fp.write(
+            f"[auth]\nserver_cert={dir_}/hub.pem\nserver_key={dir_}/hub.key\n"
+            f"server_ca_bundle={dir_}/ca.pem\n"
+        )
+    yield ReceptorConfig(["-c", conf, "node"])
+    shutil.rmtree(dir_)
+
+
+async def hello(reader, writer):
+    writer.write(b"HI")
+    await writer.drain()
+    writer.close()
+
+
+async def storm(port, contexts):
+    """Connects every client to the hub at once; returns the time taken and sessions reused."""
+
+    async def reconnect(context):
+        if callable(context):
+            context = context()
+        r, w = await asyncio.open_connection(
+            "127.0.0.1", port, ssl=context, server_hostname="localhost"
+        )
+        await r.read()
+        ssl_object = w.get_extra_info("ssl_object")
+        context.remember("localhost", ssl_object)
+        w.close()
+        return ssl_object.session_reused
+
+    start = time.monotonic()
+    reused = await asyncio.gather(*(reconnect(context) for context in contexts))
+    return time.monotonic() - start, sum(reused)
+
+
+def test_reconnect_storm(config):
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(
+        asyncio.start_server(
+            hello, "127.0.0.1", 0, ssl=config.get_ssl_context("server"), backlog=CLIENTS
+        )
+    )
+    port = server.sockets[0].getsockname()[1]
+    try:
+        # Every reconnect loads the CA bundle into a new context and handshakes in full
+        fresh, _ = loop.run_until_complete(storm(port, [config.get_client_ssl_context] * CLIENTS))
+        # One cached context per client, as each spoke would have; the first
+        # round has no sessions yet and the second resumes them
+        contexts = [config.get_client_ssl_context() for _ in range(CLIENTS)]
+        cold, _ = loop.run_until_complete(storm(port, contexts))
+        resumed, reused = loop.run_until_complete(storm(port, contexts))
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+
+    print(f"{time.time()} - {CLIENTS} reconnects with a new context each took {fresh:.3f}s")
+    print(f"{time.time()} - {CLIENTS} reconnects with cached contexts took {cold:.3f}s")
+    print(f"{time.time()} - {CLIENTS} reconnects resuming sessions took {resumed:.3f}s")
+    assert reused == CLIENTS
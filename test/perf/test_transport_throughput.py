@@ -0,0 +1,108 @@
+import asyncio
+import os
+import tempfile
+import time
+
+import aiohttp
+import aiohttp.web
+import pytest
+
+from receptor import fileio
+from receptor.bridgequeue import BridgeQueue
+from receptor.connection import sock, ws
+
+PAYLOAD_MB = int(os.environ.get("RECEPTOR_PERF_PAYLOAD_MB", "100"))
+
+
+@pytest.fixture(scope="module")
+def payload():
+    with tempfile.NamedTemporaryFile() as fp:
+        block = os.urandom(2 ** 20)
+        for _ in range(PAYLOAD_MB):
+            fp.write(block)
+        fp.flush()
+        yield fp.name
+
+
+async def send_file(transport, path):
+    q = BridgeQueue(maxsize=1)
+    deferrer = fileio.Deferrer()
+    await asyncio.gather(deferrer.defer(q.read_from, path, transport.read_size), transport.send(q))
+
+
+async def over_rnp(path, size):
+    done = asyncio.get_event_loop().create_future()
+
+    async def serve(reader, writer):
+        received = 0
+        t = sock.RawSocket(reader, writer)
+        while received < size:
+            received += len(await t.__anext__())
+        done.set_result(received)
+
+    server = await asyncio.start_server(serve, "127.0.0.1", 0, limit=sock.MAX_CHUNK)
+    port = server.sockets[0].getsockname()[1]
+    start = time.monotonic()
+    r, w = await asyncio.open_connection("127.0.0.1", port, limit=sock.MAX_CHUNK)
+    await send_file(sock.RawSocket(r, w), path)
+    await done
+    elapsed = time.monotonic() - start
+    w.close()
+    server.close()
+    return elapsed
+
+
+async def over_ws(path, size, max_message=None, compress=False):
+    done = asyncio.get_event_loop().create_future()
+
+    async def serve(request):
+        conn = aiohttp.web.WebSocketResponse(
+            protocols=ws.message_protocols(ws.MAX_MESSAGE),
+            compress=compress,
+            max_msg_size=ws.receive_limit(ws.MAX_MESSAGE),
+        )
+        await conn.prepare(request)
+        received = 0
+        async for msg in conn:
+            received += len(msg.data)
+            if received >= size:
+                done.set_result(received)
+        return conn
+
+    app = aiohttp.web.Application()
+    app.add_routes([aiohttp.web.get("/", serve)])
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        start = time.monotonic()
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(
+                f"http://127.0.0.1:{port}/",
+                protocols=ws.message_protocols(ws.MAX_MESSAGE),
+                compress=15 if compress else 0,
+                max_msg_size=ws.receive_limit(ws.MAX_MESSAGE),
+            ) as conn:
+                await send_file(ws.WebSocket(conn, max_message=max_message), path)
+                await done
+                return time.monotonic() - start
+    finally:
+        await runner.cleanup()
+
+
+@pytest.mark.parametrize(
+    "transport", ["rnp", "ws-4k-frames", "ws", "ws-deflate"],
+)
+def test_throughput(payload, transport):
+    size = PAYLOAD_MB * 2 ** 20
+    run = {
+        "rnp": lambda: over_rnp(payload, size),
+        "ws-4k-frames": lambda: over_ws(payload, size, max_message=2 ** 12),
+        "ws": lambda: over_ws(payload, size),
+        "ws-deflate": lambda: over_ws(payload, size, compress=True),
+    }[transport]
+    elapsed = asyncio.get_event_loop().run_until_complete(run())
+    print(f"{time.time()} - {transport}: {PAYLOAD_MB}MiB in {elapsed:.3f}s, ", end="")
+    print(f"{PAYLOAD_MB / elapsed:.1f}MiB/s")
@@ -0,0 +1,190 @@
+import asyncio
+import functools
+from types import SimpleNamespace
+
+import pytest
+
+from receptor import work as work_module
+from receptor.dispatch import Dispatcher
+from receptor.messages.framed import FileBackedBuffer, FramedMessage
+from receptor.plugin_utils import BYTES_PAYLOAD, plugin_export
+from receptor.receptor import Receptor
+from receptor.work import WorkManager
+
+
+@pytest.mark.asyncio
+async def test_flows_take_turns(event_loop):
+    order = []
+    gate = asyncio.Event()
+
+    def handler(flow, n):
+        async def run():
+            await gate.wait()
+            order.append((flow, n))
+
+        return run
+
+    d = Dispatcher(concurrency=1)
+    for n in range(4):
+        d.submit("noisy", handler("noisy", n))
+    for n in range(2):
+        d.submit("quiet", handler("quiet", n))
+    assert (d.active, d.queued) == (1, 5)
+    gate.set()
+    while d.active or d.queued:
+        await asyncio.sleep(0)
+    assert [flow for flow, _ in order] == ["noisy", "noisy", "quiet", "noisy", "quiet", "noisy"]
+
+
+@pytest.mark.asyncio
+async def test_concurrency_and_flow_limits(event_loop):
+    running = []
+    peak = {}
+    gate = asyncio.Event()
+
+    def handler(flow):
+        async def run():
+            running.append(flow)
+            peak[flow] = max(peak.get(flow, 0), running.count(flow))
+            await gate.wait()
+            running.remove(flow)
+
+        return run
+
+    d = Dispatcher(concurrency=4, flow_limit=2)
+    for _ in range(10):
+        d.submit("a", handler("a"))
+    d.submit("b", handler("b"))
+    await asyncio.sleep(0)
+    assert sorted(running) == ["a", "a", "b"]
+    gate.set()
+    while d.active or d.queued:
+        await asyncio.sleep(0)
+    assert peak == {"a": 2, "b": 1}
+
+
+@pytest.mark.asyncio
+async def test_failing_handler_frees_slot(event_loop):
+    async def fail():
+        raise RuntimeError("boom")
+
+    done = []
+
+    async def ok():
+        done.append(True)
+
+    d = Dispatcher(concurrency=1)
+    d.submit("x", fail)
+    d.submit("x", ok)
+    for _ in range(10):
+        await asyncio.sleep(0)
+    assert done == [True]
+
+
+@pytest.mark.asyncio
+async def test_ordered_flow_runs_one_at_a_time():
+    dispatcher = Dispatcher(concurrency=8)
+    finished = []
+
+    def handler(n, delay):
+        async def run():
+            await asyncio.sleep(delay)
+            finished.append(n)
+
+        return run
+
+    for n, delay in enumerate([0.03, 0.0, 0.01]):
+        dispatcher.submit("relay", handler(n, delay), ordered=True)
+    assert dispatcher.active == 1
+    await asyncio.sleep(0.1)
+    assert finished == [0, 1, 2] and not dispatcher._ordered
+
+
+@pytest.mark.asyncio
+async def test_local_work_does_not_hold_dispatcher_slots():
+    started, delivered = [], []
+    finish = asyncio.Event()
+
+    async def run_work(msg):
+        started.append(msg)
+        await finish.wait()
+
+    async def start_work(msg):
+        return asyncio.ensure_future(run_work(msg))
+
+    receptor = SimpleNamespace(
+        node_id="me",
+        dispatcher=Dispatcher(concurrency=2),
+        work_manager=SimpleNamespace(start=start_work),
+        router=SimpleNamespace(
+            response_registry=SimpleNamespace(received=lambda msg: dict(stream=None))
+        ),
+        response_queue=SimpleNamespace(put=lambda msg: asyncio.sleep(0, delivered.append(msg))),
+    )
+    for name in ("_dispatch", "handle_message", "handle_directive", "handle_response"):
+        setattr(receptor, name, functools.partial(getattr(Receptor, name), receptor))
+
+    for sender in ("a", "a", "b", "b"):
+        work = dict(sender=sender, recipient="me", directive="plugin:run")
+        Receptor.dispatch(receptor, FramedMessage(header=work))
+    Receptor.dispatch(
+        receptor, FramedMessage(header=dict(sender="c", recipient="me", in_response_to=1))
+    )
+    for _ in range(10):
+        await asyncio.sleep(0)
+    assert len(started) == 4 and len(delivered) == 1
+    assert receptor.dispatcher.active == 0
+    finish.set()
+
+
+@pytest.mark.asyncio
+async def test_flood_of_local_work_stays_bounded(monkeypatch):
+    finish = asyncio.Event()
+    done, released = [], []
+
+    @plugin_export(payload_type=BYTES_PAYLOAD)
+    async def wait(payload, config):
+        await finish.wait()
+        done.append(payload)
+        yield payload
+
+    plugin = SimpleNamespace(
+        load=lambda: SimpleNamespace(wait=wait), dist=SimpleNamespace(version="1")
+    )
+    monkeypatch.setattr(work_module, "discover_plugins", lambda: {"aio": plugin})
+
+    async def send(msg):
+        pass
+
+    receptor = SimpleNamespace(
+        node_id="me",
+        dispatcher=Dispatcher(concurrency=4),
+        config=SimpleNamespace(
+            default_max_workers=1,
+            default_max_async_work=2,
+            node_groups=[],
+            _is_ephemeral=False,
+            plugins={},
+        ),
+        router=SimpleNamespace(send=send),
+        load_changed=lambda: None,
+    )
+    receptor.work_manager = WorkManager(receptor)
+    for name in ("_dispatch", "handle_message", "handle_directive"):
+        setattr(receptor, name, functools.partial(getattr(Receptor, name), receptor))
+    ingress = SimpleNamespace(release=released.append)
+
+    for n in range(100):
+        header = dict(sender=f"c{n % 10}", recipient="me", directive="aio:wait")
+        msg = FramedMessage(header=header, payload=FileBackedBuffer.from_data(str(n)))
+        Receptor.dispatch(receptor, msg, ingress)
+    for _ in range(10):
+        await asyncio.sleep(0)
+    # two running, four waiting for a slot and the rest queued, not in tasks
+    assert len(asyncio.all_tasks()) <= 1 + 2 + 4
+    assert len(released) == 2 and receptor.dispatcher.queued == 94
+
+    finish.set()
+    while len(done) < 100:
+        await asyncio.sleep(0.01)
+    assert len(released) == 100
@@ -1,12 +1,17 @@
 import asyncio
 import os
 import shutil
+import time
 import tempfile
 
 import pytest
 
 from receptor import fileio
+from receptor.bridgequeue import BridgeQueue
+from receptor.buffers.blobs import BlobStore
 from receptor.buffers.file import DurableBuffer
+from receptor.buffers.lanes import LaneQueue
+from receptor.messages.framed import FileBackedBuffer, FramedMessage
 
 
 @pytest.fixture
@@ -16,6 +21,18 @@ def tempdir():
     shutil.rmtree(dir_)
 
 
+@pytest.fixture
+def buffer(event_loop, tempdir):
+    buffers = []
+
+    def _buffer(key, **kwargs):
+        buffers.append(DurableBuffer(tempdir, key, event_loop, **kwargs))
+        return buffers[-1]
+
+    yield _buffer
+    event_loop.run_until_complete(asyncio.gather(*(b.close() for b in buffers)))
+
+
 @pytest.mark.asyncio
 async def test_read(event_loop, tempdir):
     with tempfile.NamedTemporaryFile() as fp:
@@ -27,8 +44,8 @@ async def test_read(event_loop, tempdir):
 
 
 @pytest.mark.asyncio
-async def test_create(event_loop, tempdir):
-    b = DurableBuffer(tempdir, "test_create", asyncio.get_event_loop())
+async def test_create(event_loop, buffer):
+    b = buffer("test_create")
     await b.put(b"some data")
     item = await b.get()
     data = await fileio.read(item["path"])
@@ -36,8 +53,8 @@ async def test_create(event_loop, tempdir):
 
 
 @pytest.mark.asyncio
-async def test_manifest(event_loop, tempdir):
-    b = DurableBuffer(tempdir, "test_manifest", event_loop, write_time=0.0)
+async def test_manifest(event_loop, buffer):
+    b = buffer("test_manifest", write_time=0.0)
     await b.put(b"one")
     await b.put(b"two")
     await b.put(b"three")
@@ -48,8 +65,8 @@ async def test_manifest(event_loop, tempdir):
 
 
 @pytest.mark.asyncio
-async def test_chunks(event_loop, tempdir):
-    b = DurableBuffer(tempdir, "test_chunks", event_loop, write_time=0.0)
+async def test_chunks(event_loop, buffer):
+    b = buffer("test_chunks", write_time=0.0)
     await b.put((b"one", b"two", b"three"))
 
     item = await b.get()
@@ -58,9 +75,9 @@ async def test_chunks(event_loop, tempdir):
 
 
 @pytest.mark.asyncio
-async def test_unreadable_file(event_loop, tempdir):
-    b = DurableBuffer(tempdir, "test_unreadable_file", event_loop)
-    b.q._queue.appendleft("junk")
+async def test_unreadable_file(event_loop, buffer):
+    b = buffer("test_unreadable_file")
+    b.q.put_nowait("junk")
     await b.put(b"valid data")
     item = await b.get()
     data = await fileio.read(item["path"])
@@ -69,11 +86,189 @@ async def test_unreadable_file(event_loop, tempdir):
 
 
 @pytest.mark.asyncio
-async def test_does_not_delete_messages(event_loop, tempdir):
-    b = DurableBuffer(tempdir, "test_deletes_messages", event_loop, write_time=0.0)
+async def test_does_not_delete_messages(event_loop, buffer):
+    b = buffer("test_deletes_messages", write_time=0.0)
     await b.put(b"some data")
     item = await b.get()
     data = await fileio.read(item["path"])
     assert data == b"some data"
     await b._manifest_clean.wait()
     assert os.path.exists(item["path"])
+
+
+@pytest.mark.asyncio
+async def test_priority_lanes(event_loop, buffer):
+    b = buffer("test_priority_lanes", write_time=0.0)
+    await b.put(FramedMessage(header={"recipient": "a", "directive": "x:y"}))
+    await b.put(FramedMessage(header={"cmd": "ROUTE2"}))
+    item = await b.get()
+    assert item["priority"] == "control"
+    item = await b.get()
+    assert item["priority"] == "bulk"
+
+
+@pytest.mark.asyncio
+async def test_eof_does_not_overtake_responses(event_loop, buffer):
+    b = buffer("test_eof_order", write_time=0.0)
+    for serial in (1, 2):
+        await b.put(FramedMessage(header={"in_response_to": 1, "serial": serial}))
+    await b.put(FramedMessage(header={"in_response_to": 1, "serial": 3, "eof": True}))
+    assert [(await b.get())["priority"] for _ in range(3)] == ["interactive"] * 3
+
+
+@pytest.mark.asyncio
+async def test_lanes_do_not_starve(event_loop):
+    q = LaneQueue(weights={"control": 2}, loop=event_loop)
+    for _ in range(3):
+        q.put_nowait({"priority": "bulk"})
+    for _ in range(6):
+        q.put_nowait({"priority": "control"})
+    order = [q.get_nowait()["priority"] for _ in range(9)]
+    assert order[:3] == ["control", "control", "bulk"]
+    assert order.count("bulk") == 3
+
+
+@pytest.mark.asyncio
+async def test_sender_deadline(event_loop, buffer):
+    expired = []
+
+    async def on_expire(item):
+        expired.append(item)
+
+    b = buffer("test_sender_deadline", on_expire=on_expire)
+    late = FramedMessage(
+        header={"sender": "a", "recipient": "b", "directive": "x:y", "deadline": time.time()}
+    )
+    await b.put(late)
+    await b.put(FramedMessage(header={"sender": "a", "recipient": "b", "directive": "x:y"}))
+    await b.expire_all()
+    assert b.q.qsize() == 1
+    assert [(i["sender"], i["msg_id"]) for i in expired] == [("a", late.msg_id)]
+    assert not os.path.exists(expired[0]["path"])
+
+
+def test_pop_expired_skips_dequeued(event_loop):
+    q = LaneQueue(loop=event_loop)
+    q.put_nowait({"id": 1}, deadline=1.0)
+    q.put_nowait({"id": 2}, deadline=2.0)
+    q.put_nowait({"id": 3}, deadline=5.0)
+    assert q.get_nowait() == {"id": 1}
+    assert q.next_deadline() == 2.0
+    assert q.pop_expired(3.0) == [{"id": 2}]
+    assert list(q) == [{"id": 3}]
+
+
+@pytest.mark.asyncio
+async def test_manifest_survives_restart(event_loop, buffer):
+    b = buffer("test_restart", write_time=0.0)
+    await b.put(FramedMessage(header={"cmd": "ROUTE2"}))
+    await b._manifest_clean.wait()
+
+    restarted = buffer("test_restart")
+    await restarted.ready.wait()
+    assert restarted.recovery["manifest"] == "ok"
+    assert restarted.q.qsize() == 1
+
+
+@pytest.mark.asyncio
+async def test_recover_without_manifest(event_loop, buffer):
+    b = buffer("test_recover", write_time=0.0)
+    msg = FramedMessage(header={"sender": "a", "recipient": "b", "directive": "x:y"})
+    await b.put(msg)
+    await b._manifest_clean.wait()
+    os.remove(b._manifest_path)
+    with open(os.path.join(b._message_path, "torn"), "wb") as fp:
+        fp.write(msg.serialize()[:-1])
+
+    recovered = buffer("test_recover")
+    await recovered.ready.wait()
+    assert recovered.recovery["manifest"] == "missing"
+    assert recovered.recovery["recovered"] == 1
+    assert recovered.recovery["reclaimed"] == 1
+    item = await recovered.get()
+    assert item["msg_id"] == msg.msg_id
+    assert os.listdir(recovered._message_path) == [os.path.basename(item["path"])]
+
+
+def large_message(data):
+    header = {"sender": "a", "recipient": "b", "directive": "x:y"}
+    return FramedMessage(header=header, payload=FileBackedBuffer.from_data(data))
+
+
+@pytest.mark.asyncio
+async def test_shared_payload(event_loop, buffer, tempdir):
+    blobs = BlobStore(os.path.join(tempdir, "blobs"), min_size=4)
+    b = buffer("test_shared", blobs=blobs)
+    msg = large_message(b"shared payload")
+    await b.put(msg)
+    await b.put(large_message(b"shared payload"))
+    first, second = await b.get(), await b.get()
+    assert first["blob"] == second["blob"]
+    blob = os.path.join(blobs.path, first["blob"])
+    assert os.stat(blob).st_nlink == 3
+
+    q = BridgeQueue()
+    q.read_files(b.message_paths(first))
+    assert b"".join([chunk async for chunk in q]) == msg.serialize()
+
+    b.release(first)
+    assert os.stat(blob).st_nlink == 2
+    b.release(second)
+    assert not os.path.exists(blob)
+    assert os.listdir(b._message_path) == []
+
+
+@pytest.mark.asyncio
+async def test_recover_shared_payload(event_loop, buffer, tempdir):
+    blobs = BlobStore(os.path.join(tempdir, "blobs"), min_size=4)
+    b = buffer("test_recover", write_time=0.0, blobs=blobs)
+    await b.put(large_message(b"shared payload"))
+    await b._manifest_clean.wait()
+    os.remove(b._manifest_path)
+    # A payload link whose header was never written
+    (digest,) = os.listdir(blobs.path)
+    os.link(os.path.join(blobs.path, digest), os.path.join(b._message_path, f"torn.{digest}"))
+
+    recovered = buffer("test_recover", blobs=blobs)
+    await recovered.ready.wait()
+    assert recovered.recovery["recovered"] == 1
+    assert recovered.recovery["reclaimed"] == 1
+    item = await recovered.get()
+    assert item["blob"] == digest
+    assert os.stat(os.path.join(blobs.path, digest)).st_nlink == 2
+    assert sorted(os.listdir(recovered._message_path)) == sorted(
+        os.path.basename(path) for path in recovered.message_paths(item)
+    )
+
+
+@pytest.mark.asyncio
+async def test_shared_by_streams(event_loop, buffer):
+    b = buffer("test_streams")
+    streams = [event_loop.create_task(b.get()) for _ in range(3)]
+    for n in range(3):
+        await b.put(f"message {n}".encode())
+    items = await asyncio.wait_for(asyncio.gather(*streams), 1)
+    assert len({item["path"] for item in items}) == 3
+
+
+@pytest.mark.asyncio
+async def test_flows_for_stripes(event_loop, buffer):
+    b = buffer("test_flows")
+    await b.put(FramedMessage(header={"in_response_to": "req", "serial": 1}))
+    await b.put(FramedMessage(header={"cmd": "ROUTE2", "origin": "node"}))
+    await b.put(FramedMessage(header={"sender": "a", "recipient": "b", "directive": "x:y"}))
+    flows = {(await b.get()).get("flow") for _ in range(3)}
+    assert flows == {"req", "node", None}
+
+
+@pytest.mark.asyncio
+async def test_hand_over(event_loop, buffer):
+    old = buffer("old")
+    new = buffer("new")
+    for n in range(3):
+        await old.put(FramedMessage(header={"recipient": "spoke", "serial": n}))
+    assert await old.hand_over(new) == 3
+    assert old.qsize() == 0 and not os.listdir(old._message_path)
+    items = [await new.get() for _ in range(3)]
+    assert all(os.path.dirname(item["path"]) == new._message_path for item in items)
+    assert all(os.path.exists(item["path"]) for item in items)
@@ -132,3 +132,22 @@ async def test_too_short(framed_buffer, msg_id):
 
     with pytest.raises(asyncio.QueueEmpty):
         framed_buffer.get_nowait()
+
+
+@pytest.mark.asyncio
+async def test_ingress_limit(event_loop):
+    buf = FramedBuffer(loop=event_loop, max_pending=100)
+    first = FramedMessage(header={"cmd": "x"}, payload=FileBackedBuffer.from_data(b"a" * 80))
+    second = FramedMessage(header={"cmd": "y"}, payload=FileBackedBuffer.from_data(b"b" * 80))
+    await buf.put(first.serialize())
+    assert buf.has_room()
+    await buf.put(second.serialize())
+    assert not buf.has_room()
+
+    room = event_loop.create_task(buf.wait_for_room())
+    await asyncio.sleep(0)
+    assert not room.done()
+    buf.release(await buf.get())
+    await asyncio.wait_for(room, 1)
+    buf.release(await buf.get())
+    assert buf.pending_bytes == 0
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from receptor.gather import Gatherer, unpack
+from receptor.messages.framed import FileBackedBuffer, FramedMessage
+
+
+class FakeRouter:
+    node_id = "relay"
+
+    def __init__(self):
+        self.forwarded = []
+
+    def next_hop(self, node_id):
+        return "upstream"
+
+    async def forward(self, msg, next_hop, gather=True):
+        self.forwarded.append(msg)
+
+
+def request():
+    return FramedMessage(header=dict(sender="controller", recipients=["a", "b", "c"]))
+
+
+def response(request, sender, eof=False):
+    header = dict(sender=sender, recipient="controller", in_response_to=request.msg_id, serial=1)
+    if eof:
+        header["eof"] = True
+    return FramedMessage(header=header, payload=FileBackedBuffer.from_data(f"from {sender}"))
+
+
+@pytest.mark.asyncio
+async def test_responses_are_batched_until_delay():
+    router = FakeRouter()
+    gatherer = Gatherer(router, delay=0.01)
+    req = request()
+    gatherer.expect(req, 3)
+
+    assert gatherer.gather(response(req, "a"))
+    assert gatherer.gather(response(req, "b"))
+    assert not gatherer.gather(FramedMessage(header=dict(recipient="x", in_response_to=1)))
+    await asyncio.sleep(0.05)
+
+    [batch] = router.forwarded
+    assert batch.header["batch"] == 2 and batch.header["eofs"] == 0
+    responses = await unpack(batch)
+    assert [r.header["sender"] for r in responses] == ["a", "b"]
+    assert responses[1].payload.readall() == b"from b"
+
+
+@pytest.mark.asyncio
+async def test_last_eof_flushes_and_merges_batches():
+    router = FakeRouter()
+    downstream = Gatherer(router, delay=10)
+    gatherer = Gatherer(router, delay=10)
+    req = request()
+    downstream.expect(req, 2)
+    gatherer.expect(req, 3)
+
+    downstream.gather(response(req, "a", eof=True))
+    downstream.gather(response(req, "b", eof=True))
+    await asyncio.sleep(0)
+    [inner] = router.forwarded
+    assert inner.header["eofs"] == 2
+
+    gatherer.gather(inner)
+    assert req.msg_id in gatherer
+    gatherer.gather(response(req, "c", eof=True))
+    await asyncio.sleep(0)
+    assert req.msg_id not in gatherer
+
+    batch = router.forwarded[-1]
+    assert batch.header["batch"] == 3 and batch.header["eofs"] == 3
+    assert [r.header["sender"] for r in await unpack(batch)] == ["a", "b", "c"]
+
+
+@pytest.mark.asyncio
+async def test_batches_are_forwarded_in_order():
+    class SlowRouter(FakeRouter):
+        async def forward(self, msg, next_hop, gather=True):
+            if not self.forwarded and not msg.header.get("eof"):
+                await asyncio.sleep(0.02)  # the first batch is slow to enqueue
+            self.forwarded.append(msg)
+
+    router = SlowRouter()
+    gatherer = Gatherer(router, delay=10, max_bytes=1)
+    req = request()
+    gatherer.expect(req, 1)
+
+    gatherer.gather(response(req, "a"))
+    gatherer.gather(response(req, "a", eof=True))
+    await asyncio.sleep(0.05)
+    assert [msg.header.get("eof", False) for msg in router.forwarded] == [False, True]
@@ -0,0 +1,127 @@
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+
+from receptor.config import ReceptorConfig
+from receptor.groups import GroupIndex, HashRing
+from receptor.receptor import Receptor
+
+
+def index(**nodes):
+    known_nodes = defaultdict(dict)
+    routing_table = {}
+    for node, (groups, active, threads, cost) in nodes.items():
+        known_nodes[node]["capabilities"] = dict(
+            groups=groups, active_work=active, max_work_threads=threads
+        )
+        if cost is not None:
+            routing_table[node] = ("hop", cost)
+    receptor = SimpleNamespace(
+        node_id="me", known_nodes=known_nodes, router=SimpleNamespace(routing_table=routing_table)
+    )
+    receptor.known_nodes["me"]["capabilities"] = dict(max_work_threads=4)
+    return GroupIndex(receptor)
+
+
+def test_choose_prefers_idle_nearby_members():
+    groups = index(
+        busy=(["workers"], 3, 4, 1),
+        far=(["workers"], 0, 4, 3),
+        near=(["workers"], 0, 4, 1),
+        gone=(["workers"], 0, 4, None),
+        other=(["db"], 0, 4, 1),
+    )
+    assert groups.members("workers") == ["near", "far", "busy"]
+    assert groups.choose("workers") == "near"
+    assert groups.choose("nobody") is None
+
+
+def test_choices_spread_until_next_advertisement():
+    groups = index(a=(["workers"], 0, 2, 1), b=(["workers"], 0, 2, 1))
+    chosen = [groups.choose("workers") for _ in range(4)]
+    assert sorted(chosen) == ["a", "a", "b", "b"]
+
+    groups.invalidate()  # a fresh advertisement resets the estimates
+    assert groups.choose("workers") == "a"
+
+
+def test_choose_skips_excluded_members():
+    groups = index(a=(["workers"], 0, 4, 1), b=(["workers"], 1, 4, 1))
+    assert groups.choose("workers", exclude=["a"]) == "b"
+    assert groups.choose("workers", exclude=["a", "b"]) is None
+    assert groups.choose("workers") == "a"
+
+
+def test_hash_ring_only_moves_keys_of_departed_member():
+    keys = [f"project-{n}" for n in range(1000)]
+    before = HashRing(["a", "b", "c", "d"])
+    after = HashRing(["a", "b", "c"])
+    moved = [key for key in keys if before.get(key) != after.get(key)]
+    assert moved and all(before.get(key) == "d" for key in moved)
+    assert len({before.get(key) for key in keys}) == 4
+
+    key = moved[0]
+    assert before.get(key, exclude=["d"]) == after.get(key)
+    assert before.get(key, exclude=["a", "b", "c", "d"]) is None
+
+
+def test_affinity_is_stable_across_load_changes():
+    groups = index(a=(["workers"], 0, 4, 1), b=(["workers"], 0, 4, 1), c=(["db"], 0, 4, 1))
+    member = groups.affinity("workers", "project-x")
+    groups.receptor.known_nodes[member]["capabilities"]["active_work"] = 4
+    groups.invalidate()
+    assert groups.affinity("workers", "project-x") == member
+    assert groups.affinity("workers", "project-x", exclude=[member]) not in (member, None)
+    assert groups.affinity("nobody", "project-x") is None
+
+
+@pytest.mark.asyncio
+async def test_load_travels_on_its_own(tmpdir):
+    receptor = Receptor(ReceptorConfig(["--data-dir", tmpdir.strpath, "node"]), node_id="hub")
+    sent = []
+
+    async def put(msg):
+        sent.append(msg)
+
+    receptor.buffer_mgr = defaultdict(lambda: SimpleNamespace(put=put))
+    receptor.connections = {
+        "a": [SimpleNamespace(features=frozenset({"load"}))],
+        "b": [SimpleNamespace(features=frozenset({"load"}))],
+        "old": [SimpleNamespace(features=frozenset())],
+    }
+    receptor.known_nodes["a"]
+    busy = receptor.known_nodes["busy"]
+    busy["capabilities"] = dict(groups=["workers"], active_work=0)
+
+    def load(seq, active_work):
+        header = dict(cmd="LOAD", origin="busy", id="a", seq_epoch=1.0, load_seq=seq)
+        return dict(header, load=dict(active_work=active_work))
+
+    await receptor.handle_load_advertisement(load(2, 3))
+    await receptor.handle_load_advertisement(load(2, 3))
+    await receptor.handle_load_advertisement(load(1, 1))
+    assert busy["capabilities"]["active_work"] == 3
+    assert [msg.header["recipient"] for msg in sent] == ["b"]
+
+    # a route advertisement carries a's possibly stale copy of busy's load
+    await receptor.handle_route_advertisement(
+        dict(
+            cmd="ROUTE2",
+            origin="a",
+            id="a",
+            route_adv_id="x",
+            seq_epoch=1.0,
+            sequence=1,
+            connections={"hub": 1, "busy": 1},
+            node_capabilities={"busy": dict(groups=["workers"], active_work=0)},
+        )
+    )
+    assert busy["capabilities"] == dict(groups=["workers"], active_work=3)
+
+    sent.clear()
+    receptor.known_nodes["hub"]["capabilities"]["active_work"] = 1
+    await receptor.send_load()
+    await receptor.send_load()  # unchanged since the last one
+    assert sorted(msg.header["recipient"] for msg in sent) == ["a", "b"]
+    assert sent[0].header["load"] == dict(active_work=1, queue_depth=0)
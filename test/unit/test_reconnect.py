@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from receptor.connection.reconnect import Backoff, supervise
+from receptor.stats import connect_attempts_counter
+
+
+def test_backoff():
+    backoff = Backoff(base=1, cap=10, rand=lambda: 1.0)
+    assert [backoff.next_delay() for _ in range(7)] == [0, 1, 2, 4, 8, 10, 10]
+    backoff.reset()
+    assert backoff.next_delay() == 0
+
+
+def test_backoff_jitter():
+    backoff = Backoff(base=1, cap=10)
+    backoff.next_delay()
+    delays = [backoff.next_delay() for _ in range(20)]
+    assert all(0 <= delay <= 10 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+@pytest.mark.asyncio
+async def test_single_attempt(event_loop):
+    async def fail(established):
+        return False
+
+    assert await supervise(fail, "rnp", reconnect=False, loop=event_loop) is False
+
+
+@pytest.mark.asyncio
+async def test_retries_until_cancelled(event_loop):
+    attempts = []
+
+    async def connect(established):
+        attempts.append(event_loop.time())
+        return len(attempts) > 2
+
+    task = event_loop.create_task(
+        supervise(connect, "rnp", backoff=Backoff(base=0.01, cap=0.02), loop=event_loop)
+    )
+    await asyncio.sleep(0.2)
+    task.cancel()
+    assert len(attempts) > 3
+    assert attempts[1] - attempts[0] < 0.01  # the first retry is immediate
+
+
+def attempts(result):
+    return connect_attempts_counter.labels("rnpu", result)._value.get()
+
+
+@pytest.mark.asyncio
+async def test_attempt_counted_at_handshake(event_loop):
+    closed = event_loop.create_future()
+    calls = []
+
+    async def connect(established):
+        calls.append(established)
+        # the first handshake succeeds and its connection stays up, later ones fail
+        established.set_result(len(calls) == 1)
+        if len(calls) == 1:
+            await closed
+        return True
+
+    connected, failed = attempts("connected"), attempts("failed")
+    task = event_loop.create_task(supervise(connect, "rnpu", loop=event_loop))
+    await asyncio.sleep(0.01)
+    assert (attempts("connected"), attempts("failed")) == (connected + 1, failed)
+
+    closed.set_result(None)
+    await asyncio.sleep(0.01)
+    task.cancel()
+    assert attempts("connected") == connected + 1 and attempts("failed") > failed
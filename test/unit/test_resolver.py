@@ -0,0 +1,57 @@
+import asyncio
+import socket
+
+import pytest
+
+from receptor.connection.resolver import Resolver, interleave, race
+
+V4, V6 = socket.AF_INET, socket.AF_INET6
+
+
+def test_interleave():
+    addrs = [(V6, "a"), (V6, "b"), (V6, "b"), (V6, "c"), (V4, "1"), (V4, "2")]
+    assert interleave(addrs) == [(V6, "a"), (V4, "1"), (V6, "b"), (V4, "2"), (V6, "c")]
+
+
+@pytest.mark.asyncio
+async def test_resolver_caches(event_loop, monkeypatch):
+    lookups = []
+
+    async def getaddrinfo(host, port, type):
+        lookups.append(host)
+        await asyncio.sleep(0)
+        return [(V4, type, 6, "", ("192.0.2.1", port))]
+
+    monkeypatch.setattr(event_loop, "getaddrinfo", getaddrinfo)
+    resolver = Resolver(ttl=60, loop=event_loop)
+    first, second = await asyncio.gather(
+        resolver.resolve("hub", 8888), resolver.resolve("hub", 8888)
+    )
+    assert first == second == [(V4, ("192.0.2.1", 8888))]
+    await resolver.resolve("hub", 8888)
+    assert lookups == ["hub"]
+    resolver.forget("hub", 8888)
+    await resolver.resolve("hub", 8888)
+    assert lookups == ["hub", "hub"]
+
+
+@pytest.mark.asyncio
+async def test_race_fails_over(event_loop):
+    server = await asyncio.start_server(lambda r, w: w.close(), "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+    dead_port = closed.getsockname()[1]
+    closed.close()
+
+    candidates = [("down", V4, ("127.0.0.1", dead_port)), ("up", V4, ("127.0.0.1", port))]
+    start = event_loop.time()
+    sock, host = await race(candidates, delay=5, loop=event_loop)
+    sock.close()
+    server.close()
+    assert host == "up"
+    # A refused attempt starts the next one without waiting out the delay
+    assert event_loop.time() - start < 1
+
+    with pytest.raises(OSError):
+        await race(candidates[:1], loop=event_loop)
@@ -0,0 +1,88 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from receptor.exceptions import ResponseOverflowError
+from receptor.messages.framed import FramedMessage
+from receptor.receptor import Receptor
+from receptor.responses import ResponseRegistry, ResponseStream
+
+
+def response(msg_id, serial, eof=False):
+    header = {"in_response_to": msg_id, "serial": serial}
+    if eof:
+        header["eof"] = True
+    return FramedMessage(header=header)
+
+
+@pytest.mark.asyncio
+async def test_stream_ends_at_eof(event_loop):
+    registry = ResponseRegistry()
+    stream = ResponseStream("m1", loop=event_loop)
+    registry.register("m1", None, stream=stream)
+    assert stream == "m1" and "m1" in registry
+
+    for msg in (response("m1", 1), response("m1", 2, eof=True)):
+        assert registry.received(msg)["stream"].put_nowait(msg)
+    assert "m1" not in registry
+    assert [msg.header["serial"] async for msg in stream] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_unread_stream_spills_to_queue(event_loop):
+    registry = ResponseRegistry()
+    stream = ResponseStream("m1", maxsize=2, loop=event_loop)
+    registry.register("m1", None, stream=stream, on_done=lambda: done.append(1))
+    done = []
+    receptor = SimpleNamespace(
+        router=SimpleNamespace(response_registry=registry), response_queue=asyncio.Queue()
+    )
+    for msg in (response("m1", 1), response("m1", 2), response("m1", 3)):
+        await asyncio.wait_for(Receptor.handle_response(receptor, msg), 1)
+    assert "m1" in registry and not done
+
+    await Receptor.handle_response(receptor, response("m1", 4, eof=True))
+    assert "m1" not in registry and done
+    queued = [receptor.response_queue.get_nowait() for _ in range(2)]
+    assert [msg.header["serial"] for msg in queued] == [3, 4]
+    assert [(await stream.__anext__()).header["serial"] for _ in range(2)] == [1, 2]
+    with pytest.raises(ResponseOverflowError):
+        await stream.__anext__()
+
+
+@pytest.mark.asyncio
+async def test_registry_times_out(event_loop):
+    registry = ResponseRegistry(timeout=0.01)
+    stream = ResponseStream("m1", loop=event_loop)
+    registry.register("m1", None, stream=stream)
+    registry.register("m2", None)
+    await asyncio.sleep(0.05)
+    assert len(registry) == 0
+    with pytest.raises(asyncio.TimeoutError):
+        await stream.__anext__()
+
+
+@pytest.mark.asyncio
+async def test_closed_stream_is_forgotten(event_loop):
+    registry = ResponseRegistry()
+    stream = ResponseStream("m1", loop=event_loop)
+    registry.register("m1", None, stream=stream)
+    stream.close()
+    assert "m1" not in registry
+    assert [msg async for msg in stream] == []
+
+
+@pytest.mark.asyncio
+async def test_multicast_stream_waits_for_every_recipient(event_loop):
+    registry = ResponseRegistry()
+    stream = ResponseStream("m1", eofs=3, loop=event_loop)
+    registry.register("m1", None, stream=stream, eofs=3)
+
+    expired = response("m1", 1, eof=True)
+    expired.header["covers"] = ["b", "c"]
+    for msg in (response("m1", 1, eof=True), expired):
+        assert registry.received(msg)["stream"].put_nowait(msg)
+        assert "m1" in registry or msg is expired
+    assert "m1" not in registry and stream.done
+    assert len([msg async for msg in stream]) == 2
@@ -1,4 +1,12 @@
+import asyncio
+from collections import defaultdict
+from types import SimpleNamespace
+
 import pytest
+
+from receptor.config import ReceptorConfig
+from receptor.messages.framed import FramedMessage
+from receptor.receptor import Receptor
 from receptor.router import MeshRouter
 
 test_networks = [
@@ -48,3 +56,123 @@ def test_neighbors(edges, expected_next_hops, expected_neighbors):
     r.add_or_update_edges(edges)
     for node_id, neighbors in expected_neighbors:
         assert r.get_neighbors(node_id) == neighbors
+
+
+class RecordingBuffer:
+    def __init__(self):
+        self.messages = []
+
+    async def put(self, msg):
+        self.messages.append(msg)
+
+
+def multicast_router(features):
+    handled = []
+    receptor = SimpleNamespace(
+        node_id="a",
+        config=SimpleNamespace(
+            default_response_timeout=10, node_gather_delay=0.01, node_gather_bytes=2 ** 20
+        ),
+        connections={
+            "b": [SimpleNamespace(features=frozenset(features))],
+            "e": [SimpleNamespace(features=frozenset(features))],
+        },
+        buffer_mgr=defaultdict(RecordingBuffer),
+        dispatch=handled.append,
+    )
+    r = MeshRouter(receptor)
+    r.add_or_update_edges([("a", "b", 1), ("b", "c", 1), ("b", "d", 1), ("a", "e", 1)])
+    return r, handled
+
+
+def multicast_message(recipients):
+    return FramedMessage(
+        header=dict(recipients=recipients, directive="plugin:method", timestamp=None)
+    )
+
+
+@pytest.mark.asyncio
+async def test_multicast_copies_once_per_branch():
+    r, handled = multicast_router({"multicast"})
+    msg = multicast_message(["c", "d", "e", "a", "x"])
+    await r.send(msg, expected_response=True)
+    await asyncio.sleep(0)
+
+    [to_b] = r.receptor.buffer_mgr["b"].messages
+    assert to_b.msg_id == msg.msg_id
+    assert to_b.header["recipient"] == "b" and to_b.header["recipients"] == ["c", "d"]
+    [to_e] = r.receptor.buffer_mgr["e"].messages
+    assert to_e.header["recipient"] == "e" and "recipients" not in to_e.header
+
+    # a copy for this node, and an error for x, which has no route
+    local, error = sorted(handled, key=lambda m: "in_response_to" in m.header)
+    assert local.header["recipient"] == "a" and local.msg_id == msg.msg_id
+    assert error.header["covers"] == ["x"] and error.header["eof"]
+
+    entry = r.response_registry.received(error)
+    assert entry["eofs"] == 4
+
+
+@pytest.mark.asyncio
+async def test_multicast_to_legacy_neighbor_sends_unicast_copies():
+    r, _ = multicast_router(set())
+    await r.multicast(
+        FramedMessage(header=dict(recipients=["c", "d"], sender="z", route_list=["z"]))
+    )
+    assert [m.header["recipient"] for m in r.receptor.buffer_mgr["b"].messages] == ["c", "d"]
+    assert not any("recipients" in m.header for m in r.receptor.buffer_mgr["b"].messages)
+
+
+def advert(origin, sequence=1, **connections):
+    return dict(
+        cmd="ROUTE2",
+        origin=origin,
+        id=origin,
+        route_adv_id=f"{origin}-{sequence}",
+        seq_epoch=1.0,
+        sequence=sequence,
+        connections=connections,
+    )
+
+
+@pytest.mark.asyncio
+async def test_route_advertisement_forwarded_while_a_peer_connects(tmpdir):
+    receptor = Receptor(ReceptorConfig(["--data-dir", tmpdir.strpath, "node"]), node_id="hub")
+    receptor.known_nodes["a"]  # known already, so no advertisement back is scheduled
+
+    class ConnectingBuffer(RecordingBuffer):
+        async def put(self, msg):
+            await super().put(msg)
+            receptor.connections.setdefault("late", [])  # registered meanwhile
+
+    receptor.buffer_mgr = defaultdict(ConnectingBuffer)
+    receptor.connections = {"a": [object()], "b": [object()], "c": [object()]}
+    await receptor.handle_route_advertisement(advert("a", hub=1))
+    assert receptor.known_nodes["a"]["sequence"] == 1
+    assert all(receptor.buffer_mgr[node].messages for node in ("b", "c"))
+
+
+@pytest.mark.asyncio
+async def test_bad_advertisement_does_not_stop_the_message_handler(tmpdir):
+    receptor = Receptor(ReceptorConfig(["--data-dir", tmpdir.strpath, "node"]), node_id="hub")
+    receptor.known_nodes["a"]  # known already, so no advertisement back is scheduled
+    receptor.buffer_mgr = defaultdict(RecordingBuffer)
+    malformed = dict(advert("a"), origin=None, cmd="ROUTE1")
+
+    class Inbox:
+        def __init__(self, *headers):
+            self.messages = [FramedMessage(header=header) for header in headers]
+            self.released = []
+
+        async def get(self):
+            if not self.messages:
+                raise asyncio.CancelledError()
+            return self.messages.pop(0)
+
+        def release(self, msg):
+            self.released.append(msg)
+
+    inbox = Inbox(malformed, advert("a", hub=1))
+    await receptor.message_handler(inbox)
+    assert len(inbox.released) == 2
+    assert receptor.known_nodes["a"]["sequence"] == 1
@@ -0,0 +1,27 @@
+from receptor import shards
+
+
+def test_shard_node_id():
+    assert shards.shard_node_id("hub", 0) == "hub"
+    assert shards.shard_node_id("hub", 2) == "hub-shard2"
+
+
+def test_shards_form_full_mesh():
+    links = set()
+    for shard in range(4):
+        listen = shards.shard_listen_url("/data", "hub", shard)
+        assert listen == "rnpu:///data/hub/shard-%d.sock" % shard
+        for peer in shards.shard_peer_urls("/data", "hub", shard):
+            links.add(frozenset((listen, peer)))
+    assert len(links) == 4 * 3 // 2
+
+
+def test_peers_dealt_out():
+    peers = ["a", "b", "c", "d", "e"]
+    dealt = [shards.shard_peers(peers, shard, 2) for shard in range(2)]
+    assert dealt == [["a", "c", "e"], ["b", "d"]]
+
+
+def test_sibling_ids():
+    assert shards.sibling_ids("hub", 0, 3) == {"hub-shard1", "hub-shard2"}
+    assert shards.sibling_ids("hub-shard2", 2, 3) == {"hub", "hub-shard1"}
@@ -0,0 +1,71 @@
+import asyncio
+import errno
+import os
+import socket
+import stat
+
+import pytest
+
+from receptor.connection.base import StreamStats
+from receptor.connection.manager import parse_peer
+from receptor.connection.sock import RawSocket, peer_credentials, unix_listener
+from receptor.stats import stream_bytes_sent
+
+
+def test_read_size_grows_and_shrinks():
+    t = RawSocket(None, None, chunk_size=2 ** 16, min_chunk=2 ** 12, max_chunk=2 ** 18)
+    for _ in range(4):
+        t._adapt(t.chunk_size)
+    assert t.chunk_size == 2 ** 18
+
+    for _ in range(20):
+        t._adapt(100)
+    assert t.chunk_size == 2 ** 12
+
+
+def test_stream_stats():
+    stats = StreamStats()
+    stats.sent(10)
+    stats.peer = "node2"
+    stats.sent(5)
+    stats.received(7)
+    stats.message_sent()
+    snapshot = stats.snapshot()
+    assert (snapshot["bytes_sent"], snapshot["bytes_recv"], snapshot["messages_sent"]) == (15, 7, 1)
+    assert stream_bytes_sent.labels("node2")._value.get() == 5
+
+
+def test_parse_unix_peer():
+    assert parse_peer("rnpu:///run/receptor.sock", "server").path == "/run/receptor.sock"
+    assert parse_peer("rnpu://localhost/run/receptor.sock", "client").path == "/run/receptor.sock"
+    for url in ("rnpu://", "rnpu://host/run/receptor.sock"):
+        with pytest.raises(RuntimeError):
+            parse_peer(url, "client")
+
+
+@pytest.mark.asyncio
+async def test_unix_listener(event_loop, tmp_path):
+    path = str(tmp_path / "receptor.sock")
+    received = event_loop.create_future()
+
+    async def serve(reader, writer):
+        creds = peer_credentials(writer.get_extra_info("socket"))
+        data = await reader.read(5)
+        if data:
+            received.set_result((data, creds))
+        writer.close()
+
+    unix_listener(path).close()  # a stale socket file is replaced
+    server = await asyncio.start_unix_server(serve, sock=unix_listener(path, 0o640))
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    _, w = await asyncio.open_unix_connection(path)
+    w.write(b"hello")
+    data, creds = await asyncio.wait_for(received, 5)
+    w.close()
+    with pytest.raises(OSError) as exc:
+        unix_listener(path)  # the socket file of a live listener is kept
+    assert exc.value.errno == errno.EADDRINUSE
+    server.close()
+    assert data == b"hello"
+    if hasattr(socket, "SO_PEERCRED"):
+        assert creds["uid"] == os.getuid()
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+import pytest
+
+from receptor import fileio
+from receptor.buffers.sqlite import SQLiteBufferManager
+from receptor.exceptions import ReceptorBufferError
+from receptor.messages.framed import FramedMessage
+
+
+@pytest.fixture
+def tempdir():
+    dir_ = tempfile.mkdtemp()
+    yield dir_
+    shutil.rmtree(dir_)
+
+
+def directive(recipient="node2", **extra):
+    header = {"sender": "node1", "recipient": recipient, "directive": "x:y"}
+    header.update(extra)
+    return FramedMessage(header=header)
+
+
+@pytest.mark.asyncio
+async def test_put_get(event_loop, tempdir):
+    mgr = SQLiteBufferManager(tempdir, event_loop)
+    b = mgr["node2"]
+    await b.put(b"some data")
+    item = await b.get()
+    data = await fileio.read(item["path"])
+    assert data == b"some data"
+    assert await mgr.summary() == {}
+
+
+@pytest.mark.asyncio
+async def test_priority_order(event_loop, tempdir):
+    b = SQLiteBufferManager(tempdir, event_loop)["node2"]
+    await b.put(directive())
+    await b.put(FramedMessage(header={"cmd": "ROUTE2"}))
+    assert (await b.get())["priority"] == "control"
+    assert (await b.get())["priority"] == "bulk"
+
+
+@pytest.mark.asyncio
+async def test_queued_for(event_loop, tempdir):
+    mgr = SQLiteBufferManager(tempdir, event_loop)
+    await mgr["node2"].put(directive("node3"))
+    await mgr["node2"].put(directive("node3"))
+    await mgr["node4"].put(directive("node4"))
+    queued = await mgr.queued_for("node3")
+    assert queued["messages"] == 2
+    assert queued["bytes"] > 0
+    assert await mgr.summary() == {
+        "node2": {"control": 0, "interactive": 0, "bulk": 2},
+        "node4": {"control": 0, "interactive": 0, "bulk": 1},
+    }
+
+
+@pytest.mark.asyncio
+async def test_expiry(event_loop, tempdir):
+    expired = []
+
+    async def on_expire(item):
+        expired.append(item)
+
+    b = SQLiteBufferManager(tempdir, event_loop, on_expire=on_expire)["node2"]
+    late = directive(deadline=time.time())
+    await b.put(late)
+    await b.put(directive())
+    await b.expire_all()
+    assert [item["msg_id"] for item in expired] == [late.msg_id]
+    assert not os.path.exists(expired[0]["path"])
+    assert b.qsize() == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_get_keeps_message(event_loop, tempdir):
+    b = SQLiteBufferManager(tempdir, event_loop)["node2"]
+    msg = directive()
+    await b.put(msg)
+    getter = event_loop.create_task(b.get())
+    while b.qsize():
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)  # the pop is now queued on the database thread
+    getter.cancel()
+    item = await asyncio.wait_for(b.get(), 1)
+    assert item["msg_id"] == msg.msg_id
+
+
+@pytest.mark.asyncio
+async def test_restart(event_loop, tempdir):
+    mgr = SQLiteBufferManager(tempdir, event_loop)
+    await mgr["node2"].put(directive())
+    await mgr.close()
+
+    restarted = SQLiteBufferManager(tempdir, event_loop)
+    recovery = await restarted.recover()
+    assert recovery["node2"]["queued"] == 1
+    item = await restarted["node2"].get()
+    assert item["recipient"] == "node2"
+
+
+@pytest.mark.asyncio
+async def test_close(event_loop, tempdir):
+    mgr = SQLiteBufferManager(tempdir, event_loop)
+    b = mgr["node2"]
+    await b.put(directive())
+    assert not hasattr(b, "q")  # the queue lives in the database
+    await mgr.close()
+    assert not mgr.store._thread.is_alive()
+    with pytest.raises(ReceptorBufferError):
+        await b.put(directive())
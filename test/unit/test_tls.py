@@ -0,0 +1,71 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+
+import pytest
+
+from receptor.config import ReceptorConfig
+
+pytestmark = pytest.mark.skipif(shutil.which("openssl") is None, reason="needs openssl")
+
+
+def openssl(command, cwd):
+    subprocess.run(["openssl", *command.split()], cwd=cwd, check=True, capture_output=True)
+
+
+@pytest.fixture(scope="module")
+def config():
+    dir_ = tempfile.mkdtemp()
+    openssl("req -x509 -newkey rsa:2048 -nodes -keyout ca.key -out ca.pem -subj /CN=ca", dir_)
+    openssl("req -newkey rsa:2048 -nodes -keyout node.key -out node.csr -subj /CN=localhost", dir_)
+    with open(os.path.join(dir_, "ext"), "w") as fp:
+        fp.write("subjectAltName=DNS:localhost\n")
+    openssl(
+        "x509 -req -in node.csr -CA ca.pem -CAkey ca.key -CAcreateserial -out node.pem -days 1 "
+        "-extfile ext",
+        dir_,
+    )
+    conf = os.path.join(dir_, "receptor.conf")
+    with open(conf, "w") as fp:
+        fp.write(
+            f"[auth]\nserver_cert={dir_}/node.pem\nserver_key={dir_}/node.key\n"
+            f"server_ca_bundle={dir_}/ca.pem\n"
+        )
+    yield ReceptorConfig(["-c", conf, "node"])
+    shutil.rmtree(dir_)
+
+
+def test_context_cache(config):
+    client = config.get_ssl_context("client")
+    assert config.get_ssl_context("client") is client
+    os.utime(config.auth_server_ca_bundle, ns=(0, 0))
+    assert config.get_ssl_context("client") is not client
+
+
+@pytest.mark.asyncio
+async def test_session_resumption(event_loop, config):
+    async def handle(reader, writer):
+        writer.write(b"x")
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(
+        handle, "127.0.0.1", 0, ssl=config.get_ssl_context("server")
+    )
+    port = server.sockets[0].getsockname()[1]
+    client = config.get_ssl_context("client")
+    reused = []
+    for _ in range(2):
+        r, w = await asyncio.open_connection(
+            "127.0.0.1", port, ssl=client, server_hostname="localhost"
+        )
+        await r.read()
+        ssl_object = w.get_extra_info("ssl_object")
+        reused.append(ssl_object.session_reused)
+        client.remember("localhost", ssl_object)
+        w.close()
+    server.close()
+    await server.wait_closed()
+    assert reused == [False, True]
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from receptor.messages.framed import FramedMessage
+from receptor.responses import ResponseRegistry, ResponseStream
+from receptor.window import SendWindow
+
+
+@pytest.mark.asyncio
+async def test_window_limits_outstanding(event_loop):
+    window = SendWindow(limit=2, loop=event_loop)
+    first = await window.acquire("node1")
+    await window.acquire("node2")
+    blocked = event_loop.create_task(window.acquire("node1"))
+    await asyncio.sleep(0.01)
+    assert not blocked.done() and window.waiting == 1
+
+    first()
+    first()  # releasing twice gives back one slot
+    await asyncio.wait_for(blocked, 1)
+    stats = window.stats()
+    assert stats["outstanding"] == 2 and stats["completed"] == 1 and stats["sent"] == 3
+    assert stats["latency_mean"] is not None
+
+
+@pytest.mark.asyncio
+async def test_full_recipient_does_not_block_others(event_loop):
+    window = SendWindow(limit=3, per_recipient=1, loop=event_loop)
+    busy = await window.acquire("busy")
+    queued = event_loop.create_task(window.acquire("busy"))
+    await asyncio.sleep(0)
+    await asyncio.wait_for(window.acquire("idle"), 1)
+    assert not queued.done()
+
+    busy()
+    await asyncio.wait_for(queued, 1)
+
+
+@pytest.mark.asyncio
+async def test_recipients_take_turns(event_loop):
+    window = SendWindow(limit=1, loop=event_loop)
+    release = await window.acquire("a")
+    granted = []
+
+    async def send(recipient):
+        done = await window.acquire(recipient)
+        granted.append(recipient)
+        await asyncio.sleep(0)
+        done()
+
+    tasks = [event_loop.create_task(send(r)) for r in ("a", "a", "a", "b")]
+    await asyncio.sleep(0)
+    release()
+    await asyncio.wait_for(asyncio.gather(*tasks), 1)
+    assert granted == ["a", "b", "a", "a"]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_gives_up_its_place(event_loop):
+    window = SendWindow(limit=1, loop=event_loop)
+    release = await window.acquire("node1")
+    waiter = event_loop.create_task(window.acquire("node1"))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    await asyncio.sleep(0)
+    assert window.waiting == 0
+    release()
+    assert window.outstanding == 0
+
+
+@pytest.mark.asyncio
+async def test_registry_releases_slot(event_loop):
+    window = SendWindow(limit=2, loop=event_loop)
+    registry = ResponseRegistry(timeout=0.01)
+    for msg_id in ("m1", "m2"):
+        stream = ResponseStream(msg_id, loop=event_loop)
+        registry.register(msg_id, None, stream=stream, on_done=await window.acquire("node1"))
+    assert window.outstanding == 2
+
+    registry.received(FramedMessage(header={"in_response_to": "m1", "eof": True}))
+    assert window.outstanding == 1
+    await asyncio.sleep(0.05)  # m2 times out
+    assert window.outstanding == 0
@@ -0,0 +1,281 @@
+import asyncio
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+
+from receptor import exceptions, work as work_module
+from receptor.config import ReceptorConfig
+from receptor.groups import GroupIndex
+from receptor.messages.framed import FileBackedBuffer, FramedMessage
+from receptor.plugin_utils import BYTES_PAYLOAD, plugin_export
+from receptor.receptor import Receptor
+from receptor.work import WorkManager
+
+
+class FakeRouter:
+    def __init__(self):
+        self.sent = []
+        self.forwarded = []
+        self.routing_table = {}
+
+    def next_hop(self, node_id):
+        return "hop"
+
+    async def send(self, msg):
+        self.sent.append(msg)
+
+    async def forward(self, msg, next_hop):
+        self.forwarded.append((msg, next_hop))
+
+
+class FakeReceptor:
+    node_id = "busy"
+
+    def __init__(self, stealing=True):
+        self.config = SimpleNamespace(
+            default_max_workers=1,
+            node_groups=["workers"],
+            node_work_stealing=stealing,
+            node_steal_interval=1.0,
+            default_max_async_work=2,
+            _is_ephemeral=False,
+            plugins={},
+        )
+        self.router = FakeRouter()
+        self.router.groups = GroupIndex(self)
+        self.known_nodes = defaultdict(lambda: dict(capabilities={}))
+        self.changes = 0
+        self.adverts = 0
+
+    def load_changed(self):
+        self.changes += 1
+
+    async def send_routes(self):
+        self.adverts += 1
+
+
+def add_thief(receptor, node="idle", groups=("workers",)):
+    receptor.known_nodes[node]["capabilities"] = dict(
+        groups=list(groups), worker_versions={"sleepy": "1"}
+    )
+    receptor.router.routing_table[node] = ("hop", 1)
+
+
+def work(directive="sleepy:nap", **header):
+    header.update(sender="controller", recipient="busy", directive=directive)
+    return FramedMessage(header=header, payload=FileBackedBuffer.from_data("1"))
+
+
+async def queue(manager, *messages):
+    waiting = [asyncio.ensure_future(manager._wait_for_thread(m)) for m in messages]
+    await asyncio.sleep(0)
+    return waiting
+
+
+@pytest.mark.asyncio
+async def test_work_waits_for_a_thread_in_order():
+    manager = WorkManager(FakeReceptor(stealing=False))
+    first, second, third = await queue(manager, work(), work(), work())
+    assert first.result() is True
+    assert len(manager.pending) == 2 and not second.done()
+
+    manager._thread_done()
+    await asyncio.sleep(0)
+    assert second.result() is True and not third.done()
+
+
+@pytest.mark.asyncio
+async def test_give_away_hands_over_newest_eligible_work():
+    receptor = FakeReceptor()
+    add_thief(receptor)
+    manager = WorkManager(receptor)
+    messages = [
+        work(),
+        work(),
+        work(affinity_key="project-x"),
+        work(directive="other:run"),
+        work(),
+        work(),
+    ]
+    waiting = await queue(manager, *messages)
+
+    await manager.give_away("idle", 2)
+    await asyncio.sleep(0)
+    assert [msg for msg, _ in receptor.router.forwarded] == [messages[4], messages[5]]
+    assert all(msg.header["recipient"] == "idle" for msg, _ in receptor.router.forwarded)
+    assert messages[5].header["stolen_from"] == "busy"
+    assert [w.result() for w in waiting[4:]] == [False, False]
+    assert [msg for msg, _ in manager.pending] == messages[1:4]
+
+
+@pytest.mark.asyncio
+async def test_stolen_work_is_not_given_away_again():
+    receptor = FakeReceptor()
+    add_thief(receptor)
+    manager = WorkManager(receptor)
+    await queue(manager, work(), work(stolen_from="elsewhere"))
+
+    await manager.give_away("idle", 1)
+    assert not receptor.router.forwarded and len(manager.pending) == 1
+
+
+@pytest.mark.asyncio
+async def test_work_is_only_given_to_members_of_its_group():
+    receptor = FakeReceptor()
+    receptor.config.node_groups = ["workers", "db"]
+    add_thief(receptor, "outsider", groups=["web"])
+    add_thief(receptor, "dba", groups=["db"])
+    manager = WorkManager(receptor)
+    messages = [work(group="workers"), work(group="db"), work()]
+    await queue(manager, work(), *messages)  # the first takes the only thread
+
+    await manager.give_away("outsider", 3)
+    await manager.give_away("stranger", 3)
+    assert not receptor.router.forwarded and len(manager.pending) == 3
+    assert "stranger" not in receptor.known_nodes
+
+    await manager.give_away("dba", 3)
+    assert [msg for msg, _ in receptor.router.forwarded] == messages[1:]
+
+
+@pytest.mark.asyncio
+async def test_idle_member_asks_deepest_queue():
+    receptor = FakeReceptor()
+    receptor.node_id = "idle"
+    receptor.known_nodes["a"]["capabilities"] = dict(groups=["workers"], queue_depth=2)
+    receptor.known_nodes["b"]["capabilities"] = dict(groups=["workers"], queue_depth=5)
+    receptor.known_nodes["c"]["capabilities"] = dict(groups=["db"], queue_depth=9)
+    manager = WorkManager(receptor)
+
+    manager.maybe_steal()
+    manager.maybe_steal()  # within the steal interval
+    await asyncio.sleep(0)
+    [request] = receptor.router.sent
+    assert request.header["recipient"] == "b"
+    assert request.header["directive"] == "receptor:steal"
+
+
+class FakeEntryPoint:
+    def __init__(self, name, module, version):
+        self.name = name
+        self.module = module
+        self.dist = SimpleNamespace(version=version)
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return self.module
+
+
+@plugin_export(payload_type=BYTES_PAYLOAD)
+def nap(payload, config, queue):
+    pass
+
+
+def not_exported(payload, config, queue):
+    pass
+
+
+@pytest.mark.asyncio
+async def test_plugins_are_discovered_once(monkeypatch):
+    plugin = FakeEntryPoint("sleepy", SimpleNamespace(nap=nap, hidden=not_exported), "1.0")
+    discoveries = []
+    monkeypatch.setattr(
+        work_module, "discover_plugins", lambda: discoveries.append(1) or {"sleepy": plugin}
+    )
+    receptor = FakeReceptor()
+    manager = WorkManager(receptor)
+    receptor.known_nodes["busy"]["capabilities"] = manager.get_capabilities()
+
+    for _ in range(3):
+        assert manager.get_action_method("sleepy:nap") == (nap, "sleepy")
+        assert manager.get_capabilities()["worker_versions"] == {"sleepy": "1.0"}
+    with pytest.raises(exceptions.InvalidDirectiveAction):
+        manager.get_action_method("sleepy:hidden")
+    with pytest.raises(exceptions.UnknownDirective):
+        manager.get_action_method("other:run")
+    assert len(discoveries) == 1 and plugin.loads == 1
+
+    plugin.dist.version = "1.1"
+    manager.reload_plugins()
+    await asyncio.sleep(0)
+    assert len(discoveries) == 2 and receptor.adverts == 1
+    assert receptor.known_nodes["busy"]["capabilities"]["worker_versions"] == {"sleepy": "1.1"}
+
+
+@pytest.mark.asyncio
+async def test_peers_see_reloaded_versions(monkeypatch, tmpdir):
+    plugin = FakeEntryPoint("sleepy", SimpleNamespace(nap=nap), "1.0")
+    monkeypatch.setattr(work_module, "discover_plugins", lambda: {"sleepy": plugin})
+
+    def node(node_id):
+        config = ReceptorConfig(["--data-dir", tmpdir.join(node_id).strpath, "node"])
+        return Receptor(config, node_id=node_id)
+
+    busy, peer = node("busy"), node("peer")
+    adverts = []
+
+    async def put(msg):
+        adverts.append(msg)
+
+    busy.buffer_mgr = defaultdict(lambda: SimpleNamespace(put=put))
+    busy.connections = {"peer": [SimpleNamespace(features=frozenset())]}
+
+    plugin.dist.version = "1.1"
+    busy.work_manager.reload_plugins()
+    for _ in range(10):
+        await asyncio.sleep(0)
+    (advert,) = adverts
+    await peer.handle_route_advertisement(advert.header)
+    assert peer.known_nodes["busy"]["capabilities"]["worker_versions"] == {"sleepy": "1.1"}
+
+
+@plugin_export(payload_type=BYTES_PAYLOAD)
+async def count(payload, config):
+    for n in range(int(payload)):
+        await asyncio.sleep(0)
+        yield str(n)
+
+
+@plugin_export(payload_type=BYTES_PAYLOAD)
+async def fail(payload, config):
+    await asyncio.sleep(0)
+    raise ValueError(payload.decode())
+
+
+@pytest.mark.asyncio
+async def test_async_actions_run_on_the_loop(monkeypatch):
+    plugin = FakeEntryPoint("aio", SimpleNamespace(count=count, fail=fail), "1.0")
+    monkeypatch.setattr(work_module, "discover_plugins", lambda: {"aio": plugin})
+    receptor = FakeReceptor()
+    manager = WorkManager(receptor)
+    assert manager.is_native("aio:count") and not manager.is_native("other:run")
+
+    messages = [
+        FramedMessage(
+            header=dict(sender="controller", recipient="busy", directive=directive),
+            payload=FileBackedBuffer.from_data(data),
+        )
+        for directive, data in [("aio:count", "2"), ("aio:count", "3"), ("aio:fail", "oops")]
+    ]
+    await asyncio.gather(*map(manager.handle, messages))
+    assert manager.running == 0 and not manager.active_work
+    assert not manager.saturated("aio:count")
+
+    def sent(msg):
+        return [
+            (m.header.get("code"), m.payload.readall() if m.payload else None)
+            for m in receptor.router.sent
+            if m.header["in_response_to"] == msg.msg_id
+        ]
+
+    assert sent(messages[0]) == [(None, b"0"), (None, b"1"), (0, None)]
+    assert sent(messages[1]) == [(None, b"0"), (None, b"1"), (None, b"2"), (0, None)]
+    assert sent(messages[2]) == [(1, b"oops")]
+
+
+def test_version_of_plugin_without_distribution():
+    entry_point = SimpleNamespace(name="no-such-plugin")
+    module = SimpleNamespace(__package__="no_such_plugin.actions", __name__="no_such_plugin")
+    assert work_module.plugin_version(entry_point, module) == "unknown"
@@ -0,0 +1,174 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from receptor.connection.base import (
+    Stripes,
+    StreamStats,
+    Transport,
+    Worker,
+    negotiate_features,
+)
+from receptor.messages.framed import FramedBuffer, FramedMessage
+
+
+class FakeTransport(Transport):
+    heartbeat = True
+
+    def __init__(self):
+        self.sent = []
+        self._closed = False
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+    @property
+    def closed(self):
+        return self._closed
+
+    async def close(self):
+        self._closed = True
+
+    async def send(self, q):
+        async for chunk in q:
+            self.sent.append(chunk)
+
+
+@pytest.fixture
+def worker(event_loop):
+    config = SimpleNamespace(
+        default_ingress_limit=0, node_heartbeat_interval=1, node_heartbeat_misses=3
+    )
+    w = Worker(SimpleNamespace(config=config), event_loop)
+    w.conn = FakeTransport()
+    w.remote_heartbeat = 1
+    return w
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_closes_silent_link(event_loop, worker):
+    worker.last_recv = event_loop.time()
+    await asyncio.wait_for(worker.heartbeat(0.01), 1)
+    assert worker.conn.closed
+    assert 1 <= len(worker.conn.sent) <= 3
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_keeps_live_link(event_loop, worker):
+    async def receive():
+        while True:
+            worker.last_recv = event_loop.time()
+            await asyncio.sleep(0.005)
+
+    worker.last_recv = event_loop.time()
+    receiving = event_loop.create_task(receive())
+    beating = event_loop.create_task(worker.heartbeat(0.01))
+    await asyncio.sleep(0.1)
+    assert not worker.conn.closed
+    receiving.cancel()
+    beating.cancel()
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_spares_link_paused_by_backpressure(event_loop, worker):
+    class OneFrame(FakeTransport):
+        stats = StreamStats()
+        frames = [FramedMessage(header={"sender": "peer"}).serialize()]
+
+        async def __anext__(self):
+            if self.frames:
+                return self.frames.pop()
+            await asyncio.sleep(3600)
+
+    worker.buf = FramedBuffer(loop=event_loop, max_pending=1)
+    worker.conn = OneFrame()
+    worker.last_recv = event_loop.time()
+    receiving = event_loop.create_task(worker.receive())
+    beating = event_loop.create_task(worker.heartbeat(0.01))
+    await asyncio.sleep(0.1)  # paused for more than interval * misses
+    assert worker.reading_paused and not worker.conn.closed
+
+    worker.buf.release(await worker.buf.get())
+    await asyncio.sleep(0.02)
+    assert not worker.reading_paused and not worker.conn.closed
+    receiving.cancel()
+    beating.cancel()
+
+
+def test_heartbeat_needs_both_ends(worker):
+    assert worker._heartbeat_interval() == 1
+    worker.remote_heartbeat = None
+    assert worker._heartbeat_interval() is None
+
+
+def test_negotiate_features():
+    assert negotiate_features({"version": 2, "features": ["heartbeat", "telepathy"]}) == {
+        "heartbeat"
+    }
+    assert negotiate_features({"version": 3, "features": []}) == set()
+    # Version 1 peers only announce a heartbeat interval
+    assert negotiate_features({"heartbeat": 10}) == {"heartbeat"}
+    assert negotiate_features({"heartbeat": None}) == set()
+
+
+class FakeBuffer:
+    def __init__(self, items):
+        self.q = asyncio.Queue()
+        for item in items:
+            self.q.put_nowait(item)
+
+    async def get(self):
+        return await self.q.get()
+
+    async def put_ident(self, item):
+        self.q.put_nowait(item)
+
+
+@pytest.mark.asyncio
+async def test_stripes_keep_each_requests_responses_on_one_connection():
+    items = [dict(flow=n % 4, serial=n) for n in range(40)] + [dict(serial=n) for n in range(8)]
+    stripes = Stripes(FakeBuffer(items))
+    connections = [stripes.join() for _ in range(3)]
+    sent = {stripe: [] for stripe in connections}
+
+    async def drain(stripe):
+        while True:
+            sent[stripe].append(await stripe.get())
+            await asyncio.sleep(0)
+
+    draining = [asyncio.ensure_future(drain(stripe)) for stripe in connections]
+    await asyncio.sleep(0.05)
+    assert sum(map(len, sent.values())) == len(items)
+    for flow in range(4):
+        [on] = [
+            stripe for stripe in connections if any(i.get("flow") == flow for i in sent[stripe])
+        ]
+        assert [i["serial"] for i in sent[on] if i.get("flow") == flow] == list(range(flow, 40, 4))
+    for task in draining:
+        task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_leaving_stripe_returns_pinned_messages():
+    buffer = FakeBuffer([dict(flow=1), dict(flow=2)])
+    stripes = Stripes(buffer)
+    first, second = stripes.join(), stripes.join()
+    taken = await first.get()
+    assert stripes.owner(taken) is first
+    assert len(first.items) + len(second.items) + buffer.q.qsize() == 1
+
+    await first.leave()
+    await second.leave()
+    assert buffer.q.qsize() == 1 and not first.items and not second.items
+
+
+@pytest.mark.asyncio
+async def test_message_for_closed_connection_stays_queued(worker):
+    released = []
+    worker.outbound = FakeBuffer([])
+    worker.outbound.release = released.append
+    await worker.conn.close()
+    await worker.drain_buf(dict(path="/nonexistent"))
+    assert worker.outbound.q.get_nowait() == dict(path="/nonexistent")
+    assert not released and not worker.conn.sent
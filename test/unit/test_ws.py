@@ -0,0 +1,71 @@
+import asyncio
+
+import aiohttp
+import aiohttp.web
+import pytest
+
+from receptor.bridgequeue import BridgeQueue
+from receptor.connection.ws import MIN_MESSAGE, WebSocket, message_protocols
+
+
+def test_message_protocols():
+    assert message_protocols(2 ** 18 + 1) == [
+        "receptor.max-message.262144",
+        "receptor.max-message.131072",
+        "receptor.max-message.65536",
+    ]
+
+
+async def exchange(loop, server_protocols, client_protocols, data):
+    """Sends data from a client to a server websocket, returns both transports and the messages."""
+    received = []
+    server_side = loop.create_future()
+
+    async def handler(request):
+        ws = aiohttp.web.WebSocketResponse(protocols=server_protocols)
+        await ws.prepare(request)
+        server_side.set_result(WebSocket(ws))
+        async for msg in ws:
+            received.append(msg.data)
+        return ws
+
+    app = aiohttp.web.Application()
+    app.add_routes([aiohttp.web.get("/", handler)])
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(
+                f"http://127.0.0.1:{port}/", protocols=client_protocols
+            ) as ws:
+                client = WebSocket(ws)
+                q = BridgeQueue()
+                for n in range(0, len(data), 4096):
+                    q.put_nowait(data[n : n + 4096])
+                q.close()
+                await client.send(q)
+        return client, await asyncio.wait_for(server_side, 5), received
+    finally:
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_coalesce_to_negotiated_size(event_loop):
+    data = bytes(range(256)) * 2 ** 12
+    client, server, received = await exchange(
+        event_loop, message_protocols(2 ** 17), message_protocols(2 ** 20), data
+    )
+    assert client.max_message == server.max_message == 2 ** 17
+    assert b"".join(received) == data
+    assert [len(m) for m in received] == [2 ** 17] * 8
+
+
+@pytest.mark.asyncio
+async def test_unnegotiated_peer(event_loop):
+    data = b"x" * (MIN_MESSAGE + 10)
+    client, server, received = await exchange(event_loop, (), message_protocols(2 ** 20), data)
+    assert client.max_message == server.max_message == MIN_MESSAGE
+    assert [len(m) for m in received] == [MIN_MESSAGE, 10]